@@ -0,0 +1,100 @@
+"""Benchmark CSV vs binary COPY of analytics rows: rows/sec, client CPU and bytes sent.
+
+Usage:
+    python benchmarks/bench_copy_formats.py [--rows 100000 1000000] [--repeat 3] [--dsn "host=... dbname=..."]
+
+Rows are the mapped rows of a yandex impressions report (see bench_impressions_ingest.py),
+typed like data_analytics_bydays_main. Without --dsn the COPY stream is consumed by a
+null cursor, which measures client-side encoding only. With --dsn rows are COPY'd into
+a temp table with the same column types, so server-side parsing is included in wall time;
+with a server on this host the CPU time of its backend process is reported too.
+Each result is the best of --repeat runs."""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_impressions_ingest import synthetic_rows, COLUMNS, NullCursor  # noqa: E402
+
+PG_TYPES = {'sku_id': 'text', 'sku_name': 'text', 'date': 'date', 'category_id': 'bigint',
+            'category_name': 'text', 'brand_id': 'bigint', 'brand_name': 'text',
+            'session_view': 'integer', 'hits_tocart': 'integer', 'conv_tocart': 'double precision',
+            'delivered_units': 'integer', 'revenue': 'double precision', 'region_id': 'integer',
+            'region_name': 'text', 'api_id': 'integer'}
+# File header -> column, in COLUMNS order (api_id is added)
+SOURCE_INDEXES = [14, 15, 5, 12, 13, 10, 11, 16, 17, 18, 19, 21, 8, 9]
+
+
+def mapped_rows(n):
+    return [tuple(row[i] for i in SOURCE_INDEXES) + (1,) for row in synthetic_rows(n)]
+
+
+def backend_cpu(pid):
+    """CPU seconds of a server backend process, None if the server is not on this host."""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def run(rows, copy_format, dsn):
+    from bulk_load import copy_rows, copy_rows_binary
+    pg_types = [PG_TYPES[column] for column in COLUMNS]
+    connection = None
+    if dsn:
+        import psycopg2
+        connection = psycopg2.connect(dsn)
+        cursor = connection.cursor()
+        cursor.execute(f"CREATE TEMP TABLE bench_copy ({', '.join(f'{c} {PG_TYPES[c]}' for c in COLUMNS)});")
+        cursor.execute("SELECT pg_backend_pid();")
+        backend_pid = cursor.fetchone()[0]
+    else:
+        cursor = NullCursor()
+        backend_pid = None
+    server_cpu_started = backend_cpu(backend_pid) if backend_pid else None
+    started = time.perf_counter()
+    cpu_started = time.process_time()
+    if copy_format == 'binary':
+        loaded, bytes_sent = copy_rows_binary(cursor, 'bench_copy', COLUMNS, rows, pg_types)
+    else:
+        loaded, bytes_sent = copy_rows(cursor, 'bench_copy', COLUMNS, rows)
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    server_cpu = None
+    if server_cpu_started is not None:
+        server_cpu = round(backend_cpu(backend_pid) - server_cpu_started, 3)
+    if connection is not None:
+        connection.rollback()
+        connection.close()
+    return {'rows': loaded, 'seconds': round(elapsed, 3), 'client_cpu_seconds': round(cpu, 3),
+            'server_cpu_seconds': server_cpu, 'rows_per_sec': round(loaded / elapsed), 'bytes_sent': bytes_sent}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--dsn', default=os.getenv('BENCH_DSN'))
+    parser.add_argument('--json', action='store_true', help="print results as JSON lines")
+    args = parser.parse_args()
+    for n in args.rows:
+        rows = mapped_rows(n)
+        for copy_format in ('csv', 'binary'):
+            result = min((run(rows, copy_format, args.dsn) for _ in range(args.repeat)),
+                         key=lambda r: r['seconds'])
+            if args.json:
+                print(json.dumps(dict(result, format=copy_format, server=bool(args.dsn))))
+                continue
+            print(f"{n:>9} rows {copy_format:>6}: {result['rows_per_sec']:>8} rows/s, {result['seconds']:>7}s, "
+                  f"client CPU {result['client_cpu_seconds']:>7}s, server CPU {result['server_cpu_seconds']}s, "
+                  f"{result['bytes_sent'] / 1024 ** 2:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,499 @@
+"""Load test of the upload, listing, download and report endpoints under gunicorn:
+latency p50/p99, throughput and peak RSS of the workers per scenario, saved as JSON.
+
+Usage:
+    docker compose -f benchmarks/docker-compose.yml up -d
+    python benchmarks/bench_endpoints.py [--scenarios upload_price list_client_files report ...]
+                                         [--requests 50] [--concurrency 8] [--rows 1000] [--format xlsx]
+                                         [--report-rows 10000] [--upstream-delay 0] [--workers 8]
+                                         [--job-rows 100000]
+                                         [--gunicorn-arg=--worker-class=gthread] [--out benchmarks/results]
+                                         [--baseline results/endpoints-....json] [--tolerance 0.2]
+
+The driver starts stub_upstream.py and gunicorn with gunicorn.conf.py in a temp work dir
+with links to the app (stored files don't go to the repo), creates the tables with
+setup_db.py and runs every scenario: --requests requests sent by --concurrency client
+threads, after --warmup requests that are not counted. PG_* default to the database of benchmarks/docker-compose.yml. With --base-url
+an app that is already running is measured (worker RSS only with --server-pid).
+
+Upload scenarios send workbooks of workbooks.py (--variants different files, so uploads are
+not all deduplicated) and, with a processor for the file group, wait for the job to finish:
+latency is the upload request, job_seconds is from the upload response to the job end.
+Report scenarios send a different body every time, so the report cache is not hit.
+report_during_job sends the report requests while the job of a --job-rows impressions
+upload is running (it is uploaded first, its job_seconds and whether it was still running
+when the reports ended are saved as background_job): reports must not wait for the job.
+Worker RSS is sampled every 0.1s during a scenario (sum of workers and the biggest worker), pool
+processes forked by the workers (cpu_pool, jobs) are summed separately.
+
+Results are saved to --out as endpoints-<time>.json with the commit and the settings. With
+--baseline, scenarios whose p50 or p99 grew, or whose throughput fell, by more than
+--tolerance are listed and the exit status is 1."""
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from workbooks import KINDS, make_workbook  # noqa: E402
+
+# Database of benchmarks/docker-compose.yml, used when PG_* are not set
+BENCH_PG_ENV = {'PG_HOST': '127.0.0.1', 'PG_PORT': '55432', 'PG_DB': 'files_load_api_bench',
+                'PG_USER': 'bench', 'PG_PASSWORD': 'bench', 'SSLMODE': 'disable', 'TARGET_SESSION_ATTRS': 'any'}
+CLIENT_ID = 900001
+REPORT_METHOD = '/graphs/full'
+BATCH_METHODS = ['/graphs/full', '/graphs/ddr', '/graphs/revenue']
+JOB_POLL_INTERVAL = 0.05
+JOB_TIMEOUT = 600
+
+SCENARIOS = ['upload_price', 'upload_margin', 'upload_mapping', 'upload_impressions', 'upload_boost',
+             'upload_report_file', 'list_client_files', 'list_report_files', 'download', 'report',
+             'report_batch', 'report_during_job']
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of values."""
+    ordered = sorted(values)
+    return ordered[max(math.ceil(q / 100 * len(ordered)) - 1, 0)]
+
+
+def summary(values, digits=1, scale=1):
+    if not values:
+        return None
+    return {'p50': round(percentile(values, 50) * scale, digits), 'p90': round(percentile(values, 90) * scale, digits),
+            'p99': round(percentile(values, 99) * scale, digits), 'max': round(max(values) * scale, digits),
+            'mean': round(sum(values) / len(values) * scale, digits)}
+
+
+def process_tree(master_pid):
+    """Pids of the children of master_pid (the workers) and of all their descendants
+    (cpu_pool and job processes), as two lists."""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                # The process name may contain spaces, fields after it are fixed
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(name))
+    workers = children.get(master_pid, [])
+    descendants = []
+    parents = list(workers)
+    while parents:
+        pids = [pid for parent in parents for pid in children.get(parent, [])]
+        descendants.extend(pids)
+        parents = pids
+    return workers, descendants
+
+
+def status_kb(pid, field):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+class RssSampler:
+    """Samples VmRSS of the gunicorn workers and of their pool processes in a thread, keeps the peaks."""
+
+    def __init__(self, master_pid, interval=0.1):
+        self.master_pid = master_pid
+        self.interval = interval
+        self.peak_total = self.peak_worker = self.peak_pool_total = self.peak_all = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            workers, pool_processes = process_tree(self.master_pid)
+            sizes = [status_kb(pid, 'VmRSS') for pid in workers]
+            pool_total = sum(status_kb(pid, 'VmRSS') for pid in pool_processes)
+            if sizes:
+                self.peak_total = max(self.peak_total, sum(sizes))
+                self.peak_worker = max(self.peak_worker, max(sizes))
+            self.peak_pool_total = max(self.peak_pool_total, pool_total)
+            self.peak_all = max(self.peak_all, sum(sizes) + pool_total)
+            if self._stop.wait(self.interval):
+                return
+
+    def __enter__(self):
+        if self.master_pid:
+            self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def result(self):
+        if not self.master_pid:
+            return None
+        return {'peak_total': round(self.peak_total / 1024, 1), 'peak_worker': round(self.peak_worker / 1024, 1),
+                'peak_pool_total': round(self.peak_pool_total / 1024, 1), 'peak_all': round(self.peak_all / 1024, 1)}
+
+
+class Client:
+    """Sends the requests of the scenarios; one requests.Session per client thread."""
+
+    def __init__(self, base_url, args):
+        self.base_url = base_url.rstrip('/')
+        self.args = args
+        self.local = threading.local()
+        self.run_id = datetime.now().strftime('%H%M%S%f')
+        self.file_ids = []
+
+    @property
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def send(self, method, path, parse=False, **kwargs):
+        """Return (status, bytes received, response JSON if parse else None); the body is read to the end."""
+        with self.session.request(method, self.base_url + path, stream=True, timeout=JOB_TIMEOUT,
+                                  **kwargs) as response:
+            if parse:
+                content = response.content
+                try:
+                    return response.status_code, len(content), json.loads(content)
+                except ValueError:
+                    return response.status_code, len(content), None
+            received = 0
+            for chunk in response.iter_content(65536):
+                received += len(chunk)
+            return response.status_code, received, None
+
+    def wait_job(self, job_id):
+        """Return (final status, seconds) of a job, polling /jobs/<job_id>."""
+        started = time.perf_counter()
+        while time.perf_counter() - started < JOB_TIMEOUT:
+            status, _, data = self.send('GET', f'/jobs/{job_id}', parse=True)
+            if status != 200 or not data:
+                return f'http {status}', time.perf_counter() - started
+            if data['status'] in ('done', 'failed'):
+                return data['status'], time.perf_counter() - started
+            time.sleep(JOB_POLL_INTERVAL)
+        return 'timeout', time.perf_counter() - started
+
+    def upload(self, i, kind, table='client_files'):
+        args = self.args
+        file_path = make_workbook(kind, args.rows, args.format, i % args.variants, args.data_dir)
+        file_group = KINDS[kind][0] if table == 'client_files' else 'bench'
+        with open(file_path, 'rb') as f:
+            started = time.perf_counter()
+            status, received, data = self.send(
+                'POST', f'/{table}/bench_{kind}_{i}.{args.format}', parse=True,
+                params={'client_id': CLIENT_ID, 'file_group': file_group, 'api_id': 1}, data=f)
+            latency = time.perf_counter() - started
+        extra = {'sent': os.path.getsize(file_path)}
+        if status == 202 and data and args.wait_jobs:
+            extra['job_status'], extra['job_seconds'] = self.wait_job(data['job_id'])
+        return status, latency, received, extra
+
+    def timed(self, method, path, **kwargs):
+        started = time.perf_counter()
+        status, received, _ = self.send(method, path, **kwargs)
+        return status, time.perf_counter() - started, received, {}
+
+    def request(self, scenario, i):
+        """Send request i of scenario. Return (status, latency, bytes received, extra dict)."""
+        if scenario.startswith('upload_') and scenario != 'upload_report_file':
+            return self.upload(i, scenario[len('upload_'):])
+        if scenario == 'upload_report_file':
+            return self.upload(i, 'price', table='client_report_files')
+        if scenario == 'list_client_files':
+            return self.timed('GET', '/client_files/', params={'client_id': CLIENT_ID, 'limit': self.args.list_limit})
+        if scenario == 'list_report_files':
+            return self.timed('GET', '/client_report_files/',
+                              params={'client_id': CLIENT_ID, 'limit': self.args.list_limit})
+        if scenario == 'download':
+            return self.timed('GET', f'/client_files/{self.file_ids[i % len(self.file_ids)]}')
+        data = {'rows': self.args.report_rows, 'delay': self.args.upstream_delay,
+                'nonce': f'{self.run_id}-{scenario}-{i}'}
+        if scenario in ('report', 'report_during_job'):
+            params = {'client_id': CLIENT_ID, 'method': REPORT_METHOD, 'format': self.args.report_format}
+            return self.timed('POST', '/report', json=data, params=params)
+        if scenario == 'report_batch':
+            return self.timed('POST', '/reports/batch', params={'client_id': CLIENT_ID},
+                              json={'methods': BATCH_METHODS, 'data': data})
+        raise ValueError(f"Unknown scenario {scenario}")
+
+    def load_file_ids(self):
+        try:
+            status, _, files = self.send('GET', '/client_files/', parse=True,
+                                         params={'client_id': CLIENT_ID, 'limit': 100})
+        except requests.exceptions.RequestException:
+            status, files = None, None
+        self.file_ids = [info['file_id'] for info in files] if status == 200 and files else []
+
+
+class BackgroundJob:
+    """Uploads a --job-rows impressions workbook and waits for its job in a thread."""
+
+    def __init__(self, client, args):
+        self.client = client
+        self.args = args
+        self.queued = threading.Event()
+        self.result = {}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        """Start the upload, return once the job is queued."""
+        self._thread.start()
+        self.queued.wait(JOB_TIMEOUT)
+
+    def _run(self):
+        args = self.args
+        file_path = make_workbook('impressions', args.job_rows, args.format, 0, args.data_dir)
+        try:
+            with open(file_path, 'rb') as f:
+                status, _, data = self.client.send(
+                    'POST', f'/client_files/bench_job_{self.client.run_id}.{args.format}', parse=True,
+                    params={'client_id': CLIENT_ID, 'file_group': KINDS['impressions'][0], 'api_id': 1}, data=f)
+            self.result['upload_status'] = status
+            if status == 202 and data:
+                self.queued.set()
+                self.result['job_status'], job_seconds = self.client.wait_job(data['job_id'])
+                self.result['job_seconds'] = round(job_seconds, 3)
+        except requests.exceptions.RequestException as e:
+            self.result['upload_status'] = type(e).__name__
+        finally:
+            self.queued.set()
+
+    def join(self):
+        """Wait for the job, return the result with whether it was still running when the reports ended."""
+        self.result['running_after_reports'] = self._thread.is_alive()
+        self._thread.join()
+        return self.result
+
+
+def run_scenario(client, scenario, args, master_pid):
+    if scenario == 'download':
+        client.load_file_ids()
+        if not client.file_ids:
+            return {'skipped': "no client files to download, run an upload scenario first"}
+
+    def one(i):
+        try:
+            return client.request(scenario, i)
+        except requests.exceptions.RequestException as e:
+            return type(e).__name__, None, 0, {}
+
+    for i in range(args.warmup):
+        one(-1 - i)
+    background = None
+    if scenario == 'report_during_job':
+        background = BackgroundJob(client, args)
+        background.start()
+    latencies, statuses, extras = [], Counter(), []
+    received = sent = 0
+    with RssSampler(master_pid) as sampler, ThreadPoolExecutor(args.concurrency) as pool:
+        started = time.perf_counter()
+        for status, latency, size, extra in pool.map(one, range(args.requests)):
+            statuses[str(status)] += 1
+            if latency is not None:
+                latencies.append(latency)
+            received += size
+            sent += extra.get('sent', 0)
+            extras.append(extra)
+        elapsed = time.perf_counter() - started
+    errors = sum(count for status, count in statuses.items() if not status.isdigit() or int(status) >= 400)
+    result = {'requests': args.requests, 'errors': errors, 'statuses': dict(statuses), 'seconds': round(elapsed, 3),
+              'throughput_rps': round(args.requests / elapsed, 2), 'latency_ms': summary(latencies, scale=1000),
+              'mb_sent': round(sent / 1024 ** 2, 2), 'mb_received': round(received / 1024 ** 2, 2),
+              'worker_rss_mb': sampler.result()}
+    if background:
+        result['background_job'] = background.join()
+    job_seconds = [extra['job_seconds'] for extra in extras if 'job_seconds' in extra]
+    if job_seconds:
+        result['job_seconds'] = summary(job_seconds, digits=3)
+        result['job_statuses'] = dict(Counter(extra['job_status'] for extra in extras if 'job_status' in extra))
+    return result
+
+
+def wait_ready(url, process, log_path, timeout=60):
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if process is not None and process.poll() is not None:
+            break
+        try:
+            if requests.get(url, timeout=1).ok:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    with open(log_path, errors='replace') as f:
+        log_tail = f.read()[-3000:]
+    raise SystemExit(f"{url} is not ready:\n{log_tail}")
+
+
+def link_app(work_dir):
+    """Link the app modules and assets into work_dir. The app keeps files in ./files_storage and
+    Flask resolves them from the app dir, so both have to be work_dir, not the repo."""
+    for name in os.listdir(ROOT):
+        if name.endswith('.py') or name in ('static', 'templates'):
+            os.symlink(os.path.join(ROOT, name), os.path.join(work_dir, name))
+
+
+def start_servers(args, work_dir, processes):
+    """Start the upstream stub and gunicorn, return (app base url, gunicorn master pid)."""
+    env = dict(os.environ)
+    for name, value in BENCH_PG_ENV.items():
+        env.setdefault(name, value)
+    upstream_url = f'http://127.0.0.1:{args.upstream_port}'
+    env.update(GRAPHS_API_URL=upstream_url, BENCH_UPSTREAM_URL=upstream_url, PROCESSOR_MODULES='bench_processors',
+               PROMETHEUS_MULTIPROC_DIR=os.path.join(work_dir, 'metrics'),
+               LOG_FILE=os.path.join(work_dir, 'files_load_api.log'), LOG_LEVEL=env.get('LOG_LEVEL', 'INFO'))
+    link_app(work_dir)
+    # setup_db.py imports the metrics, which need the directory (gunicorn clears it again on start)
+    os.makedirs(env['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+    if not args.skip_setup:
+        setup = subprocess.run([sys.executable, os.path.join(BENCH_DIR, 'setup_db.py')], cwd=work_dir, env=env,
+                               capture_output=True, text=True)
+        if setup.returncode:
+            raise SystemExit(f"Database setup failed (is benchmarks/docker-compose.yml up?):\n{setup.stderr[-3000:]}")
+
+    stub_log = os.path.join(work_dir, 'stub_upstream.log')
+    with open(stub_log, 'w') as log:
+        processes.append(subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'stub_upstream.py'),
+                                           '--port', str(args.upstream_port)], stdout=log, stderr=log))
+    wait_ready(upstream_url + '/health', processes[-1], stub_log)
+
+    gunicorn_log = os.path.join(work_dir, 'gunicorn.log')
+    command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'),
+               '--pythonpath', f'{work_dir},{BENCH_DIR}', '-b', f'127.0.0.1:{args.port}',
+               '--workers', str(args.workers), '--timeout', '600'] + args.gunicorn_arg + ['flask_app:app']
+    with open(gunicorn_log, 'w') as log:
+        processes.append(subprocess.Popen(command, cwd=work_dir, env=env, stdout=log, stderr=log))
+    base_url = f'http://127.0.0.1:{args.port}'
+    wait_ready(base_url + '/metrics', processes[-1], gunicorn_log)
+    return base_url, processes[-1].pid
+
+
+def compare(results, baseline, tolerance):
+    """Print changes against baseline results, return names of regressed scenarios."""
+    regressed = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous or not current.get('latency_ms') or not previous.get('latency_ms'):
+            continue
+        changes = {'p50': current['latency_ms']['p50'] / max(previous['latency_ms']['p50'], 1e-9),
+                   'p99': current['latency_ms']['p99'] / max(previous['latency_ms']['p99'], 1e-9),
+                   'throughput': current['throughput_rps'] / max(previous['throughput_rps'], 1e-9)}
+        worse = (changes['p50'] > 1 + tolerance or changes['p99'] > 1 + tolerance
+                 or changes['throughput'] < 1 - tolerance)
+        if worse:
+            regressed.append(name)
+        print(f"{name:>20}: p50 x{changes['p50']:.2f}, p99 x{changes['p99']:.2f}, "
+              f"throughput x{changes['throughput']:.2f}{'  REGRESSION' if worse else ''}")
+    return regressed
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=1000, help="rows of uploaded workbooks")
+    parser.add_argument('--format', choices=['xlsx', 'csv'], default='xlsx')
+    parser.add_argument('--variants', type=int, default=5, help="different workbooks per upload scenario")
+    parser.add_argument('--no-wait-jobs', dest='wait_jobs', action='store_false')
+    parser.add_argument('--list-limit', type=int, default=1000)
+    parser.add_argument('--report-rows', type=int, default=10000)
+    parser.add_argument('--job-rows', type=int, default=100000, help="rows of the report_during_job upload")
+    parser.add_argument('--report-format', choices=['xlsx', 'csv', 'csv.gz'], default='xlsx')
+    parser.add_argument('--upstream-delay', type=float, default=0, help="seconds before the stub answers")
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--gunicorn-arg', action='append', default=[], help="extra gunicorn argument, repeatable")
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--upstream-port', type=int, default=18080)
+    parser.add_argument('--base-url', help="measure an already running app")
+    parser.add_argument('--server-pid', type=int, help="gunicorn master pid of --base-url, for RSS")
+    parser.add_argument('--skip-setup', action='store_true', help="don't create the tables")
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'files_load_api_bench'))
+    parser.add_argument('--out', default=os.path.join(BENCH_DIR, 'results'))
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    processes = []
+    work_dir = tempfile.mkdtemp(prefix='files_load_api_bench_')
+    try:
+        if args.base_url:
+            base_url, master_pid = args.base_url, args.server_pid
+        else:
+            base_url, master_pid = start_servers(args, work_dir, processes)
+        client = Client(base_url, args)
+        results = {'benchmark': 'endpoints', 'started_at': datetime.now().isoformat(timespec='seconds'),
+                   'commit': git_commit(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+                   'settings': {name: value for name, value in vars(args).items()
+                                if name not in ('out', 'baseline', 'data_dir')},
+                   'scenarios': {}}
+        for scenario in args.scenarios:
+            result = results['scenarios'][scenario] = run_scenario(client, scenario, args, master_pid)
+            if 'skipped' in result:
+                print(f"{scenario:>20}: skipped, {result['skipped']}")
+                continue
+            latency = result['latency_ms'] or {}
+            rss = result['worker_rss_mb'] or {}
+            print(f"{scenario:>20}: {result['throughput_rps']:>8} req/s, p50 {latency.get('p50')} ms, "
+                  f"p99 {latency.get('p99')} ms, errors {result['errors']}, "
+                  f"workers RSS peak {rss.get('peak_total')} MB (max worker {rss.get('peak_worker')} MB), "
+                  f"pool processes {rss.get('peak_pool_total')} MB, all {rss.get('peak_all')} MB"
+                  + (f", job p50 {result['job_seconds']['p50']}s" if 'job_seconds' in result else '')
+                  + (f", background job {result['background_job']}" if 'background_job' in result else ''))
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    os.makedirs(args.out, exist_ok=True)
+    out_path = os.path.join(args.out, f"endpoints-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {out_path}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+        if regressed:
+            sys.exit(f"Regressions: {', '.join(regressed)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""Benchmark upload_ya_impressions_and_sales ingestion: rows/sec and peak RSS.
+
+Usage:
+    python benchmarks/bench_impressions_ingest.py [--rows 100000 1000000 5000000] [--format csv|xlsx]
+                                                  [--legacy] [--dsn "host=... dbname=..."]
+
+Every size runs in a fresh subprocess, so peak RSS is not polluted by the previous run.
+Without --dsn the COPY stream is consumed by a null cursor, which measures reading,
+mapping and CSV encoding. With --dsn rows are COPY'd into a temp table.
+--legacy measures the previous pandas path (read whole file + one StringIO buffer).
+xlsx sizes over the sheet limit of Excel (1048576 rows) are skipped, clients can't send them."""
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import resource
+import subprocess
+import tempfile
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+HEADERS = ['Название бизнес аккаунта', 'Тип бизнес аккаунта', 'ID бизнес аккаунта',
+           'Магазин', 'ID магазина', 'День', 'Месяц', 'Год', 'ID округа',
+           'Федеральный округ', 'ID бренда', 'Бренд', 'ID категории', 'Категория',
+           'Ваш SKU', 'Название товара', 'Показы', 'Добавлено в корзину, шт.',
+           'Конверсия добавления в корзину, %', 'Продажи, шт.',
+           'Цена товара, руб.', 'Продажи, руб.']
+COLUMNS = ['sku_id', 'sku_name', 'date', 'category_id', 'category_name', 'brand_id', 'brand_name',
+           'session_view', 'hits_tocart', 'conv_tocart', 'delivered_units', 'revenue',
+           'region_id', 'region_name', 'api_id']
+XLSX_MAX_ROWS = 1048576
+
+
+def synthetic_rows(n, seed=0):
+    rnd = random.Random(seed)
+    start = date(2022, 1, 1)
+    for i in range(n):
+        day = start + timedelta(days=i % 365)
+        views = rnd.randint(0, 5000)
+        tocart = rnd.randint(0, max(views // 10, 1))
+        units = rnd.randint(0, tocart)
+        price = round(rnd.uniform(100, 10000), 2)
+        region = i % 9
+        yield ('Бизнес', 'Продавец', 1001, 'Магазин', 2002, day.isoformat(), day.month, day.year, region,
+               f'Округ {region}', 300 + i % 50, f'Бренд {i % 50}', 400 + i % 200, f'Категория {i % 200}',
+               f'SKU-{i // 365}', f'Товар {i // 365}', views, tocart,
+               round(100 * tocart / views, 2) if views else 0, units, price, round(units * price, 2))
+
+
+def make_file(n, file_format, dir_path):
+    file_path = os.path.join(dir_path, f'impressions_{n}.{file_format}')
+    if os.path.exists(file_path):
+        return file_path
+    # Written under a temp name, so a run interrupted while writing leaves no broken file
+    temp_path = f'{file_path}.{os.getpid()}.tmp.{file_format}'
+    if file_format == 'csv':
+        with open(temp_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADERS)
+            writer.writerows(synthetic_rows(n))
+    else:
+        from openpyxl import Workbook
+        workbook = Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        sheet.append(HEADERS)
+        for row in synthetic_rows(n):
+            sheet.append(row)
+        workbook.save(temp_path)
+    os.replace(temp_path, file_path)
+    return file_path
+
+
+class NullCursor:
+    """Consumes COPY data like the server would, without a server."""
+    bytes_read = 0
+
+    def copy_expert(self, sql, file, size=8192):
+        while True:
+            chunk = file.read(size)
+            if not chunk:
+                break
+            self.bytes_read += len(chunk)
+
+
+def run_streaming(file_path, dsn):
+    from file_readers import iter_rows
+    from bulk_load import copy_rows
+    rows = iter_rows(file_path)
+    headers = next(rows)
+    indexes = [headers.index(h) for h in ('Ваш SKU', 'Название товара', 'День', 'ID категории', 'Категория',
+                                          'ID бренда', 'Бренд', 'Показы', 'Добавлено в корзину, шт.',
+                                          'Конверсия добавления в корзину, %', 'Продажи, шт.',
+                                          'Продажи, руб.', 'ID округа', 'Федеральный округ')]
+    mapped_rows = (tuple(row[i] for i in indexes) + (1,) for row in rows)
+    if not dsn:
+        return copy_rows(NullCursor(), 'bench_impressions', COLUMNS, mapped_rows)[0]
+    import psycopg2
+    connection = psycopg2.connect(dsn)
+    cursor = connection.cursor()
+    cursor.execute(f"CREATE TEMP TABLE bench_impressions ({', '.join(c + ' TEXT' for c in COLUMNS)});")
+    loaded = copy_rows(cursor, 'bench_impressions', COLUMNS, mapped_rows)[0]
+    connection.rollback()
+    connection.close()
+    return loaded
+
+
+def run_legacy(file_path, dsn):
+    import pandas as pd
+    from io import StringIO
+    df = pd.read_csv(file_path) if file_path.endswith('.csv') else pd.read_excel(file_path)
+    df = df[['Ваш SKU', 'Название товара', 'День', 'ID категории', 'Категория', 'ID бренда', 'Бренд', 'Показы',
+             'Добавлено в корзину, шт.', 'Конверсия добавления в корзину, %', 'Продажи, шт.', 'Продажи, руб.',
+             'ID округа', 'Федеральный округ']]
+    df.columns = COLUMNS[:-1]
+    df['api_id'] = 1
+    s_buf = StringIO()
+    csv.writer(s_buf).writerows(df.itertuples(index=False, name=None))
+    s_buf.seek(0)
+    NullCursor().copy_expert('', s_buf)
+    return len(df)
+
+
+def child(file_path, legacy, dsn):
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    rows = run_legacy(file_path, dsn) if legacy else run_streaming(file_path, dsn)
+    elapsed = time.perf_counter() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'rows': rows, 'seconds': round(elapsed, 3), 'rows_per_sec': round(rows / elapsed),
+                      'peak_rss_mb': round(peak_rss / 1024, 1),
+                      'rss_growth_mb': round((peak_rss - rss_before) / 1024, 1)}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000, 5000000])
+    parser.add_argument('--format', choices=['csv', 'xlsx'], default='csv')
+    parser.add_argument('--legacy', action='store_true')
+    parser.add_argument('--dsn', default=os.getenv('BENCH_DSN'))
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'files_load_api_bench'))
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.legacy, args.dsn)
+        return
+    os.makedirs(args.data_dir, exist_ok=True)
+    for n in args.rows:
+        if args.format == 'xlsx' and n > XLSX_MAX_ROWS - 1:
+            print(f"{n:>9} rows xlsx: skipped, a sheet holds {XLSX_MAX_ROWS - 1} data rows")
+            continue
+        file_path = make_file(n, args.format, args.data_dir)
+        command = [sys.executable, __file__, '--child', file_path] + (['--legacy'] if args.legacy else [])
+        if args.dsn:
+            command += ['--dsn', args.dsn]
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{n:>9} rows {args.format} {'legacy' if args.legacy else 'streaming'}: "
+              f"{result['rows_per_sec']:>8} rows/s, {result['seconds']:>7}s, "
+              f"peak RSS {result['peak_rss_mb']} MB (+{result['rss_growth_mb']} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""Processors of the offers file groups sending to the upstream stub, for the endpoint benchmarks.
+
+Loaded by the app with PROCESSOR_MODULES=bench_processors (benchmarks/ on the python path):
+price, margin and offers_mapping_table are registered again with urls on BENCH_UPSTREAM_URL,
+so their jobs run to the end instead of failing on the empty upstream url."""
+import os
+from processors import Processor, register
+
+# Base URL of benchmarks/stub_upstream.py
+BENCH_UPSTREAM_URL = os.getenv('BENCH_UPSTREAM_URL', 'http://127.0.0.1:18080')
+
+register(Processor('price', schema='price', value_key='price', url=BENCH_UPSTREAM_URL + '/offers/price',
+                   reader='file_handling_methods:read_offer_values',
+                   transform='file_handling_methods:offer_values_payload',
+                   sink='file_handling_methods:post_json',
+                   message="prices are uploaded"))
+register(Processor('margin', schema='margin', value_key='min_margin', url=BENCH_UPSTREAM_URL + '/offers/margin',
+                   reader='file_handling_methods:read_offer_values',
+                   transform='file_handling_methods:offer_values_payload',
+                   sink='file_handling_methods:post_json',
+                   message="min margin are uploaded"))
+register(Processor('offers_mapping_table', url=BENCH_UPSTREAM_URL + '/offers/mapping',
+                   reader='file_handling_methods:read_checked_frame',
+                   transform='file_handling_methods:offers_mapping_payload',
+                   sink='file_handling_methods:post_json',
+                   message="offers mapping table are uploaded"))
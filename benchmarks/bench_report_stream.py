@@ -0,0 +1,101 @@
+"""Benchmark conversion of an upstream graph result to a report file: time and peak RSS.
+
+Usage:
+    python benchmarks/bench_report_stream.py [--rows 100000 1000000 3000000] [--shape records|columns]
+                                             [--format csv|csv.gz|xlsx]
+
+'loads' is the previous path (response.json() + report_writers.table_from_result),
+'stream' parses the body in chunks with json_stream.spill_table. The upstream body is
+a JSON file read in 64 KiB chunks, like response.iter_content. Every run is done in a
+fresh subprocess (so is the generation of the body), so peak RSS is not polluted
+by the previous run."""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_report_writers import synthetic_records  # noqa: E402
+
+CHUNK_SIZE = 65536
+
+
+def body_path(n, shape, dir_path):
+    return os.path.join(dir_path, f'graph_{shape}_{n}.json')
+
+
+def make_body(n, shape, file_path):
+    records = synthetic_records(n)
+    with open(file_path, 'w', encoding='utf-8') as f:
+        if shape == 'records':
+            json.dump(records, f)
+        else:
+            json.dump({column: [record[column] for record in records] for column in records[0]}, f)
+
+
+def iter_chunks(file_path):
+    with open(file_path, encoding='utf-8') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def child(body_path, engine, report_format, dir_path):
+    from report_writers import REPORT_FORMATS, table_from_result, write_report
+    file_path = os.path.join(dir_path, f'report_{engine}{REPORT_FORMATS[report_format][0]}')
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    if engine == 'loads':
+        columns, rows = table_from_result(json.loads(''.join(iter_chunks(body_path))))
+        write_report(file_path, report_format, columns, rows, index=True)
+    else:
+        from json_stream import spill_table
+        with spill_table(iter_chunks(body_path), spill_dir=dir_path) as table:
+            write_report(file_path, report_format, table.columns, table.rows(), index=True)
+    elapsed = time.perf_counter() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'seconds': round(elapsed, 3), 'peak_rss_mb': round(peak_rss / 1024, 1),
+                      'rss_growth_mb': round((peak_rss - rss_before) / 1024, 1)}))
+    os.remove(file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000, 3000000])
+    parser.add_argument('--shape', choices=['records', 'columns'], default='records')
+    parser.add_argument('--format', choices=['csv', 'csv.gz', 'xlsx'], default='csv')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'files_load_api_bench'))
+    parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+    parser.add_argument('--make', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child[0], args.child[1], args.format, args.data_dir)
+        return
+    if args.make:
+        make_body(int(args.make[0]), args.shape, args.make[1])
+        return
+    os.makedirs(args.data_dir, exist_ok=True)
+    for n in args.rows:
+        file_path = body_path(n, args.shape, args.data_dir)
+        if not os.path.exists(file_path):
+            subprocess.run([sys.executable, __file__, '--make', str(n), file_path, '--shape', args.shape], check=True)
+        body_mb = os.path.getsize(file_path) / 1024 ** 2
+        for engine in ('loads', 'stream'):
+            command = [sys.executable, __file__, '--child', file_path, engine, '--format', args.format,
+                       '--data-dir', args.data_dir]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{n:>9} {args.shape} ({body_mb:.0f} MB JSON) {engine:>6} -> {args.format}: "
+                  f"{result['seconds']:>7}s, peak RSS {result['peak_rss_mb']} MB (+{result['rss_growth_mb']} MB)")
+
+
+if __name__ == '__main__':
+    main()
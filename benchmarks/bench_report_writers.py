@@ -0,0 +1,78 @@
+"""Benchmark report writers used by get_report: time and peak RSS per format and size.
+
+Usage:
+    python benchmarks/bench_report_writers.py [--rows 10000 100000 1000000]
+                                              [--engines pandas xlsx csv csv.gz]
+
+'pandas' is the previous path (DataFrame.from_records + df.to_excel with openpyxl),
+the other engines are report_writers formats fed directly from the upstream records.
+Every run is done in a fresh subprocess, so peak RSS is not polluted by the previous run.
+The records are built before the measurement: peak RSS includes them, RSS growth is the writer's."""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import resource
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def synthetic_records(n, seed=0):
+    """Records shaped like a /graphs/full response."""
+    rnd = random.Random(seed)
+    return [{'date': f'2023-{1 + i % 12:02d}-{1 + i % 28:02d}', 'sku_id': f'SKU-{i % 5000}',
+             'session_view': rnd.randint(0, 5000), 'hits_tocart': rnd.randint(0, 500),
+             'ordered_units': rnd.randint(0, 50), 'revenue': round(rnd.uniform(0, 100000), 2),
+             'conv_tocart': round(rnd.uniform(0, 30), 2), 'adv_sum_all': round(rnd.uniform(0, 5000), 2)}
+            for i in range(n)]
+
+
+def child(n, engine, dir_path):
+    records = synthetic_records(n)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    if engine == 'pandas':
+        import pandas as pd
+        file_path = os.path.join(dir_path, f'report_{n}_pandas.xlsx')
+        pd.DataFrame.from_records(records).to_excel(file_path)
+    else:
+        from report_writers import REPORT_FORMATS, table_from_result, write_report
+        file_path = os.path.join(dir_path, f'report_{n}{REPORT_FORMATS[engine][0]}')
+        columns, rows = table_from_result(records)
+        write_report(file_path, engine, columns, rows, index=True)
+    elapsed = time.perf_counter() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'seconds': round(elapsed, 3), 'rows_per_sec': round(n / elapsed),
+                      'file_mb': round(os.path.getsize(file_path) / 1024 ** 2, 1),
+                      'peak_rss_mb': round(peak_rss / 1024, 1),
+                      'rss_growth_mb': round((peak_rss - rss_before) / 1024, 1)}))
+    os.remove(file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--engines', nargs='+', default=['pandas', 'xlsx', 'csv', 'csv.gz'])
+    parser.add_argument('--child', nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(int(args.child[0]), args.child[1], args.child[2])
+        return
+    dir_path = tempfile.mkdtemp(prefix='report_writers_bench_')
+    for n in args.rows:
+        for engine in args.engines:
+            output = subprocess.run([sys.executable, __file__, '--child', str(n), engine, dir_path],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{n:>8} rows {engine:>7}: {result['seconds']:>8}s {result['rows_per_sec']:>8} rows/s, "
+                  f"file {result['file_mb']} MB, RSS growth {result['rss_growth_mb']} MB "
+                  f"(peak {result['peak_rss_mb']} MB)")
+    os.rmdir(dir_path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""Benchmark yandex_sales_boost ingestion: report rows/sec, daily rows/sec and peak RSS.
+
+Usage:
+    python benchmarks/bench_sales_boost_ingest.py [--rows 100000 1000000] [--period-days 1 7]
+                                                  [--copy-format csv|binary] [--dsn "host=... dbname=..."]
+
+A synthetic report has --rows rows of --period-days day periods and a summary row.
+It goes through the processor stages (read_report_rows -> expand_periods): streaming read,
+validation, period expansion and the summary check. Every size runs in a fresh subprocess,
+so peak RSS is not polluted by the previous run. Without --dsn the COPY stream is consumed
+by a null cursor; with --dsn daily rows are COPY'd into a temp table."""
+import os
+import sys
+import csv
+import json
+import time
+import random
+import argparse
+import resource
+import subprocess
+import tempfile
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_impressions_ingest import NullCursor  # noqa: E402
+
+HEADERS = ['Название бизнес аккаунта', 'Тип бизнес аккаунта', 'ID бизнес аккаунта',
+           'Магазин', 'ID магазина', 'Начало периода', 'Конец периода', 'Ваш SKU',
+           'Наименование предложения', 'Продано с помощью продвижения, шт',
+           'Продано с помощью продвижения, рубли', 'Расход на продвижение, рубли',
+           'Расход на продвижение, %', 'Средняя стоимость продвижения',
+           'Продано всего, шт', 'Продано всего, рубли', 'Количество, шт',
+           'Доля продаж у партнера', 'Клики по товарам со ставками, шт.',
+           'Все клики, шт.', 'Заказано товаров со ставками, шт.',
+           'Всего заказано товаров, шт.']
+PG_TYPES = {'sku_id': 'text', 'sku_name': 'text', 'hits_view_search': 'integer', 'hits_view': 'integer',
+            'delivered_units': 'integer', 'revenue': 'double precision', 'ordered_units': 'integer',
+            'adv_sum_all': 'double precision', 'date': 'date', 'region_id': 'integer', 'api_id': 'integer'}
+
+
+def synthetic_report(n, period_days, seed=0):
+    """Yield n report rows of period_days periods, then the summary row."""
+    rnd = random.Random(seed)
+    start = date(2022, 1, 1)
+    totals = [0] * len(HEADERS)
+    summed = [9, 10, 11, 14, 15, 18, 19, 20, 21]
+    for i in range(n):
+        period_start = start + timedelta(days=period_days * (i % 52))
+        clicks = rnd.randint(0, 2000)
+        bid_clicks = rnd.randint(0, clicks)
+        ordered = rnd.randint(0, max(clicks // 20, 1))
+        bid_ordered = rnd.randint(0, ordered)
+        sold = rnd.randint(0, ordered)
+        boosted = rnd.randint(0, sold)
+        price = round(rnd.uniform(100, 10000), 2)
+        spend = round(boosted * price * 0.05, 2)
+        row = ['Бизнес', 'Продавец', 1001, 'Магазин', 2002, period_start.isoformat(),
+               (period_start + timedelta(days=period_days - 1)).isoformat(), f'SKU-{i // 52}', f'Товар {i // 52}',
+               boosted, round(boosted * price, 2), spend, round(100 * spend / (sold * price), 2) if sold else 0,
+               round(spend / bid_clicks, 2) if bid_clicks else 0, sold, round(sold * price, 2), sold,
+               round(boosted / sold, 2) if sold else 0, bid_clicks, clicks, bid_ordered, ordered]
+        for index in summed:
+            totals[index] += row[index]
+        yield row
+    yield [None] * 7 + ['', 'Итого'] + [round(totals[i], 2) if i in summed else None for i in range(9, len(HEADERS))]
+
+
+def make_file(n, period_days, dir_path):
+    file_path = os.path.join(dir_path, f'sales_boost_{n}_{period_days}d.csv')
+    if not os.path.exists(file_path):
+        with open(file_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(HEADERS)
+            writer.writerows(synthetic_report(n, period_days))
+    return file_path
+
+
+def child(file_path, copy_format, dsn):
+    from processors import get_processor
+    from bulk_load import copy_rows, copy_rows_binary
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    processor = get_processor('yandex_sales_boost')
+    reader, transform, _ = processor.stages()
+    context = {'file_path': file_path, 'api_id': 1}
+    columns, rows = transform(reader(file_path, processor, context), processor, context)
+    connection = None
+    if dsn:
+        import psycopg2
+        connection = psycopg2.connect(dsn)
+        cursor = connection.cursor()
+        cursor.execute(f"CREATE TEMP TABLE bench_sales_boost ({', '.join(f'{c} {PG_TYPES[c]}' for c in columns)});")
+    else:
+        cursor = NullCursor()
+    if copy_format == 'binary':
+        loaded = copy_rows_binary(cursor, 'bench_sales_boost', columns, rows, [PG_TYPES[c] for c in columns])[0]
+    else:
+        loaded = copy_rows(cursor, 'bench_sales_boost', columns, rows)[0]
+    if connection is not None:
+        connection.rollback()
+        connection.close()
+    elapsed = time.perf_counter() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(json.dumps({'daily_rows': loaded, 'seconds': round(elapsed, 3),
+                      'daily_rows_per_sec': round(loaded / elapsed),
+                      'peak_rss_mb': round(peak_rss / 1024, 1),
+                      'rss_growth_mb': round((peak_rss - rss_before) / 1024, 1)}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--period-days', type=int, nargs='+', default=[1, 7])
+    parser.add_argument('--copy-format', choices=['csv', 'binary'], default='csv')
+    parser.add_argument('--dsn', default=os.getenv('BENCH_DSN'))
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'files_load_api_bench'))
+    parser.add_argument('--json', action='store_true', help="print results as JSON lines")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child, args.copy_format, args.dsn)
+        return
+    os.makedirs(args.data_dir, exist_ok=True)
+    for n in args.rows:
+        for period_days in args.period_days:
+            file_path = make_file(n, period_days, args.data_dir)
+            command = [sys.executable, __file__, '--child', file_path, '--copy-format', args.copy_format]
+            if args.dsn:
+                command += ['--dsn', args.dsn]
+            output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            result.update(rows=n, period_days=period_days, rows_per_sec=round(n / result['seconds']))
+            if args.json:
+                print(json.dumps(result))
+                continue
+            print(f"{n:>9} rows x {period_days} days {args.copy_format}: {result['rows_per_sec']:>7} rows/s, "
+                  f"{result['daily_rows_per_sec']:>8} daily rows/s, {result['seconds']:>7}s, "
+                  f"peak RSS {result['peak_rss_mb']} MB (+{result['rss_growth_mb']} MB)")
+
+
+if __name__ == '__main__':
+    main()
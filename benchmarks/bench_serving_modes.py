@@ -0,0 +1,81 @@
+"""Benchmark gunicorn serving modes with many concurrent slow report requests.
+
+Usage:
+    python benchmarks/bench_serving_modes.py [--modes sync gthread gevent] [--concurrency 256] [--requests 512]
+                                             [--upstream-delay 2] [--report-rows 1000] [--workers 8]
+                                             [--threads 32] [--out benchmarks/results]
+
+Every mode runs the 'report' scenario of bench_endpoints.py (same gunicorn.conf.py and
+upstream stub) with GUNICORN_WORKER_CLASS set to the mode: --concurrency clients send
+/report requests, the stub waits --upstream-delay seconds before it answers. Sync workers
+serve --workers requests at a time, so the others queue; gthread and gevent workers wait
+for the upstream in threads or greenlets while the report conversion runs in cpu_pool.
+gevent needs gevent and psycogreen installed. Arguments after '--' are passed to
+bench_endpoints.py (e.g. -- --skip-setup). The results of all modes are saved as
+serving-modes-<time>.json in --out."""
+import os
+import sys
+import json
+import glob
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def run_mode(mode, args, extra_args):
+    """Run bench_endpoints.py in mode, return its results dict or {'error': ...}."""
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=mode, GUNICORN_THREADS=str(args.threads),
+               GUNICORN_WORKER_CONNECTIONS=str(args.worker_connections))
+    with tempfile.TemporaryDirectory() as out_dir:
+        command = [sys.executable, os.path.join(BENCH_DIR, 'bench_endpoints.py'), '--scenarios', 'report',
+                   '--requests', str(args.requests), '--concurrency', str(args.concurrency),
+                   '--upstream-delay', str(args.upstream_delay), '--report-rows', str(args.report_rows),
+                   '--workers', str(args.workers), '--warmup', str(args.workers), '--out', out_dir] + extra_args
+        process = subprocess.run(command, env=env, capture_output=True, text=True)
+        paths = glob.glob(os.path.join(out_dir, 'endpoints-*.json'))
+        if process.returncode or not paths:
+            return {'error': (process.stderr or process.stdout)[-2000:]}
+        with open(paths[0]) as f:
+            return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--modes', nargs='+', choices=['sync', 'gthread', 'gevent'], default=['sync', 'gthread'])
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--requests', type=int, default=512)
+    parser.add_argument('--upstream-delay', type=float, default=2)
+    parser.add_argument('--report-rows', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--worker-connections', type=int, default=1000)
+    parser.add_argument('--out', default=os.path.join(BENCH_DIR, 'results'))
+    args, extra_args = parser.parse_known_args()
+    extra_args = [arg for arg in extra_args if arg != '--']
+
+    results = {'benchmark': 'serving-modes', 'started_at': datetime.now().isoformat(timespec='seconds'),
+               'settings': vars(args), 'modes': {}}
+    for mode in args.modes:
+        result = results['modes'][mode] = run_mode(mode, args, extra_args)
+        if 'error' in result:
+            print(f"{mode:>8}: failed\n{result['error']}")
+            continue
+        report = result['scenarios']['report']
+        latency = report['latency_ms'] or {}
+        rss = report['worker_rss_mb'] or {}
+        print(f"{mode:>8}: {report['throughput_rps']:>8} req/s, p50 {latency.get('p50')} ms, "
+              f"p99 {latency.get('p99')} ms, errors {report['errors']}, "
+              f"workers RSS peak {rss.get('peak_total')} MB, pool processes {rss.get('peak_pool_total')} MB")
+
+    os.makedirs(args.out, exist_ok=True)
+    out_path = os.path.join(args.out, f"serving-modes-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    with open(out_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results saved to {out_path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Create the tables of the app in the benchmark database, and the storage dirs in the current dir.
+
+Usage:
+    PG_HOST=127.0.0.1 PG_PORT=55432 PG_DB=files_load_api_bench PG_USER=bench PG_PASSWORD=bench \
+        python benchmarks/setup_db.py
+
+The files tables and data_analytics_bydays_main exist in production before the app starts,
+so they are created here; the rest is the setup step of script.sh (python postgres.py)."""
+import os
+import sys
+import runpy
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from postgres import DB, db_connection_string  # noqa: E402
+
+# Columns filled by yandex_impressions_and_sales and yandex_sales_boost, id is used by the duplicates cleanup
+ANALYTICS_TABLE_SQL = """CREATE TABLE IF NOT EXISTS data_analytics_bydays_main (
+                                id BIGSERIAL PRIMARY KEY, sku_id VARCHAR, sku_name VARCHAR, date DATE,
+                                category_id BIGINT, category_name VARCHAR, brand_id BIGINT, brand_name VARCHAR,
+                                session_view INT, hits_tocart INT, conv_tocart DOUBLE PRECISION,
+                                delivered_units INT, revenue DOUBLE PRECISION, region_id INT, region_name VARCHAR,
+                                hits_view_search INT, hits_view INT, ordered_units INT,
+                                adv_sum_all DOUBLE PRECISION, api_id INT);"""
+
+
+def main():
+    with DB(db_connection_string) as db:
+        if db.connection is None:
+            sys.exit("Unable to connect to the database, check PG_* variables.")
+        db.create_client_report_files_table()
+        db.create_templates_table()
+        db.create_client_files_table()
+        cursor = db.connection.cursor()
+        cursor.execute(ANALYTICS_TABLE_SQL)
+        db.connection.commit()
+        cursor.close()
+    runpy.run_path(os.path.join(ROOT, 'postgres.py'), run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
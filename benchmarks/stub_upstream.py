@@ -0,0 +1,103 @@
+"""Local stand-in for the upstream analytics API, for the endpoint benchmarks.
+
+Usage:
+    python benchmarks/stub_upstream.py [--port 18080] [--rows 10000] [--delay 0]
+
+POST /graphs/<method> answers with a JSON result of synthetic records (see
+bench_report_writers.synthetic_records). The request body may set "rows", "shape"
+('records' or 'columns') and "delay" (seconds before the response starts, to mimic a slow
+upstream); --rows and --delay are the defaults. Bodies are built once per (rows, shape)
+and sent in 64 KiB chunks. Any other POST (offers uploads of price, margin and mapping
+processors) reads the body and answers {"status": "ok"}. GET /health answers 200."""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_report_writers import synthetic_records  # noqa: E402
+
+CHUNK_SIZE = 65536
+
+_bodies = {}
+_bodies_lock = threading.Lock()
+
+
+def graph_body(n, shape):
+    with _bodies_lock:
+        body = _bodies.get((n, shape))
+        if body is None:
+            records = synthetic_records(n)
+            if shape == 'columns':
+                result = {column: [record[column] for record in records] for column in records[0]} if records else {}
+            else:
+                result = records
+            body = _bodies[(n, shape)] = json.dumps(result).encode()
+        return body
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    default_rows = 10000
+    default_delay = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        view = memoryview(body)
+        for start in range(0, len(body), CHUNK_SIZE):
+            self.wfile.write(view[start:start + CHUNK_SIZE])
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send(200, b'{"status": "ok"}')
+        else:
+            self._send(404, b'{"detail": "not found"}')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data = self.rfile.read(length) if length else b''
+        if not self.path.startswith('/graphs/'):
+            self._send(200, b'{"status": "ok"}')
+            return
+        try:
+            params = json.loads(data) if data else {}
+        except ValueError:
+            params = None
+        if not isinstance(params, dict):
+            params = {}
+        time.sleep(float(params.get('delay', self.default_delay)))
+        self._send(200, graph_body(int(params.get('rows', self.default_rows)), params.get('shape', 'records')))
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Many app threads connect at once in the concurrency benchmarks
+    request_queue_size = 256
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--rows', type=int, default=Handler.default_rows)
+    parser.add_argument('--delay', type=float, default=Handler.default_delay)
+    args = parser.parse_args()
+    Handler.default_rows = args.rows
+    Handler.default_delay = args.delay
+    server = Server((args.host, args.port), Handler)
+    print(f"Upstream stub on http://{args.host}:{args.port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Synthetic client workbooks for the upload benchmarks.
+
+Usage:
+    python benchmarks/workbooks.py [--kinds price margin mapping impressions boost] [--rows 1000 100000]
+                                   [--format xlsx|csv] [--variants 1] [--out DIR]
+
+Kinds are the processed file groups: price, margin, offers_mapping_table (mapping),
+yandex_impressions_and_sales (impressions) and yandex_sales_boost (boost). Rows pass
+validation of their file group. Variants of a workbook have the same size and different
+values (seed), so repeated uploads are not deduplicated by content. Files are written
+once per (kind, rows, format, variant) and reused by later runs."""
+import os
+import csv
+import sys
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_impressions_ingest  # noqa: E402
+import bench_sales_boost_ingest  # noqa: E402
+
+DATA_DIR = os.path.join(tempfile.gettempdir(), 'files_load_api_bench')
+
+
+def offer_value_rows(n, value_column, seed=0):
+    rnd = random.Random(seed)
+    yield ['offer_id', value_column]
+    for i in range(n):
+        yield [f'OFFER-{seed}-{i}', round(rnd.uniform(1 if value_column == 'price' else -50, 10000), 2)]
+
+
+def mapping_rows(n, seed=0):
+    rnd = random.Random(seed)
+    yield ['offer_id', 'sku_id', 'barcode', 'name']
+    for i in range(n):
+        yield [f'OFFER-{seed}-{i}', f'SKU-{i}', str(4600000000000 + rnd.randrange(10 ** 9)), f'Товар {i}']
+
+
+def impressions_rows(n, seed=0):
+    yield bench_impressions_ingest.HEADERS
+    yield from bench_impressions_ingest.synthetic_rows(n, seed)
+
+
+def boost_rows(n, seed=0, period_days=7):
+    yield bench_sales_boost_ingest.HEADERS
+    yield from bench_sales_boost_ingest.synthetic_report(n, period_days, seed)
+
+
+# kind -> (file_group of the upload, rows(n, seed) with the header first)
+KINDS = {'price': ('price', lambda n, seed: offer_value_rows(n, 'price', seed)),
+         'margin': ('margin', lambda n, seed: offer_value_rows(n, 'margin', seed)),
+         'mapping': ('offers_mapping_table', mapping_rows),
+         'impressions': ('yandex_impressions_and_sales', impressions_rows),
+         'boost': ('yandex_sales_boost', boost_rows)}
+
+
+def write_rows(file_path, rows):
+    """Write rows (header first) to a .csv or .xlsx file."""
+    if file_path.endswith('.csv'):
+        with open(file_path, 'w', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(rows)
+        return
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    for row in rows:
+        sheet.append(row)
+    workbook.save(file_path)
+
+
+def make_workbook(kind, n, file_format='xlsx', variant=0, dir_path=DATA_DIR):
+    """Return path of the kind workbook with n rows, writing it if it doesn't exist."""
+    os.makedirs(dir_path, exist_ok=True)
+    file_path = os.path.join(dir_path, f'{kind}_{n}_v{variant}.{file_format}')
+    if not os.path.exists(file_path):
+        # Written under a temp name, so a run interrupted while writing leaves no broken file
+        temp_path = f'{file_path}.{os.getpid()}.tmp.{file_format}'
+        write_rows(temp_path, KINDS[kind][1](n, variant))
+        os.replace(temp_path, file_path)
+    return file_path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--kinds', nargs='+', choices=list(KINDS), default=list(KINDS))
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 100000])
+    parser.add_argument('--format', choices=['xlsx', 'csv'], default='xlsx')
+    parser.add_argument('--variants', type=int, default=1)
+    parser.add_argument('--out', default=DATA_DIR)
+    args = parser.parse_args()
+    for kind in args.kinds:
+        for n in args.rows:
+            for variant in range(args.variants):
+                file_path = make_workbook(kind, n, args.format, variant, args.out)
+                print(f"{file_path} {os.path.getsize(file_path) / 1024 ** 2:.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Encoder of PostgreSQL binary COPY format from NumPy column arrays.
+
+Each batch is one complete COPY stream: header, tuples, trailer. A tuple is the
+int16 number of fields, then for every field its int32 length (-1 for NULL) and
+its value in network byte order. Values of a column are converted to a typed
+array once, and fields are written into the output buffer with array indexing,
+without per-row Python formatting."""
+import struct
+import numpy as np
+
+HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+TRAILER = struct.pack('!h', -1)
+PG_EPOCH_DATE = np.datetime64('2000-01-01', 'D')
+PG_EPOCH_TIMESTAMP = np.datetime64('2000-01-01T00:00:00', 'us')
+
+# information_schema.columns.data_type -> big-endian dtype of the binary value
+FIXED_TYPES = {'smallint': '>i2', 'integer': '>i4', 'bigint': '>i8',
+               'real': '>f4', 'double precision': '>f8',
+               'date': '>i4', 'timestamp without time zone': '>i8'}
+TEXT_TYPES = {'text', 'character varying', 'character'}
+
+
+def is_supported(pg_types):
+    return all(pg_type in FIXED_TYPES or pg_type in TEXT_TYPES for pg_type in pg_types)
+
+
+def get_column_types(cursor, table_name, columns):
+    """Return data_type of columns of table_name from information_schema (None for unknown columns)."""
+    cursor.execute("""SELECT column_name, data_type
+                        FROM information_schema.columns
+                       WHERE table_name = %s;""", (table_name,))
+    types = dict(cursor.fetchall())
+    return [types.get(column) for column in columns]
+
+
+def _to_integers(values):
+    try:
+        integers = values.astype(np.int64)
+    except (ValueError, TypeError):
+        integers = None
+    else:
+        # astype truncates floats: 1.5 would be written as 1
+        if np.all(integers == values):
+            return integers
+    floats = values.astype(np.float64)
+    if not np.all(np.mod(floats, 1) == 0):
+        raise ValueError("Not integer values in an integer column")
+    return floats.astype(np.int64) if integers is None else integers
+
+
+def to_column_array(values, pg_type):
+    """Convert a column of Python values to (array of binary values, null mask, byte lengths).
+    Fixed size values are a big-endian array, text values are one uint8 array of utf-8 bytes.
+    Raise ValueError (or TypeError) if a value can't be converted to pg_type."""
+    values = np.array(values, dtype=object)
+    nulls = np.equal(values, None)
+    if pg_type in TEXT_TYPES:
+        strings = values[~nulls].tolist()
+        try:
+            joined = '\x00'.join(strings)
+        except TypeError:
+            joined = '\x00'.join(map(str, strings))
+        # Encode all values at once; text can't contain NUL, so NUL bytes split the values
+        data = np.frombuffer(joined.encode('utf-8'), dtype=np.uint8)
+        separators = np.flatnonzero(data == 0)
+        lengths = np.zeros(len(values), dtype=np.int64)
+        if strings:
+            ends = np.append(separators, len(data))
+            lengths[~nulls] = ends - np.concatenate(([0], separators + 1))
+            data = data[data != 0]
+        return data, nulls, lengths
+    dtype = np.dtype(FIXED_TYPES[pg_type])
+    if pg_type == 'date':
+        days = np.where(nulls, PG_EPOCH_DATE, values).astype('datetime64[D]')
+        data = (days - PG_EPOCH_DATE).astype(np.int64)
+    elif pg_type == 'timestamp without time zone':
+        moments = np.where(nulls, PG_EPOCH_TIMESTAMP, values).astype('datetime64[us]')
+        data = (moments - PG_EPOCH_TIMESTAMP).astype(np.int64)
+    elif dtype.kind == 'i':
+        data = _to_integers(np.where(nulls, 0, values))
+        limits = np.iinfo(dtype)
+        if data.size and (data.min() < limits.min or data.max() > limits.max):
+            raise ValueError(f"Value out of {pg_type} range")
+    else:
+        data = np.where(nulls, 0, values).astype(np.float64)
+    lengths = np.where(nulls, 0, dtype.itemsize)
+    return data.astype(dtype), nulls, lengths
+
+
+def encode_columns(columns, pg_types):
+    """Encode one COPY stream (bytes) from a list of column value lists of equal length."""
+    n_rows = len(columns[0]) if columns else 0
+    arrays = [to_column_array(values, pg_type) for values, pg_type in zip(columns, pg_types)]
+    # 2 bytes of field count, 4 bytes of length per field, then the values
+    row_sizes = 2 + 4 * len(arrays) + sum(lengths for _, _, lengths in arrays)
+    row_starts = len(HEADER) + np.concatenate(([0], np.cumsum(row_sizes)[:-1])).astype(np.int64)
+    out = np.zeros(len(HEADER) + int(np.sum(row_sizes)) + len(TRAILER), dtype=np.uint8)
+    out[:len(HEADER)] = np.frombuffer(HEADER, dtype=np.uint8)
+    out[-len(TRAILER):] = np.frombuffer(TRAILER, dtype=np.uint8)
+    if not n_rows:
+        return out.tobytes()
+    field_count = np.frombuffer(struct.pack('!h', len(arrays)), dtype=np.uint8)
+    out[row_starts[:, None] + np.arange(2)] = field_count
+    positions = row_starts + 2
+    for data, nulls, lengths in arrays:
+        if data.dtype != np.uint8 and not nulls.any():
+            # Length and value as one record, written with a single scatter
+            fields = np.empty(len(data), dtype=[('length', '>i4'), ('value', data.dtype)])
+            fields['length'] = data.dtype.itemsize
+            fields['value'] = data
+            width = fields.dtype.itemsize
+            out[positions[:, None] + np.arange(width)] = fields.view(np.uint8).reshape(-1, width)
+            positions = positions + width
+            continue
+        length_bytes = np.where(nulls, -1, lengths).astype('>i4').view(np.uint8).reshape(-1, 4)
+        out[positions[:, None] + np.arange(4)] = length_bytes
+        value_starts = positions[~nulls] + 4
+        if data.dtype == np.uint8:  # text
+            value_lengths = lengths[~nulls]
+            source_starts = np.concatenate(([0], np.cumsum(value_lengths)[:-1])).astype(np.int64)
+            out[np.repeat(value_starts - source_starts, value_lengths) + np.arange(len(data))] = data
+        else:
+            width = data.dtype.itemsize
+            value_bytes = data.view(np.uint8).reshape(-1, width)[~nulls]
+            out[value_starts[:, None] + np.arange(width)] = value_bytes
+        positions = positions + 4 + lengths
+    return out.tobytes()
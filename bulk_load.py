@@ -0,0 +1,223 @@
+import os
+import csv
+import time
+import threading
+from io import StringIO, BytesIO
+from itertools import islice
+import my_logger
+import binary_copy
+from postgres import sqlalch_db_conn_str, connection_args
+
+# Rows sent to Postgres with one COPY statement
+COPY_BATCH_SIZE = int(os.getenv('COPY_BATCH_SIZE', 50000))
+# Connections of the bulk load engine (per process); loads are rare and long, so few are needed
+BULK_LOAD_POOL_SIZE = int(os.getenv('BULK_LOAD_POOL_SIZE', 2))
+BULK_LOAD_MAX_OVERFLOW = int(os.getenv('BULK_LOAD_MAX_OVERFLOW', 2))
+# Tables loaded with binary COPY by default, e.g. 'data_analytics_bydays_main'
+COPY_BINARY_TABLES = {table for table in os.getenv('COPY_BINARY_TABLES', '').split(',') if table}
+
+logger = my_logger.init_logger("bulk_load")
+
+
+def iter_batches(rows, batch_size=COPY_BATCH_SIZE):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def copy_rows(cursor, table_name, columns, rows, batch_size=COPY_BATCH_SIZE, on_batch=None):
+    """COPY rows into table_name in batches of batch_size rows.
+    Only one batch is held in memory (as a CSV buffer) at a time.
+    on_batch(rows_loaded) is called after every batch.
+    Return (rows_loaded, bytes_sent)."""
+    sql = 'COPY {} ({}) FROM STDIN WITH CSV'.format(
+        table_name, ', '.join(['"{}"'.format(column) for column in columns]))
+    rows_loaded = 0
+    bytes_sent = 0
+    s_buf = StringIO()
+    writer = csv.writer(s_buf)
+    for batch in iter_batches(rows, batch_size):
+        s_buf.seek(0)
+        s_buf.truncate()
+        writer.writerows(batch)
+        bytes_sent += s_buf.tell()  # size of CSV text, close to bytes on the wire
+        s_buf.seek(0)
+        cursor.copy_expert(sql=sql, file=s_buf)
+        rows_loaded += len(batch)
+        if on_batch:
+            on_batch(rows_loaded)
+    return rows_loaded, bytes_sent
+
+
+def copy_rows_binary(cursor, table_name, columns, rows, pg_types, batch_size=COPY_BATCH_SIZE, on_batch=None):
+    """Same as copy_rows, but batches are sent in PostgreSQL binary format,
+    encoded from NumPy arrays (see binary_copy). pg_types are data types of columns.
+    A batch with values that can't be converted is sent as CSV, so the server reports the bad value.
+    Return (rows_loaded, bytes_sent)."""
+    sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT binary)'.format(
+        table_name, ', '.join(['"{}"'.format(column) for column in columns]))
+    rows_loaded = 0
+    bytes_sent = 0
+    for batch in iter_batches(rows, batch_size):
+        try:
+            data = binary_copy.encode_columns(list(zip(*batch)), pg_types)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Batch of {table_name} can't be encoded in binary format ({e!r}), sending CSV.")
+            bytes_sent += copy_rows(cursor, table_name, columns, batch, batch_size)[1]
+        else:
+            cursor.copy_expert(sql=sql, file=BytesIO(data))
+            bytes_sent += len(data)
+        rows_loaded += len(batch)
+        if on_batch:
+            on_batch(rows_loaded)
+    return rows_loaded, bytes_sent
+
+
+def create_staging_table(cursor, table_name, columns):
+    """Create a temp table with the given columns of table_name (same types) and
+    a staging_row_num column that keeps load order. It is dropped on commit.
+    Return its name."""
+    staging_name = f'{table_name}_staging'
+    cursor.execute('CREATE TEMP TABLE {} ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA;'.format(
+        staging_name, ', '.join(['"{}"'.format(column) for column in columns]), table_name))
+    cursor.execute(f'ALTER TABLE {staging_name} ADD COLUMN staging_row_num BIGSERIAL;')
+    return staging_name
+
+
+def lock_staged_keys(cursor, staging_name, table_name, column):
+    """Take transaction-level advisory locks on (table_name, value) for every value of column
+    in the staged rows (in the same order in all sessions, so they don't deadlock).
+    Concurrent merges of rows with these values wait until this transaction ends: without it
+    they would both see the key missing and insert it."""
+    cursor.execute(f"""SELECT pg_advisory_xact_lock(hashtext(%s), hashtext(coalesce(value::text, '')))
+                         FROM (SELECT DISTINCT "{column}" AS value
+                                 FROM {staging_name}
+                                ORDER BY 1) staged;""", (table_name,))
+
+
+def merge_staging_table(cursor, staging_name, table_name, key_columns, columns, nullable_key_columns=()):
+    """Replace rows of table_name that have the same key_columns as staged rows
+    with the staged rows. If a key is staged several times the last loaded row wins.
+    Only the staged keys are touched (through the index on key_columns), so cost
+    depends on the batch, not on the table. NULLs in nullable_key_columns match each other.
+    Merges of the same first key column values (api_id) are serialized, see lock_staged_keys.
+    Return (rows_deleted, rows_inserted)."""
+    lock_staged_keys(cursor, staging_name, table_name, key_columns[0])
+    # Temp tables are never analyzed by autovacuum, without stats the planner may scan table_name
+    cursor.execute(f'ANALYZE {staging_name};')
+    key_condition = ' AND '.join(
+        ['(t."{0}" = s."{0}" OR (t."{0}" IS NULL AND s."{0}" IS NULL))'.format(column)
+         if column in nullable_key_columns else 't."{0}" = s."{0}"'.format(column)
+         for column in key_columns])
+    cursor.execute(f'DELETE FROM {table_name} t USING {staging_name} s WHERE {key_condition};')
+    rows_deleted = cursor.rowcount
+    column_list = ', '.join(['"{}"'.format(column) for column in columns])
+    key_list = ', '.join(['"{}"'.format(column) for column in key_columns])
+    cursor.execute(f"""INSERT INTO {table_name} ({column_list})
+                       SELECT {column_list}
+                         FROM (SELECT DISTINCT ON ({key_list}) *
+                                 FROM {staging_name}
+                                ORDER BY {key_list}, staging_row_num DESC) s;""")
+    return rows_deleted, cursor.rowcount
+
+
+def update_from_staging_table(cursor, staging_name, table_name, key_columns, columns, nullable_key_columns=()):
+    """Like merge_staging_table, but rows of table_name with a staged key keep their other
+    columns: only the staged columns are updated, rows with new keys are inserted.
+    For reports that fill some of the columns of rows loaded from other reports.
+    Serialized with merges of the same first key column values, see lock_staged_keys: the
+    unique index does not stop concurrent inserts of keys with NULLs (e.g. region_id).
+    Return (rows_updated, rows_inserted)."""
+    lock_staged_keys(cursor, staging_name, table_name, key_columns[0])
+    cursor.execute(f'ANALYZE {staging_name};')
+    key_condition = ' AND '.join(
+        ['(t."{0}" = s."{0}" OR (t."{0}" IS NULL AND s."{0}" IS NULL))'.format(column)
+         if column in nullable_key_columns else 't."{0}" = s."{0}"'.format(column)
+         for column in key_columns])
+    column_list = ', '.join(['"{}"'.format(column) for column in columns])
+    key_list = ', '.join(['"{}"'.format(column) for column in key_columns])
+    staged = f"""(SELECT DISTINCT ON ({key_list}) *
+                    FROM {staging_name}
+                   ORDER BY {key_list}, staging_row_num DESC) s"""
+    assignments = ', '.join(['"{0}" = s."{0}"'.format(column) for column in columns if column not in key_columns])
+    cursor.execute(f'UPDATE {table_name} t SET {assignments} FROM {staged} WHERE {key_condition};')
+    rows_updated = cursor.rowcount
+    cursor.execute(f"""INSERT INTO {table_name} ({column_list})
+                       SELECT {column_list}
+                         FROM {staged}
+                        WHERE NOT EXISTS (SELECT 1 FROM {table_name} t WHERE {key_condition});""")
+    return rows_updated, cursor.rowcount
+
+
+class BulkLoader:
+    """Loads rows into a table with COPY through a staging table and replaces rows with
+    the same key, all in one transaction on one connection of a pooled engine.
+    A failure at any point rolls everything back, nothing is half-loaded."""
+
+    def __init__(self, db_url=sqlalch_db_conn_str, pool_size=BULK_LOAD_POOL_SIZE,
+                 max_overflow=BULK_LOAD_MAX_OVERFLOW):
+        from sqlalchemy import create_engine
+        self.pid = os.getpid()
+        self.engine = create_engine(db_url, connect_args=connection_args, pool_size=pool_size,
+                                    max_overflow=max_overflow, pool_pre_ping=True)
+
+    def load(self, table_name, columns, rows, key_columns, nullable_key_columns=(),
+             batch_size=COPY_BATCH_SIZE, on_batch=None, copy_format=None, merge='replace'):
+        """COPY rows (tuples in columns order) into table_name, replacing rows with the same key_columns
+        (merge='replace') or updating their loaded columns (merge='update').
+        copy_format is 'csv' or 'binary', by default 'binary' for COPY_BINARY_TABLES.
+        Return stats dict: rows_loaded, bytes_sent, rows_deleted, rows_updated, rows_inserted,
+        elapsed, copy_elapsed, merge_elapsed (seconds), copy_format."""
+        start = time.perf_counter()
+        copy_format = copy_format or ('binary' if table_name in COPY_BINARY_TABLES else 'csv')
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            staging_name = create_staging_table(cursor, table_name, columns)
+            pg_types = None
+            if copy_format == 'binary':
+                pg_types = binary_copy.get_column_types(cursor, table_name, columns)
+                if not binary_copy.is_supported(pg_types):
+                    logger.warning(f"{table_name} has column types {pg_types} without binary encoder, "
+                                   f"loading CSV.")
+                    copy_format = 'csv'
+            copy_start = time.perf_counter()
+            if copy_format == 'binary':
+                rows_loaded, bytes_sent = copy_rows_binary(cursor, staging_name, columns, rows, pg_types,
+                                                           batch_size, on_batch)
+            else:
+                rows_loaded, bytes_sent = copy_rows(cursor, staging_name, columns, rows, batch_size, on_batch)
+            merge_start = time.perf_counter()
+            rows_deleted = rows_updated = 0
+            if merge == 'update':
+                rows_updated, rows_inserted = update_from_staging_table(cursor, staging_name, table_name,
+                                                                        key_columns, columns, nullable_key_columns)
+            else:
+                rows_deleted, rows_inserted = merge_staging_table(cursor, staging_name, table_name, key_columns,
+                                                                  columns, nullable_key_columns)
+            connection.commit()
+            merge_end = time.perf_counter()
+            cursor.close()
+        finally:
+            # Returns the connection to the engine pool, which rolls back an unfinished transaction
+            connection.close()
+        return {'rows_loaded': rows_loaded, 'bytes_sent': bytes_sent, 'rows_deleted': rows_deleted,
+                'rows_updated': rows_updated, 'rows_inserted': rows_inserted,
+                'elapsed': round(time.perf_counter() - start, 3), 'copy_elapsed': round(merge_start - copy_start, 3),
+                'merge_elapsed': round(merge_end - merge_start, 3), 'copy_format': copy_format}
+
+
+_loader = None
+_loader_lock = threading.Lock()
+
+
+def get_bulk_loader():
+    """Return the process-wide loader, creating it (and its engine) on first use after fork."""
+    global _loader
+    with _loader_lock:
+        if _loader is None or _loader.pid != os.getpid():
+            _loader = BulkLoader()
+        return _loader
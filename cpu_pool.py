@@ -0,0 +1,80 @@
+"""Process pool for CPU-bound work of request and job threads.
+
+With gthread or gevent workers (see gunicorn.conf.py) the requests of a worker share one
+GIL: converting a big report or validating a workbook in a request thread would stall
+every other request of the worker. run() sends such work to processes of the worker's
+pool and waits for the result, so the thread only waits, like it waits for the upstream
+or the database. Processes are started by forkserver, forking a worker with running
+threads could copy locks they hold.
+
+Background jobs (see jobs.py) have their own pool: a long job never holds the processes
+that request threads wait for, and its processes have a lower CPU priority."""
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import my_logger
+
+# Processes of the pool of one gunicorn worker; 0 runs the work in the calling thread (sync workers)
+CPU_POOL_WORKERS = int(os.getenv('CPU_POOL_WORKERS', 0))
+# Processes for background jobs of one gunicorn worker; 0 runs jobs in the job threads
+JOBS_POOL_WORKERS = int(os.getenv('JOBS_POOL_WORKERS', 0))
+# Niceness added to job processes, so request work gets the CPU first when both are busy
+JOBS_POOL_NICE = int(os.getenv('JOBS_POOL_NICE', 10))
+
+logger = my_logger.init_logger("cpu_pool")
+
+POOL_WORKERS = {'requests': CPU_POOL_WORKERS, 'jobs': JOBS_POOL_WORKERS}
+POOL_NICE = {'requests': 0, 'jobs': JOBS_POOL_NICE}
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+
+
+def get_cpu_pool(name='requests'):
+    """Return the process-wide pool name ('requests' or 'jobs'), creating it on first use after fork.
+    None if the pool has 0 workers."""
+    global _pools_pid
+    if not POOL_WORKERS[name]:
+        return None
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        if name not in _pools:
+            _pools[name] = ProcessPoolExecutor(POOL_WORKERS[name], mp_context=multiprocessing.get_context('forkserver'),
+                                               initializer=os.nice, initargs=(POOL_NICE[name],))
+        return _pools[name]
+
+
+def _discard(name, pool):
+    with _pools_lock:
+        if _pools.get(name) is pool:
+            del _pools[name]
+    pool.shutdown(wait=False)
+
+
+def run(fn, *args, **kwargs):
+    """Return fn(*args, **kwargs) computed in the requests pool, or in this thread without the pool.
+    fn, arguments, result and exceptions are pickled: fn must be a module-level function."""
+    return _run('requests', fn, args, kwargs)
+
+
+def run_job(fn, *args, **kwargs):
+    """Same as run, in the jobs pool."""
+    return _run('jobs', fn, args, kwargs)
+
+
+def _run(name, fn, args, kwargs):
+    pool = get_cpu_pool(name)
+    if pool is None:
+        return fn(*args, **kwargs)
+    try:
+        return pool.submit(fn, *args, **kwargs).result()
+    except BrokenProcessPool as e:
+        # A process died (e.g. killed for memory), the pool can't run anything anymore
+        logger.error(f"CPU pool {name} is broken, it is replaced: {e!r}")
+        _discard(name, pool)
+        raise
@@ -1,171 +1,269 @@
+"""Stages of file_group processors, see processors.py.
+
+readers:    (file_path, processor, context) -> validated data
+transforms: (data, processor, context) -> payload for the sink
+sinks:      (payload, processor, context) -> stats dict or None
+
+context holds file_path, client_id, api_id, sha256 and progress (a callback or None)."""
 import os
-import pandas as pd
+from datetime import date, datetime
 import requests
 import my_logger
+import metrics
+import parse_cache
 from flask import abort
-from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError
-from postgres import sqlalch_db_conn_str, connection_args, psql_insert_copy, DB, db_connection_string
+from werkzeug.exceptions import HTTPException
+from file_readers import iter_rows, read_frame
+from file_storage import file_sha256
+from http_client import get_http_client
+from bulk_load import get_bulk_loader
+from validation import check_frame, check_file_headers, iter_checked_rows, abort_with_errors
 
 logger = my_logger.init_logger("file_handling_methods")
 
 
-def upload_prices(file_path, api_id, **kwargs):
-    if os.path.splitext(file_path)[1] == '.csv':
-        df = pd.read_csv(file_path)
-    else:  # .xlsx or .xls
-        df = pd.read_excel(file_path)
-    print(df)
-    expected_headers = ['offer_id', 'price']
-    if not (list(df.columns) == expected_headers):
-        logger.warning("400 Bad file structure")
-        abort(400, description="Bad file structure.")
-    offer_ids = df['offer_id'].tolist()
-    try:
-        prices = df['price'].astype(float).tolist()
-    except ValueError:
-        logger.warning("400 Bad file structure")
-        abort(400, description="Bad file structure.")
+def report_progress(context, percent):
+    """Report job progress if the processor runs as a background job."""
+    progress = context.get('progress')
+    if progress:
+        progress(percent)
 
-    data = {"api_id": api_id,
-            "offer_id": offer_ids,
-            "price": prices}
-    url = ""
-    try:
-        response = requests.post(url, json=data)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        logger.warning(repr(e))
-        abort(502, description=repr(e))
+
+def read_checked_frame(file_path, processor, context):
+    """Read the whole file into a DataFrame and validate it against processor.schema."""
+    with metrics.STAGE_SECONDS.labels(processor.file_group, 'parse').time():
+        df = read_frame(file_path)
+    report_progress(context, 30)
+    with metrics.STAGE_SECONDS.labels(processor.file_group, 'validate').time():
+        return check_frame(df, processor.schema, os.path.basename(file_path))
+
+
+def read_offer_values(file_path, processor, context):
+    """Read and validate a file with 'offer_id' and processor.schema columns
+    (schema name is also the value column name). Return dict of the two columns as lists.
+    Results are cached by file content hash, so re-uploads of the same file skip parsing."""
+    value_column = processor.schema
+    cache_key = f"{value_column}-{context.get('sha256') or file_sha256(file_path)}"
+    cached = parse_cache.get(cache_key)
+    if cached is None:
+        df = read_checked_frame(file_path, processor, context)
+        cached = {'offer_id': df['offer_id'].tolist(), value_column: df[value_column].tolist()}
+        parse_cache.put(cache_key, cached)
+    else:
+        logger.info(f"Parse cache hit for {os.path.basename(file_path)}.")
+    report_progress(context, 30)
+    return cached
+
+
+def read_checked_rows(file_path, processor, context):
+    """Stream rows of the file. Return (headers, rows); the header is checked here,
+    values are checked batch by batch while rows are consumed."""
+    rows = iter_rows(file_path)
+    headers = list(next(rows, ()))
+    filename = os.path.basename(file_path)
+    check_file_headers(headers, processor.schema, filename)
+    return headers, iter_checked_rows(rows, headers, processor.schema, filename)
+
+
+def read_report_rows(file_path, processor, context):
+    """Stream rows of a report that ends with a summary row: the last row if its
+    processor.options['id_header'] cell is empty. Return (headers, rows, summary);
+    rows are checked like in read_checked_rows, summary is a list that gets
+    the summary row once rows are consumed."""
+    rows = iter_rows(file_path)
+    headers = list(next(rows, ()))
     filename = os.path.basename(file_path)
-    return {"message": f"Client file: {filename} is successfully saved and prices are uploaded."}
-
-
-def upload_min_margin(file_path, api_id, **kwargs):
-    if os.path.splitext(file_path)[1] == '.csv':
-        df = pd.read_csv(file_path)
-    else:  # .xlsx or .xls
-        df = pd.read_excel(file_path)
-    print(df)
-    expected_headers = ['offer_id', 'margin']
-    if not (list(df.columns) == expected_headers):
-        logger.warning("400 Bad file structure")
-        abort(400, description="Bad file structure.")
-    offer_ids = df['offer_id'].tolist()
+    check_file_headers(headers, processor.schema, filename)
+    summary = []
+    data_rows = _hold_summary_row(rows, headers.index(processor.options['id_header']), summary)
+    return headers, iter_checked_rows(data_rows, headers, processor.schema, filename), summary
+
+
+def _hold_summary_row(rows, id_index, summary):
+    previous = None
+    for row in rows:
+        if previous is not None:
+            yield previous
+        previous = row
+    if previous is None:
+        return
+    if id_index < len(previous) and previous[id_index] is not None:
+        yield previous
+    else:
+        summary.append(previous)
+
+
+def offer_values_payload(data, processor, context):
+    return {"api_id": context['api_id'],
+            "offer_id": data['offer_id'],
+            processor.options['value_key']: data[processor.schema]}
+
+
+def offers_mapping_payload(df, processor, context):
+    return {'client_id': context['client_id'],
+            'mappings': df.to_dict('list')}
+
+
+def map_columns(data, processor, context):
+    """Pick and rename columns of streamed rows by processor.options['columns']
+    (file header -> table column) and add api_id. Return (columns, rows)."""
+    headers, rows = data
+    new_headers = processor.options['columns']
+    indexes = [headers.index(header) for header in new_headers]
+    columns = list(new_headers.values()) + ['api_id']
+    api_id = context['api_id']
+    report_progress(context, 10)
+    return columns, (tuple(row[i] for i in indexes) + (api_id,) for row in rows)
+
+
+def _to_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    value = str(value).strip()
     try:
-        margin = df['margin'].astype(float).tolist()
+        return date.fromisoformat(value[:10])
     except ValueError:
-        logger.warning("400 Bad file structure")
-        abort(400, description="Bad file structure.")
+        return datetime.strptime(value, '%d.%m.%Y').date()
+
+
+def _to_units(value, scale):
+    """Value as an integer number of 1/scale units (kopecks for scale 100), None for empty cells."""
+    if value is None:
+        return None
+    return round(float(value) * scale)
+
+
+def _split_units(units, days, scale):
+    """Split units evenly between days, the remainder goes one unit a day to the first days."""
+    share, remainder = divmod(units, days)
+    daily = [share + 1] * remainder + [share] * (days - remainder)
+    return daily if scale == 1 else [value / scale for value in daily]
+
+
+def expand_periods(data, processor, context):
+    """Turn rows of a period report (see read_report_rows) into daily rows.
+    Columns are picked and renamed by processor.options['columns']. A row of a period of
+    N days (processor.options['period_headers']) becomes N rows with a 'date' column;
+    metric columns (processor.options['metrics'], column -> decimals) are split evenly
+    between the days, rounded to the decimals, the remainder goes to the first days,
+    so daily values add up to the row's value. Key columns the report doesn't have
+    are NULL, api_id is added. Once rows are consumed their metric totals are compared
+    with the summary row, and a mismatch aborts with 400 (before the load is committed).
+    Return (columns, rows)."""
+    headers, rows, summary = data
+    columns = processor.options['columns']
+    metrics = processor.options['metrics']
+    filename = os.path.basename(context['file_path'])
+    start_index, end_index = [headers.index(header) for header in processor.options['period_headers']]
+    indexes = [headers.index(header) for header in columns]
+    names = list(columns.values())
+    scales = [10 ** metrics[name] if name in metrics else None for name in names]
+    missing_keys = [column for column in processor.options['key_columns']
+                    if column not in names and column not in ('date', 'api_id')]
+    tail = (None,) * len(missing_keys) + (context['api_id'],)
+    report_progress(context, 10)
+    dates = {}
+
+    def parse_date(value):
+        parsed = dates.get(value)
+        if parsed is None:
+            parsed = dates[value] = _to_date(value)
+        return parsed
+
+    def daily_rows():
+        totals = [0] * len(names)
+        row_number = 1
+        for row in rows:
+            row_number += 1
+            try:
+                start, end = parse_date(row[start_index]), parse_date(row[end_index])
+            except ValueError as e:
+                abort_with_errors([{'row': row_number, 'column': None, 'value': None, 'error': str(e)}], 1, filename)
+            days = (end - start).days + 1
+            if days < 1:
+                abort_with_errors([{'row': row_number, 'column': processor.options['period_headers'][1],
+                                    'value': str(row[end_index]), 'error': "period ends before it starts"}],
+                                  1, filename)
+            values = [row[i] if scale is None else _to_units(row[i], scale) for i, scale in zip(indexes, scales)]
+            for position, scale in enumerate(scales):
+                if scale is not None and values[position] is not None:
+                    totals[position] += values[position]
+            if days == 1:
+                yield tuple(value if scale is None or value is None or scale == 1 else value / scale
+                            for value, scale in zip(values, scales)) + (start,) + tail
+                continue
+            splits = [_split_units(value, days, scale) if scale is not None and value is not None else None
+                      for value, scale in zip(values, scales)]
+            for day in range(days):
+                yield tuple(value if split is None else split[day] for value, split in zip(values, splits)) \
+                    + (date.fromordinal(start.toordinal() + day),) + tail
+        _check_summary(summary, headers, columns, scales, totals, row_number - 1, filename)
+
+    return names + ['date'] + missing_keys + ['api_id'], daily_rows()
+
+
+def _check_summary(summary, headers, columns, scales, totals, rows_count, filename):
+    """Compare metric totals (in units) of rows_count report rows with the summary row.
+    Every row and the summary itself are rounded, so decimals may differ by half a unit per row."""
+    if not summary:
+        logger.warning(f"{filename} has no summary row, totals are not checked.")
+        return
+    errors = []
+    for (header, name), scale, total in zip(columns.items(), scales, totals):
+        index = headers.index(header)
+        value = summary[0][index] if index < len(summary[0]) else None
+        if scale is None or value is None:
+            continue
+        try:
+            expected = _to_units(value, scale)
+        except ValueError:
+            errors.append({'row': rows_count + 2, 'column': header, 'value': str(value), 'error': "not float"})
+            continue
+        tolerance = 0 if scale == 1 else (rows_count + 1) / 2
+        if abs(total - expected) > tolerance:
+            rows_sum = total if scale == 1 else total / scale
+            errors.append({'row': rows_count + 2, 'column': header, 'value': value,
+                           'error': f"summary differs from the sum of rows {rows_sum}"})
+    if errors:
+        abort_with_errors(errors, len(errors), filename)
 
-    data = {"api_id": api_id,
-            "offer_id": offer_ids,
-            "min_margin": margin}
-    url = ""
+
+def post_json(payload, processor, context):
+    """Send payload to processor.options['url']."""
+    report_progress(context, 60)
     try:
-        response = requests.post(url, json=data)
+        with metrics.STAGE_SECONDS.labels(processor.file_group, 'post').time():
+            response = get_http_client().post(processor.options['url'], json=payload)
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         logger.warning(repr(e))
         abort(502, description=repr(e))
-    filename = os.path.basename(file_path)
-    return {"message": f"Client file: {filename} is successfully saved and min margin are uploaded."}
-
-
-def upload_ya_impressions_and_sales(file_path, api_id, **kwargs):
-    if os.path.splitext(file_path)[1] == '.csv':
-        df = pd.read_csv(file_path)
-    else:  # .xlsx or .xls
-        df = pd.read_excel(file_path)
-    expected_headers = ['Название бизнес аккаунта', 'Тип бизнес аккаунта', 'ID бизнес аккаунта',
-                        'Магазин', 'ID магазина', 'День', 'Месяц', 'Год', 'ID округа',
-                        'Федеральный округ', 'ID бренда', 'Бренд', 'ID категории', 'Категория',
-                        'Ваш SKU', 'Название товара', 'Показы', 'Добавлено в корзину, шт.',
-                        'Конверсия добавления в корзину, %', 'Продажи, шт.',
-                        'Цена товара, руб.', 'Продажи, руб.']
-    if not (list(df.columns) == expected_headers):
-        logger.warning("400 Bad file structure")
-        abort(400, description="Bad file structure.")
-
-    new_headers = {'Ваш SKU': 'sku_id', 'Название товара': 'sku_name', 'День': 'date',
-                   'ID категории': 'category_id', 'Категория': 'category_name',
-                   'ID бренда': 'brand_id', 'Бренд': 'brand_name',
-                   'Показы': 'session_view', 'Добавлено в корзину, шт.': 'hits_tocart',
-                   'Конверсия добавления в корзину, %': 'conv_tocart', 'Продажи, шт.': 'delivered_units',
-                   'Продажи, руб.': 'revenue', 'ID округа': 'region_id', 'Федеральный округ': 'region_name'}
-    headers_list = list(new_headers.keys())
-    df = df[headers_list]
-    df.rename(columns=new_headers, inplace=True)
-    df['api_id'] = api_id
+
+
+def copy_to_table(payload, processor, context):
+    """COPY (columns, rows) into processor.options['table'] through a staging table,
+    replacing rows with the same processor.options['key_columns'], in one transaction.
+    Return load stats."""
+    columns, rows = payload
+    table_name = processor.options['table']
     try:
-        engine = create_engine(sqlalch_db_conn_str, connect_args=connection_args)
-        df.to_sql('data_analytics_bydays_main', engine, if_exists='append', method=psql_insert_copy, index=False)
-        logger.info(f"Yandex impressions and sales data for api_id {api_id} saved in db.")
+        stats = get_bulk_loader().load(table_name, columns, rows, processor.options['key_columns'],
+                                       processor.options.get('nullable_key_columns', ()),
+                                       copy_format=processor.options.get('copy_format'),
+                                       merge=processor.options.get('merge', 'replace'))
+    except HTTPException:
+        raise
     except (Exception, SQLAlchemyError) as e:
         logger.error(repr(e))
-    with DB(db_connection_string) as db:
-        db.delete_duplicates_from_data_analytics_bydays_main_table()
-
-
-def upload_yandex_sales_boost(file_path, api_id, **kwargs):
-    if os.path.splitext(file_path)[1] == '.csv':
-        df = pd.read_csv(file_path)
-    else:  # .xlsx or .xls
-        df = pd.read_excel(file_path)
-    expected_headers = ['Название бизнес аккаунта', 'Тип бизнес аккаунта', 'ID бизнес аккаунта',
-                        'Магазин', 'ID магазина', 'Начало периода', 'Конец периода', 'Ваш SKU',
-                        'Наименование предложения', 'Продано с помощью продвижения, шт',
-                        'Продано с помощью продвижения, рубли', 'Расход на продвижение, рубли',
-                        'Расход на продвижение, %', 'Средняя стоимость продвижения',
-                        'Продано всего, шт', 'Продано всего, рубли', 'Количество, шт',
-                        'Доля продаж у партнера', 'Клики по товарам со ставками, шт.',
-                        'Все клики, шт.', 'Заказано товаров со ставками, шт.',
-                        'Всего заказано товаров, шт.']
-    if not (list(df.columns) == expected_headers):
-        logger.warning("400 Bad file structure")
-        abort(400, description="Bad file structure.")
-    print(df.head())
-    # Delete last row
-    df = df.iloc[:-1]
-    new_headers = {'Ваш SKU': 'sku_id', 'Наименование предложения': 'sku_name', 'День': 'date',
-                   'Клики по товарам со ставками, шт.': 'hits_view_search', 'Все клики, шт.': 'hits_view',
-                   'Продано всего, шт': 'delivered_units', 'Продано всего, рубли': 'revenue',
-                   'Всего заказано товаров, шт.': 'ordered_units', 'Расход на продвижение, рубли': 'adv_sum_all',
-                   'Заказано товаров со ставками, шт.': '', 'Продано с помощью продвижения, рубли': '',
-                   'Продано с помощью продвижения, шт': '',
-                   'ID округа': 'region_id', 'Федеральный округ': 'region_name'}
-    headers_list = list(new_headers.keys())
-    df = df[headers_list]
-    df.rename(columns=new_headers, inplace=True)
-    df['api_id'] = api_id
-
-
-def upload_offers_mapping_table(file_path, client_id, **kwargs):
-    if os.path.splitext(file_path)[1] == '.csv':
-        df = pd.read_csv(file_path)
-    else:  # .xlsx or .xls
-        df = pd.read_excel(file_path)
-    if df.isnull().values.any():
-        logger.warning("400 Bad file structure")
-        abort(400, description="Bad file structure.")
-    mappings = df.to_dict('list')
-    data = {'client_id': client_id,
-            'mappings': mappings}
-    url = ""
-    try:
-        response = requests.post(url, json=data)
-        response.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        logger.warning(repr(e))
-        abort(502, description=repr(e))
-    filename = os.path.basename(file_path)
-    return {"message": f"Client file: {filename} is successfully saved and offers mapping table are uploaded."}
-
-
-if __name__ == "__main__":
-    pass
-    # upload_ya_impressions_and_sales("impressions.xlsx", 1)
-    # upload_yandex_sales_boost("boost.xlsx")
-    # print(upload_prices('price.xlsx', 1))
-    # print(upload_min_margin('margin.xlsx', 1))
-    # print(upload_offers_mapping_table('price.xlsx', 1))
+        abort(500, description=f"Unable to save {processor.file_group} data in db.")
+    metrics.STAGE_SECONDS.labels(processor.file_group, 'copy').observe(stats['copy_elapsed'])
+    metrics.STAGE_SECONDS.labels(processor.file_group, 'merge').observe(stats['merge_elapsed'])
+    report_progress(context, 90)
+    logger.info(f"{processor.file_group} data for api_id {context['api_id']} saved in {table_name}: "
+                f"{stats['rows_loaded']} rows loaded ({stats['bytes_sent']} bytes) in {stats['elapsed']}s, "
+                f"{stats['rows_deleted']} old rows replaced, {stats['rows_updated']} rows updated, "
+                f"{stats['rows_inserted']} rows inserted.")
+    return stats
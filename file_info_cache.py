@@ -0,0 +1,146 @@
+import os
+import time
+import select
+import threading
+from collections import OrderedDict
+import psycopg2
+import my_logger
+from postgres import DB, db_connection_string, FILE_INFO_CHANNEL
+
+# Max number of file rows cached per process, 0 disables the cache
+FILE_INFO_CACHE_SIZE = int(os.getenv('FILE_INFO_CACHE_SIZE', 4096))
+# Seconds between reconnect attempts of the invalidation listener
+FILE_INFO_LISTEN_RETRY = float(os.getenv('FILE_INFO_LISTEN_RETRY', 5))
+CACHED_TABLES = {'client_files', 'client_report_files', 'file_templates'}
+
+logger = my_logger.init_logger("file_info_cache")
+
+
+class FileInfoCache:
+    """LRU cache of (table_name, file_id) -> file info row plus size and mtime of the file.
+
+    File rows never change once written, they are only deleted. Deletes are sent by
+    DB.delete_from_table on FILE_INFO_CHANNEL and received by a listener thread, so
+    all processes drop the row. While the listener is disconnected nothing is cached.
+    A hit is also checked against the file itself (one stat call, no DB round-trip)."""
+
+    def __init__(self, max_size=FILE_INFO_CACHE_SIZE, connection_string=db_connection_string):
+        self.max_size = max_size
+        self.connection_string = connection_string
+        self.pid = os.getpid()
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._listening = threading.Event()
+        self._generation = 0
+        self._stats = {'hits': 0, 'misses': 0}
+        if max_size > 0:
+            threading.Thread(target=self._listen, name='file-info-listener', daemon=True).start()
+
+    def get(self, table_name, file_id):
+        """Return dict with filename, file_path, sha256, creation_date, size and mtime or None."""
+        key = (table_name, str(file_id))
+        with self._lock:
+            file_info = self._items.get(key)
+            if file_info is not None:
+                self._items.move_to_end(key)
+            # Row read below is not cached if a delete arrives meanwhile
+            generation = self._generation
+        if file_info is not None and self._is_fresh(file_info):
+            self._count('hits')
+            return dict(file_info)
+        self._count('misses')
+        with DB(db_connection_string) as db:
+            file_info = db.get_file_info_from_table(table_name, file_id)
+        if not file_info:
+            # Not cached: the id may be taken later
+            return None
+        file_info = dict(file_info)
+        try:
+            stat = os.stat(file_info['file_path'])
+            file_info.update(size=stat.st_size, mtime=stat.st_mtime)
+        except OSError:
+            return file_info
+        with self._lock:
+            if self._listening.is_set() and generation == self._generation:
+                self._items[key] = file_info
+                self._items.move_to_end(key)
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+        return dict(file_info)
+
+    @staticmethod
+    def _is_fresh(file_info):
+        try:
+            stat = os.stat(file_info['file_path'])
+        except OSError:
+            return False
+        return stat.st_size == file_info['size'] and stat.st_mtime == file_info['mtime']
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def invalidate(self, table_name, file_id):
+        with self._lock:
+            self._items.pop((table_name, str(file_id)), None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._generation += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, size=len(self._items), max_size=self.max_size,
+                        listening=self._listening.is_set())
+
+    def _listen(self):
+        while self.pid == os.getpid():
+            connection = None
+            try:
+                connection = psycopg2.connect(self.connection_string)
+                connection.set_session(autocommit=True)
+                cursor = connection.cursor()
+                cursor.execute(f"LISTEN {FILE_INFO_CHANNEL};")
+                self._listening.set()
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        notify = connection.notifies.pop(0)
+                        table_name, _, file_id = notify.payload.partition(':')
+                        self.invalidate(table_name, file_id)
+            except (Exception, psycopg2.Error) as error:
+                logger.error(f"File info listener failed: {error!r}")
+            finally:
+                # Deletes may be missed until LISTEN is back
+                self._listening.clear()
+                self.clear()
+                if connection is not None:
+                    connection.close()
+            time.sleep(FILE_INFO_LISTEN_RETRY)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_file_info_cache():
+    """Return the process-wide cache, creating it (and its listener) on first use after fork."""
+    global _cache
+    with _cache_lock:
+        if _cache is None or _cache.pid != os.getpid():
+            _cache = FileInfoCache()
+        return _cache
+
+
+def get_file_info(table_name, file_id):
+    if table_name not in CACHED_TABLES:
+        raise ValueError(f"Table {table_name} is not cached")
+    return get_file_info_cache().get(table_name, file_id)
+
+
+def invalidate(table_name, file_id):
+    get_file_info_cache().invalidate(table_name, file_id)
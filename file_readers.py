@@ -0,0 +1,56 @@
+import os
+import csv
+
+
+def iter_rows(file_path):
+    """Lazily yield rows of the first sheet of xlsx/xls/csv file as tuples.
+    The first yielded row is the header. Trailing empty header cells and
+    fully empty rows are skipped."""
+    extension = os.path.splitext(file_path)[1].lower()
+    if extension == '.csv':
+        rows = _iter_csv_rows(file_path)
+    elif extension == '.xls':
+        rows = _iter_xls_rows(file_path)
+    else:  # .xlsx
+        rows = _iter_xlsx_rows(file_path)
+    header = next(rows, None)
+    if header is None:
+        return
+    while header and header[-1] is None:
+        header = header[:-1]
+    yield tuple(header)
+    for row in rows:
+        if any(value is not None for value in row):
+            yield row
+
+
+def read_frame(file_path):
+    """Read the first sheet of xlsx/xls/csv file into a DataFrame."""
+    import pandas as pd
+    if os.path.splitext(file_path)[1].lower() == '.csv':
+        return pd.read_csv(file_path)
+    return pd.read_excel(file_path)
+
+
+def _iter_csv_rows(file_path):
+    with open(file_path, newline='', encoding='utf-8-sig') as f:
+        for row in csv.reader(f):
+            yield tuple(value if value != '' else None for value in row)
+
+
+def _iter_xlsx_rows(file_path):
+    from openpyxl import load_workbook
+    # read_only mode parses the sheet xml as a stream instead of building the whole workbook
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        yield from workbook.worksheets[0].iter_rows(values_only=True)
+    finally:
+        workbook.close()
+
+
+def _iter_xls_rows(file_path):
+    # Legacy binary format can not be streamed, fall back to pandas
+    import pandas as pd
+    df = pd.read_excel(file_path, header=None, dtype=object)
+    df = df.where(df.notna(), None)
+    yield from df.itertuples(index=False, name=None)
@@ -0,0 +1,150 @@
+import os
+import uuid
+import hashlib
+import tempfile
+import my_logger
+from flask import abort
+from postgres import QUERY_FAILED
+
+# Max size of an uploaded file in bytes (default 1 GiB)
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', 1024 ** 3))
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE', 1024 * 1024))
+# Client files are stored once per content under their sha256
+BLOBS_FOLDER = os.getenv('BLOBS_FOLDER', './files_storage/blobs')
+
+logger = my_logger.init_logger("file_storage")
+
+
+def save_stream(stream, file_path, max_size=MAX_UPLOAD_SIZE, chunk_size=UPLOAD_CHUNK_SIZE, overwrite=True):
+    """Write stream to file_path in chunks and return (size, sha256 hexdigest).
+    Data goes to a temp file in the target dir, which is atomically renamed into
+    file_path once the whole body is received, so readers never see a partial file.
+    Nothing is written to file_path if the stream is empty (size 0 is returned).
+    With overwrite=False FileExistsError is raised if file_path exists (checked atomically)."""
+    dir_path = os.path.dirname(file_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.upload-', suffix='.part')
+    checksum = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    logger.warning(f"413 {os.path.basename(file_path)} exceeds {max_size} bytes.")
+                    abort(413, description=f"File is too large. Max size: {max_size} bytes.")
+                checksum.update(chunk)
+                f.write(chunk)
+        if size:
+            if overwrite:
+                os.replace(tmp_path, file_path)
+            else:
+                # link fails if file_path exists, unlike rename
+                os.link(tmp_path, file_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return size, checksum.hexdigest()
+
+
+def file_sha256(file_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    checksum = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            checksum.update(chunk)
+    return checksum.hexdigest()
+
+
+def allocate_file_path(dir_path, filename):
+    """Atomically create an empty file for filename in dir_path and return its path.
+    If the name is taken, a short random suffix is added: 'report.xlsx' --> 'report 3f9a1c2e.xlsx'.
+    Takes one or two open() calls, whatever the number of files with the same name,
+    and is safe across processes. Keep filename as the display name, the on-disk name may differ."""
+    os.makedirs(dir_path, exist_ok=True)
+    stem, extension = os.path.splitext(filename)
+    candidate = filename
+    while True:
+        file_path = os.path.join(dir_path, candidate)
+        try:
+            os.close(os.open(file_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            return file_path
+        except FileExistsError:
+            candidate = f"{stem} {uuid.uuid4().hex[:8]}{extension}"
+
+
+def blob_path(sha256, extension):
+    return os.path.join(BLOBS_FOLDER, sha256[:2], sha256 + extension)
+
+
+def is_blob_path(file_path):
+    return os.path.commonpath([os.path.abspath(file_path), os.path.abspath(BLOBS_FOLDER)]) == \
+        os.path.abspath(BLOBS_FOLDER)
+
+
+def receive_upload(stream, extension, max_size=MAX_UPLOAD_SIZE):
+    """Stream upload into the blob storage incoming dir.
+    Return (incoming_path, size, sha256); incoming_path is None for an empty body."""
+    incoming_dir = os.path.join(BLOBS_FOLDER, '.incoming')
+    os.makedirs(incoming_dir, exist_ok=True)
+    incoming_path = os.path.join(incoming_dir, uuid.uuid4().hex + extension)
+    size, sha256 = save_stream(stream, incoming_path, max_size=max_size)
+    return (incoming_path if size else None), size, sha256
+
+
+def store_blob(db, incoming_path, sha256, size, extension):
+    """Move received upload into content-addressed storage, or drop it if the
+    same bytes are already stored, and add a reference to the blob.
+    Return (file_path, is_new); file_path is None if the blob could not be registered.
+    The caller must commit db (e.g. by inserting the file info row)."""
+    file_path, is_new = db.acquire_file_blob(sha256, blob_path(sha256, extension), size)
+    if file_path is None:
+        os.remove(incoming_path)
+        return None, False
+    if is_new or not os.path.isfile(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        os.replace(incoming_path, file_path)
+    else:
+        os.remove(incoming_path)
+    return file_path, is_new
+
+
+def discard_blob(db, file_path, is_new):
+    """Undo store_blob when the file row could not be saved: remove the blob if this upload
+    added it and roll back the reference. Called before the transaction ends, while the blob
+    row is still locked, so a concurrent upload of the same bytes doesn't see a half-removed blob."""
+    if is_new and os.path.isfile(file_path):
+        os.remove(file_path)
+    try:
+        db.connection.rollback()
+    except Exception as error:
+        logger.error(repr(error))
+
+
+def delete_file(db, table_name, file_id):
+    """Delete the file row and drop its reference to its blob in one transaction, then remove
+    the file once nothing references it. The row is deleted first: of concurrent deletes of
+    the same file only the one that deleted it releases the blob.
+    Return True if the row was deleted, False if there was no row, None on error."""
+    file_info = db.delete_file_row(table_name, file_id)
+    orphan_path = None
+    is_blob = False
+    if file_info is not QUERY_FAILED and file_info:
+        is_blob = bool(file_info['sha256']) and is_blob_path(file_info['file_path'])
+        # Files saved before blob storage and generated reports are not shared
+        orphan_path = db.release_file_blob(file_info['sha256']) if is_blob else file_info['file_path']
+    try:
+        if file_info is QUERY_FAILED or orphan_path is QUERY_FAILED:
+            db.connection.rollback()
+            return None
+        db.connection.commit()
+    except Exception as error:
+        logger.error(repr(error))
+        return None
+    # Removed after commit: if the transaction failed the file is still referenced
+    if orphan_path and os.path.isfile(orphan_path):
+        os.remove(orphan_path)
+        if is_blob:
+            logger.info(f"Blob {file_info['sha256']} is not referenced anymore and was removed.")
+    return bool(file_info)
@@ -1,42 +1,75 @@
 import os
-import logging
-import pandas as pd
 import requests
 import json
-import file_handling_methods
-from flask import Flask, request, abort, send_file, jsonify, render_template, url_for
+import mimetypes
+import base64
+import time
+from datetime import date, datetime, timedelta
+from urllib.parse import quote
+import report_cache
+import my_logger
+from flask import Flask, request, abort, send_file, jsonify, render_template, url_for, make_response, Response, g
+from flask.logging import default_handler
 from werkzeug.utils import secure_filename
-from werkzeug.exceptions import HTTPException
-from postgres import DB, db_connection_string
-from pathlib import Path
+from werkzeug.exceptions import HTTPException, ServiceUnavailable
+from postgres import DB, db_connection_string, get_pool_stats, QUERY_FAILED, PoolTimeout
+from file_storage import save_stream, file_sha256, receive_upload, allocate_file_path, store_blob, discard_blob, \
+    delete_file, MAX_UPLOAD_SIZE
+from jobs import get_job_queue, QueueFull, JobNotSaved
+from processors import get_processor
+from file_info_cache import get_file_info, get_file_info_cache, invalidate as invalidate_file_info
+from http_client import get_http_client
+from report_writers import REPORT_FORMATS, write_xlsx
+from json_stream import save_body, write_result_report, write_results_xlsx, UnsupportedShape
+import cpu_pool
+import metrics
 from time import localtime, strftime
 from flask_cors import CORS
 
+STORAGE_FOLDER = './files_storage'
 FILES_FOLDER = './files_storage/client_report_files'
 TEMPLATES_FOLDER = './files_storage/file_templates'
-CLIENT_FILES_FOLDER = './files_storage/clients_files'
 ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv'}
 ALLOWED_METHODS = {'/graphs/cart_to_order_conversion', '/graphs/costs_cpo', '/graphs/costs_cpm_cpo',
                    '/graphs/impressions_to_cart_conversion', '/graphs/hits_view', '/graphs/org_traffic',
                    '/graphs/average_check', '/graphs/ddr', '/graphs/adv_view_all', '/graphs/costs_cpm',
                    '/graphs/full', '/graphs/impressions_to_order_conversion', '/graphs/share_of_paid_impressions',
                    '/graphs/adv_view_all_org_traffic', '/graphs/ordered', '/graphs/revenue', '/graphs/adv_sum_all'}
-FILE_GROUP_METHODS = {'price': 'upload_prices', 'margin': 'upload_min_margin',
-                      'yandex_impressions_and_sales': 'upload_ya_impressions_and_sales',
-                      'yandex_sales_boost': 'upload_yandex_sales_boost',
-                      'offers_mapping_table': 'upload_offers_mapping_table'}
+# Graph methods are requested at this base URL followed by the method path
+GRAPHS_API_URL = os.getenv('GRAPHS_API_URL', 'https://')
+# Max number of graph methods requested at the same time by /reports/batch
+REPORT_BATCH_CONCURRENCY = int(os.getenv('REPORT_BATCH_CONCURRENCY', 8))
+# Files lists are paginated, page size is set by the limit param
+FILES_LIST_DEFAULT_LIMIT = int(os.getenv('FILES_LIST_DEFAULT_LIMIT', 1000))
+FILES_LIST_MAX_LIMIT = int(os.getenv('FILES_LIST_MAX_LIMIT', 10000))
+# Internal nginx location serving STORAGE_FOLDER, e.g. '/protected_files/'.
+# If set, downloads are handed off to nginx with X-Accel-Redirect instead of being streamed by the worker.
+X_ACCEL_REDIRECT_PREFIX = os.getenv('X_ACCEL_REDIRECT_PREFIX', '')
 
 app = Flask(__name__)
 CORS(app)
 
-# Add file handler to app.logger
-fh = logging.FileHandler(filename='files_load_api.log')
-fh.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(module)s - %(funcName)s - %(message)s')
-fh.setFormatter(formatter)
-app.logger.addHandler(fh)
+# app.logger writes through the process log queue like the other modules, instead of Flask's stderr handler
+app.logger.removeHandler(default_handler)
+my_logger.init_logger(app.logger.name)
 
-app.logger.setLevel(logging.INFO)
+# Resume jobs abandoned by a previous run of this worker
+get_job_queue()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.REQUEST_SECONDS.labels(request.method, route, response.status_code).observe(
+            time.perf_counter() - started)
+    return response
 
 
 @app.errorhandler(HTTPException)
@@ -54,19 +87,166 @@ def handle_exception(e):
     return response
 
 
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    """All database connections of the worker are busy: 503, the client may retry."""
+    app.logger.warning(f"503 {e}")
+    return handle_exception(ServiceUnavailable("The server is busy, try again later."))
+
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def unique_file_path(path):
-    """Return path with new filename, if given file path already exists.
-    'already_existed_name.csv' --> 'already_existed_name (1).csv'"""
-    filename, extension = os.path.splitext(path)
-    counter = 1
-    while os.path.isfile(path):
-        path = filename + " (" + str(counter) + ")" + extension
-        counter += 1
-    return path
+def check_content_length():
+    """Reject request early if declared body size exceeds MAX_UPLOAD_SIZE."""
+    if request.content_length is not None and request.content_length > MAX_UPLOAD_SIZE:
+        app.logger.warning(f"413 Content-Length {request.content_length} exceeds {MAX_UPLOAD_SIZE} bytes.")
+        abort(413, description=f"File is too large. Max size: {MAX_UPLOAD_SIZE} bytes.")
+
+
+def save_client_upload(table_name, filename, client_id, file_group):
+    """Save request body to blob storage and register it in table_name.
+    Return (file_path, size, sha256, already_stored)."""
+    extension = os.path.splitext(filename)[1].lower()
+    incoming_path, size, checksum = receive_upload(request.stream, extension)
+    metrics.UPLOAD_BYTES.labels(table_name).inc(size)
+    # Check if the post request has the file data
+    if not size:
+        app.logger.warning("400 No data was sent.")
+        abort(400, description=f"Client_id {client_id} - {filename} - No data was sent.")
+    file_path = None
+    is_new = False
+    with DB(db_connection_string) as db:
+        file_path, is_new = store_blob(db, incoming_path, checksum, size, extension)
+        if file_path:
+            if table_name == 'client_files':
+                saved = db.insert_file_info_into_client_files_table(filename, client_id, file_group, file_path,
+                                                                    checksum)
+            else:
+                saved = db.insert_file_info_into_client_report_files_table(filename, client_id, file_group,
+                                                                           file_path, checksum)
+            if not saved:
+                # No row references the blob
+                discard_blob(db, file_path, is_new)
+                file_path = None
+    if not file_path:
+        app.logger.error(f"500 Client_id {client_id} - {filename} - Unable to register file.")
+        abort(500, description=f"Unable to save file {filename}.")
+    return file_path, size, checksum, not is_new
+
+
+def register_report(filename, client_id, file_group, file_path, checksum):
+    """Save generated report in client_report_files and return its file_id.
+    If the row is not saved the file is removed, nothing would ever reference it."""
+    file_id = None
+    with DB(db_connection_string) as db:
+        file_id = db.insert_file_info_into_client_report_files_table(filename, client_id, file_group, file_path,
+                                                                     checksum)
+    if not file_id:
+        os.remove(file_path)
+        app.logger.error(f"500 Client_id {client_id} - {filename} - Unable to register file.")
+        abort(500, description=f"Unable to save file {filename}.")
+    return file_id
+
+
+def send_stored_file(file_path, filename, sha256=None, last_modified=None, mimetype=None):
+    """Send stored file with strong ETag (sha256 of the content) and Last-Modified.
+    Requests with If-None-Match/If-Modified-Since get 304, Range requests get 206.
+    last_modified is creation_date of the file row or a timestamp."""
+    if hasattr(last_modified, 'timestamp'):
+        # creation_date is naive local time, timestamp() converts it to UTC
+        last_modified = last_modified.timestamp()
+    if not X_ACCEL_REDIRECT_PREFIX:
+        return send_file(file_path, download_name=filename, mimetype=mimetype, conditional=True,
+                         etag=sha256 or True, last_modified=last_modified)
+    # 304 is answered here, otherwise nginx streams the file and serves Range requests
+    relative_path = os.path.relpath(file_path, STORAGE_FOLDER)
+    response = make_response('')
+    response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + quote(relative_path)
+    response.headers['Content-Disposition'] = f"inline; filename*=UTF-8''{quote(filename)}"
+    response.content_type = mimetype or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    if sha256:
+        response.set_etag(sha256)
+    response.last_modified = last_modified or os.path.getmtime(file_path)
+    response.make_conditional(request)
+    if response.status_code == 304:
+        del response.headers['X-Accel-Redirect']
+    return response
+
+
+def encode_cursor(page_end):
+    creation_date, file_id = page_end
+    return base64.urlsafe_b64encode(json.dumps([creation_date.isoformat(), file_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        creation_date, file_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(creation_date), int(file_id)
+    except (ValueError, TypeError):
+        app.logger.warning(f"400 Invalid cursor {cursor}")
+        abort(400, description=f"Invalid cursor {cursor}")
+
+
+def get_date_arg(name):
+    value = request.args.get(name, type=str)
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        app.logger.warning(f"400 Invalid {name} {value}")
+        abort(400, description=f"Invalid {name} {value}, expected YYYY-MM-DD.")
+
+
+def files_list_response(table_name, client_id):
+    """Stream one page of client's files list as JSON array, newest files first.
+    Query params: limit, cursor (from X-Next-Cursor of the previous page), file_group,
+    date_from and date_to (YYYY-MM-DD, inclusive). The next page cursor is sent in
+    X-Next-Cursor and Link headers, they are absent on the last page."""
+    limit = request.args.get('limit', default=FILES_LIST_DEFAULT_LIMIT, type=int)
+    if not 0 < limit <= FILES_LIST_MAX_LIMIT:
+        app.logger.warning(f"400 Invalid limit {limit}")
+        abort(400, description=f"Limit must be from 1 to {FILES_LIST_MAX_LIMIT}.")
+    cursor = request.args.get('cursor', type=str)
+    date_to = get_date_arg('date_to')
+    filters = {'file_group': request.args.get('file_group', type=str),
+               'date_from': get_date_arg('date_from'),
+               'date_to': date_to + timedelta(days=1) if date_to else None,
+               'after': decode_cursor(cursor) if cursor else None}
+    page_end = QUERY_FAILED
+    with DB(db_connection_string) as db:
+        page_end = db.get_files_list_page_end(table_name, client_id, limit, **filters)
+    if page_end is QUERY_FAILED:
+        # Without the page end the whole list would be sent as the last page
+        app.logger.error(f"503 Client_id {client_id} - {table_name} list page can't be read.")
+        abort(503, description="Unable to read the files list, try again later.")
+
+    # Checked out before the response starts, so a busy pool is still a 503
+    db = DB(db_connection_string)
+
+    def generate():
+        try:
+            yield '['
+            for i, file_info in enumerate(db.iter_files_list(table_name, client_id, page_end, **filters)):
+                yield (',' if i else '') + app.json.dumps(file_info)
+            yield ']'
+        except Exception as error:
+            app.logger.error(f"Client_id {client_id} - {table_name} list is not complete: {error!r}")
+            raise
+        finally:
+            db.close()
+
+    response = Response(generate(), mimetype='application/json')
+    # The generator is not run if the client is gone before the body is sent
+    response.call_on_close(db.close)
+    if page_end:
+        next_cursor = encode_cursor(page_end)
+        response.headers['X-Next-Cursor'] = next_cursor
+        next_url = url_for(request.endpoint, **dict(request.args.items(), cursor=next_cursor))
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+    return response
 
 
 @app.route('/docs')
@@ -74,6 +254,38 @@ def get_docs():
     return render_template('swaggerui.html')
 
 
+@app.route('/db_pool_stats')
+def get_db_pool_stats():
+    """Return connection pool stats of the worker process that served the request."""
+    return jsonify(get_pool_stats())
+
+
+@app.route('/metrics')
+def get_metrics():
+    """Return Prometheus metrics of all worker processes."""
+    data, content_type = metrics.generate()
+    return Response(data, content_type=content_type)
+
+
+@app.route('/file_info_cache_stats')
+def get_file_info_cache_stats():
+    """Return file info cache stats of the worker process that served the request."""
+    return jsonify(get_file_info_cache().stats())
+
+
+@app.route('/parse_cache_stats')
+def get_parse_cache_stats():
+    """Return parse cache counters of the worker process that served the request and the cache size on disk."""
+    import parse_cache  # imports numpy, which the app doesn't need until a file is processed
+    return jsonify(parse_cache.stats())
+
+
+@app.route('/report_cache_stats')
+def get_report_cache_stats():
+    """Return report cache counters of the worker process that served the request."""
+    return jsonify(report_cache.stats())
+
+
 # @app.route('/file/download')
 # def download_file():
 #     file_path = "./files_storage/file_templates/price.xlsx"
@@ -117,25 +329,17 @@ def upload_file(filename):
         app.logger.warning("400 Invalid request missing required parameter client_id")
         abort(400, description="Invalid request missing required parameter client_id")
     file_group = request.args.get('file_group', default="Прочее", type=str)
-    # Check if the post request has the file data
-    if not request.data:
-        app.logger.warning("400 No data was sent.")
-        abort(400, description=f"400 Client_id {client_id} - {filename} - No data was sent.")
     if not allowed_file(filename):
         app.logger.warning(f"400 Client_id {client_id} - {filename} - Bad file extension.")
         abort(400, description=f"Bad file extension. Allowed extensions: {', '.join(ALLOWED_EXTENSIONS)}.")
+    check_content_length()
     filename = secure_filename(filename)
-    client_dir_path = os.path.join(FILES_FOLDER, str(client_id))
-    Path(client_dir_path).mkdir(parents=True, exist_ok=True)
-    file_path = os.path.join(client_dir_path, filename)
-    file_path = unique_file_path(file_path)
-    filename = os.path.basename(file_path)
-    with open(file_path, "wb") as f:
-        f.write(request.data)
-    with DB(db_connection_string) as db:
-        db.insert_file_info_into_client_report_files_table(filename, client_id, file_group, file_path)
-    app.logger.info(f"201 Client_id {client_id} - File: {filename} successfully saved.")
-    return jsonify(message=f"File: {filename} successfully saved."), 201
+    file_path, size, checksum, already_stored = save_client_upload('client_report_files', filename,
+                                                                   client_id, file_group)
+    app.logger.info(f"201 Client_id {client_id} - File: {filename} ({size} bytes, sha256 {checksum}, "
+                    f"already stored: {already_stored}) successfully saved.")
+    return jsonify(message=f"File: {filename} successfully saved.", sha256=checksum,
+                   already_stored=already_stored), 201
 
 
 @app.route("/client_report_files/")
@@ -146,15 +350,43 @@ def get_client_report_files_list():
             in: query
             schema:
               type: integer
-            required: true"""
+            required: true
+          - name: limit
+            in: query
+            schema:
+              type: integer
+              default: 1000
+            required: false
+          - name: cursor
+            in: query
+            schema:
+              type: string
+            required: false
+            description: X-Next-Cursor header of the previous page.
+          - name: file_group
+            in: query
+            schema:
+              type: string
+            required: false
+          - name: date_from
+            in: query
+            schema:
+              type: string
+              format: date
+            required: false
+          - name: date_to
+            in: query
+            schema:
+              type: string
+              format: date
+            required: false"""
     client_id = request.args.get('client_id', type=int)
     if client_id is None:
         app.logger.warning("400 Invalid request missing required parameter client_id")
         abort(400, description="Invalid request missing required parameter client_id")
-    with DB(db_connection_string) as db:
-        files = db.get_list_of_client_report_files(client_id)
+    response = files_list_response('client_report_files', client_id)
     app.logger.info(f"200 Client_id {client_id} - Сlient report files info list was sent.")
-    return jsonify(files)
+    return response
 
 
 @app.route('/client_report_files/<file_id>', methods=['GET', 'DELETE'])
@@ -179,24 +411,28 @@ def download_or_delete_client_report_file(file_id):
             schema:
               type: string
             required: true"""
-    with DB(db_connection_string) as db:
-        file_path = db.get_file_path_from_client_report_files_table(file_id)
     if request.method == 'GET':
-        if not file_path:
+        file_info = get_file_info('client_report_files', file_id)
+        if not file_info:
             app.logger.warning(f"404 File with id {file_id} does not exist.")
             abort(404, description=f"File with id {file_id} does not exist.")
         app.logger.info(f"200 File with id {file_id} was sent.")
-        return send_file(file_path)
+        return send_stored_file(file_info['file_path'], file_info['filename'], file_info['sha256'],
+                                file_info['creation_date'])
 
     if request.method == 'DELETE':
         secret_key = request.args.get('secret_key', type=str)
         if secret_key == os.getenv("DELETE_KEY"):
-            if not file_path:
+            deleted = None
+            with DB(db_connection_string) as db:
+                deleted = delete_file(db, 'client_report_files', file_id)
+            if deleted is None:
+                app.logger.error(f"500 File with id {file_id} can't be deleted.")
+                abort(500, description=f"Unable to delete file with id {file_id}, try again later.")
+            invalidate_file_info('client_report_files', file_id)
+            if not deleted:
                 app.logger.info(f"File with id {file_id} is already deleted.")
                 return jsonify(message=f"File with id {file_id} is already deleted."), 200
-            os.remove(file_path)
-            with DB(db_connection_string) as db:
-                db.delete_from_table('client_report_files', file_id)
             return jsonify(message=f"File with id {file_id} was deleted."), 200
         else:
             app.logger.warning("400 Invalid request missing required parameter secret_key")
@@ -221,23 +457,29 @@ def upload_template(filename):
         required: false
         description: Name of file group."""
     file_group = request.args.get('file_group', default="Прочее", type=str)
-    # Check if the post request has the file data
-    if not request.data:
-        app.logger.warning("400 No data was sent.")
-        abort(400, description="No data was sent.")
     if not allowed_file(filename):
         app.logger.warning(f"400 Filename: {filename} - Bad file extension.")
         abort(400, description=f"Bad file extension. Allowed extensions: {', '.join(ALLOWED_EXTENSIONS)}.")
+    check_content_length()
     filename = secure_filename(filename)
     file_path = os.path.join(TEMPLATES_FOLDER, filename)
     if os.path.isfile(file_path):
         app.logger.warning(f"400 Template {filename} already exists.")
         abort(400, description=f"Template {filename} already exists.")
-    with open(file_path, "wb") as f:
-        f.write(request.data)
+    try:
+        size, checksum = save_stream(request.stream, file_path, overwrite=False)
+    except FileExistsError:
+        # Another request saved the same template while this one was uploading
+        app.logger.warning(f"400 Template {filename} already exists.")
+        abort(400, description=f"Template {filename} already exists.")
+    metrics.UPLOAD_BYTES.labels('file_templates').inc(size)
+    # Check if the post request has the file data
+    if not size:
+        app.logger.warning("400 No data was sent.")
+        abort(400, description="No data was sent.")
     with DB(db_connection_string) as db:
-        db.insert_file_info_into_templates_table(filename, file_group, file_path)
-    app.logger.info(f"Template: {filename} successfully saved.")
+        db.insert_file_info_into_templates_table(filename, file_group, file_path, checksum)
+    app.logger.info(f"Template: {filename} ({size} bytes, sha256 {checksum}) successfully saved.")
     return jsonify(message=f"Template: {filename} successfully saved."), 201
 
 
@@ -272,23 +514,27 @@ def download_or_delete_template(file_id):
             schema:
               type: string
             required: true"""
-    with DB(db_connection_string) as db:
-        file_path = db.get_file_path_from_templates_table(file_id)
     if request.method == 'GET':
-        if not file_path:
+        file_info = get_file_info('file_templates', file_id)
+        if not file_info:
             app.logger.warning(f"404 Template with id {file_id} does not exist.")
             abort(404, description=f"Template with id {file_id} does not exist.")
         app.logger.info(f"200 File with id {file_id} was sent.")
-        return send_file(file_path)
+        return send_stored_file(file_info['file_path'], file_info['filename'], file_info['sha256'],
+                                file_info['creation_date'])
     if request.method == 'DELETE':
         secret_key = request.args.get('secret_key', type=str)
         if secret_key == os.getenv("DELETE_KEY"):
-            if not file_path:
+            deleted = None
+            with DB(db_connection_string) as db:
+                deleted = delete_file(db, 'file_templates', file_id)
+            if deleted is None:
+                app.logger.error(f"500 Template with id {file_id} can't be deleted.")
+                abort(500, description=f"Unable to delete template with id {file_id}, try again later.")
+            invalidate_file_info('file_templates', file_id)
+            if not deleted:
                 app.logger.info(f"Template with id {file_id} is already deleted.")
                 return jsonify(message=f"Template with id {file_id} is already deleted."), 200
-            os.remove(file_path)
-            with DB(db_connection_string) as db:
-                db.delete_from_table('file_templates', file_id)
             return jsonify(message=f"Template with id {file_id} was deleted."), 200
         else:
             app.logger.warning("400 Invalid request missing required parameter secret_key")
@@ -329,32 +575,62 @@ def upload_client_file(filename):
         abort(400, description="Invalid request missing required parameter client_id")
     file_group = request.args.get('file_group', default="Прочее", type=str)
     api_id = request.args.get('api_id', type=int)
-    # Check if the post request has the file data
-    if not request.data:
-        app.logger.warning("400 No data was sent.")
-        abort(400, description="No data was sent.")
     if not allowed_file(filename):
         app.logger.warning(f"400 Client_id {client_id} - {filename} - Bad file extension.")
         abort(400, description=f"Bad file extension. Allowed extensions: {', '.join(ALLOWED_EXTENSIONS)}.")
+    check_content_length()
     filename = secure_filename(filename)
-    client_dir_path = os.path.join(CLIENT_FILES_FOLDER, str(client_id))
-    Path(client_dir_path).mkdir(parents=True, exist_ok=True)
-    file_path = os.path.join(client_dir_path, filename)
-    file_path = unique_file_path(file_path)
-    filename = os.path.basename(file_path)
-    with open(file_path, "wb") as f:
-        f.write(request.data)
-    with DB(db_connection_string) as db:
-        db.insert_file_info_into_client_files_table(filename, client_id, file_group, file_path)
-    result = {"message": f"Client file: {filename} successfully saved."}
-    if file_group in FILE_GROUP_METHODS:
-        method_name = FILE_GROUP_METHODS[file_group]
-        method = getattr(file_handling_methods, method_name)
-        result = method(file_path, client_id=client_id, api_id=api_id)
+    file_path, size, checksum, already_stored = save_client_upload('client_files', filename,
+                                                                   client_id, file_group)
+    app.logger.info(f"Client_id {client_id} - Client file: {filename} ({size} bytes, sha256 {checksum}, "
+                    f"already stored: {already_stored}) saved.")
+    result = {"message": f"Client file: {filename} successfully saved.",
+              "sha256": checksum,
+              "already_stored": already_stored}
+    processor = get_processor(file_group)
+    if processor:
+        # Processing runs in background, client polls /jobs/<job_id> for the result
+        try:
+            job_id = get_job_queue().submit(file_group, processor.name, file_path,
+                                            client_id=client_id, api_id=api_id, sha256=checksum)
+        except QueueFull as e:
+            app.logger.warning(f"503 Client_id {client_id} - {filename} - {e}")
+            abort(503, description="Too many files are being processed, try again later.")
+        except JobNotSaved as e:
+            app.logger.error(f"503 Client_id {client_id} - {filename} - {e}")
+            abort(503, description=f"Client file: {filename} is saved, but it could not be queued for processing, "
+                                   f"try again later.")
+        status_url = url_for('get_job', job_id=job_id)
+        result = {"message": f"Client file: {filename} successfully saved and queued for processing.",
+                  "sha256": checksum,
+                  "already_stored": already_stored,
+                  "job_id": job_id,
+                  "status_url": status_url}
+        app.logger.info(f"202 Client_id {client_id} - " + result['message'] + f" Job id: {job_id}.")
+        return jsonify(result), 202, {'Location': status_url}
     app.logger.info(f"201 Client_id {client_id} - " + result['message'])
     return jsonify(result), 201
 
 
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Return status, progress and result of a file processing job.
+        parameters:
+          - name: job_id
+            in: path
+            schema:
+              type: string
+            required: true"""
+    job = get_job_queue().get(job_id)
+    if not job:
+        app.logger.warning(f"404 Job with id {job_id} does not exist.")
+        abort(404, description=f"Job with id {job_id} does not exist.")
+    app.logger.info(f"200 Job {job_id} status {job['status']} was sent.")
+    return jsonify(job_id=job['job_id'], client_id=job['client_id'], file_group=job['file_group'],
+                   status=job['status'], progress=job['progress'], result=job['result'], error=job['error'],
+                   created_at=job['created_at'], updated_at=job['updated_at'])
+
+
 @app.route("/client_files/")
 def get_client_files_list():
     """Return list of dictionaries with info about saved client files..
@@ -363,15 +639,43 @@ def get_client_files_list():
         in: query
         schema:
           type: integer
-        required: true"""
+        required: true
+      - name: limit
+        in: query
+        schema:
+          type: integer
+          default: 1000
+        required: false
+      - name: cursor
+        in: query
+        schema:
+          type: string
+        required: false
+        description: X-Next-Cursor header of the previous page.
+      - name: file_group
+        in: query
+        schema:
+          type: string
+        required: false
+      - name: date_from
+        in: query
+        schema:
+          type: string
+          format: date
+        required: false
+      - name: date_to
+        in: query
+        schema:
+          type: string
+          format: date
+        required: false"""
     client_id = request.args.get('client_id', type=int)
     if client_id is None:
         app.logger.warning("400 Invalid request missing required parameter client_id")
         abort(400, description="Invalid request missing required parameter client_id")
-    with DB(db_connection_string) as db:
-        files = db.get_list_of_client_files(client_id)
+    response = files_list_response('client_files', client_id)
     app.logger.info(f"200 Client_id {client_id} - Client files info list was sent.")
-    return jsonify(files)
+    return response
 
 
 @app.route('/client_files/<file_id>', methods=['GET', 'DELETE'])
@@ -397,29 +701,64 @@ def download_or_delete_client_file(file_id):
             schema:
               type: string
             required: true"""
-    with DB(db_connection_string) as db:
-        file_path = db.get_file_path_from_client_files_table(file_id)
     if request.method == 'GET':
-        if not file_path:
+        file_info = get_file_info('client_files', file_id)
+        if not file_info:
             app.logger.warning(f"404 File with id {file_id} does not exist.")
             abort(404, description=f"Client file with id {file_id} does not exist.")
         app.logger.info(f"200 Client file with id {file_id} was sent.")
-        return send_file(file_path)
+        return send_stored_file(file_info['file_path'], file_info['filename'], file_info['sha256'],
+                                file_info['creation_date'])
     if request.method == 'DELETE':
         secret_key = request.args.get('secret_key', type=str)
         if secret_key == os.getenv("DELETE_KEY"):
-            if not file_path:
+            deleted = None
+            with DB(db_connection_string) as db:
+                deleted = delete_file(db, 'client_files', file_id)
+            if deleted is None:
+                app.logger.error(f"500 Client file with id {file_id} can't be deleted.")
+                abort(500, description=f"Unable to delete client file with id {file_id}, try again later.")
+            invalidate_file_info('client_files', file_id)
+            if not deleted:
                 app.logger.info(f"Client file with id {file_id} is already deleted.")
                 return jsonify(message=f"Client file with id {file_id} is already deleted."), 200
-            os.remove(file_path)
-            with DB(db_connection_string) as db:
-                db.delete_from_table('client_files', file_id)
             return jsonify(message=f"Client file with id {file_id} was deleted."), 200
         else:
             app.logger.warning("400 Invalid request missing required parameter secret_key")
             abort(400, description="Invalid request missing required parameter secret_key")
 
 
+def save_result(response, method=''):
+    """Save streamed JSON result of a graph method to a temp file (see json_stream.save_body), return its path."""
+    prefix = f"{method}: " if method else ''
+    try:
+        return save_body(response)
+    except requests.exceptions.RequestException as e:
+        # Connection lost while reading
+        app.logger.warning(f"{prefix}{e!r}")
+        abort(404, description=f"{prefix}{e!r}")
+    finally:
+        response.close()
+
+
+def convert_results(writer, file_path, *args):
+    """Write file_path from saved results with a json_stream writer, in the CPU pool.
+    Results that are not a list of records, dict of lists or a single record are 500,
+    invalid JSON is 404. The file is removed if it is not written."""
+    try:
+        cpu_pool.run(writer, *args)
+    except BaseException as e:
+        os.remove(file_path)
+        prefix = f"{e.label}: " if getattr(e, 'label', '') else ''
+        if isinstance(e, UnsupportedShape):
+            app.logger.error(f"{prefix}Unable to convert result to table: {e}.")
+            abort(500, description=f"{prefix}Unable to convert result to table.")
+        if isinstance(e, ValueError):
+            app.logger.warning(f"{prefix}{e!r}")
+            abort(404, description=f"{prefix}{e!r}")
+        raise
+
+
 @app.route('/report', methods=['POST'])
 def get_report():
     """Return report for client.
@@ -434,7 +773,14 @@ def get_report():
             in: query
             schema:
               type: integer
-            required: true"""
+            required: true
+          - name: format
+            in: query
+            schema:
+              type: string
+              enum: [xlsx, csv, csv.gz]
+              default: xlsx
+            required: false"""
     client_id = request.args.get('client_id', type=int)
     if client_id is None:
         app.logger.warning("400 Invalid request missing required parameter client_id")
@@ -446,48 +792,124 @@ def get_report():
     if method not in ALLOWED_METHODS:
         app.logger.warning(f"400 Method {method} is not allowed")
         abort(400, description=f"400 Method {method} is not allowed. Allowed methods: {', '.join(ALLOWED_METHODS)}")
+    report_format = request.args.get('format', default='xlsx', type=str)
+    if report_format not in REPORT_FORMATS:
+        app.logger.warning(f"400 Report format {report_format} is not allowed")
+        abort(400, description=f"Report format {report_format} is not allowed. "
+                               f"Allowed formats: {', '.join(REPORT_FORMATS)}")
 
-    result = None
-    url = "https://" + method
+    url = GRAPHS_API_URL + method
     json_data = request.json
-    print(type(json_data))
-    print(json_data)
+    cached = report_cache.get(method, client_id, report_format, json_data)
+    if cached:
+        app.logger.info(f"200 Client_id {client_id} - File: {cached['filename']} was sent from cache.")
+        return send_stored_file(cached['file_path'], cached['filename'], cached.get('sha256'), cached['created'],
+                                cached['mimetype'])
     try:
-        response = requests.post(url, json=json_data)
+        # Graph methods only read data, so the request is safe to retry
+        response = get_http_client().post(url, json=json_data, idempotent=True, stream=True)
         if response.status_code in {400, 404, 422, 500}:
-            abort(response.status_code, description=repr(response.json()))
-        result = response.json()
+            # Closed before abort, or the connection would be kept out of the pool
+            with response:
+                abort(response.status_code, description=repr(response.json()))
     except requests.exceptions.RequestException as e:
         app.logger.warning(repr(e))
         abort(404, description=repr(e))
-
-    print(result)
-    if type(result) is list:
-        df = pd.DataFrame.from_records(result)
-    elif type(result) is dict:
-        values = list(result.values())
-        if type(values[0]) is list:
-            df = pd.DataFrame.from_dict(result)
-        else:
-            df = pd.DataFrame.from_records([result])
-    else:
-        app.logger.error(f"Unable to convert result to dataframe; result type: {type(result)}.")
-        abort(500, description="Unable to convert result to dataframe.")
+    body_path = save_result(response)
 
     method_name = method[1:].replace('/', ' ')
-    filename = f"{method_name} {strftime('%d-%m-%y %H-%M', localtime())}.xlsx"
+    extension, mimetype = REPORT_FORMATS[report_format]
+    filename = f"{method_name} {strftime('%d-%m-%y %H-%M', localtime())}{extension}"
     client_dir_path = os.path.join(FILES_FOLDER, str(client_id))
-    Path(client_dir_path).mkdir(parents=True, exist_ok=True)
-    file_path = os.path.join(client_dir_path, filename)
-    file_path = unique_file_path(file_path)
-    filename = os.path.basename(file_path)
+    file_path = allocate_file_path(client_dir_path, filename)
     file_group = method_name  # ????????????????????
-    df.to_excel(file_path)
-    with DB(db_connection_string) as db:
-        db.insert_file_info_into_client_report_files_table(filename, client_id, file_group, file_path)
+    try:
+        # Parsing the result and writing the file take CPU time, they are done out of the request thread
+        convert_results(write_result_report, file_path, body_path, response.encoding, file_path, report_format, True)
+    finally:
+        os.remove(body_path)
+    checksum = file_sha256(file_path)
+    file_id = register_report(filename, client_id, file_group, file_path, checksum)
+    report_cache.put(method, client_id, report_format, json_data, file_id, file_path, filename, mimetype, checksum)
     app.logger.info(f"Client_id {client_id} - File: {filename} successfully saved.")
     app.logger.info(f"200 Client_id {client_id} - File: {filename} was sent.")
-    return send_file(file_path)
+    return send_stored_file(file_path, filename, checksum, mimetype=mimetype)
+
+
+@app.route('/reports/batch', methods=['POST'])
+def get_reports_batch():
+    """Return one workbook with a sheet per graph method, methods are requested concurrently.
+        parameters:
+          - name: client_id
+            in: query
+            schema:
+              type: integer
+            required: true
+        requestBody:
+          methods: list of graph methods, e.g. ["/graphs/full", "/graphs/ddr"]
+          data: JSON that is sent to every method"""
+    client_id = request.args.get('client_id', type=int)
+    if client_id is None:
+        app.logger.warning("400 Invalid request missing required parameter client_id")
+        abort(400, description="Invalid request missing required parameter client_id")
+    body = request.get_json(silent=True) or {}
+    methods = body.get('methods')
+    if not methods or type(methods) is not list:
+        app.logger.warning("400 Invalid request missing required parameter methods")
+        abort(400, description="Invalid request missing required parameter methods")
+    not_allowed = [method for method in methods if method not in ALLOWED_METHODS]
+    if not_allowed:
+        app.logger.warning(f"400 Methods {', '.join(map(str, not_allowed))} are not allowed")
+        abort(400, description=f"Methods {', '.join(map(str, not_allowed))} are not allowed. "
+                               f"Allowed methods: {', '.join(ALLOWED_METHODS)}")
+    methods = list(dict.fromkeys(methods))  # drop duplicates, keep order
+    json_data = body.get('data')
+
+    # Bodies are read in the fan-out threads, so all methods are downloaded concurrently
+    def save_response(response):
+        try:
+            if response.status_code in {400, 404, 422, 500}:
+                response.content  # small error body, read before the response is closed
+                return response, None
+            return response, save_body(response)
+        finally:
+            response.close()
+
+    # Graph methods only read data, so the requests are safe to retry
+    saved = get_http_client().post_many([(GRAPHS_API_URL + method, json_data) for method in methods],
+                                        max_concurrency=REPORT_BATCH_CONCURRENCY, idempotent=True,
+                                        stream=True, on_response=save_response)
+    try:
+        results = []
+        sheet_names = set()
+        for method, result in zip(methods, saved):
+            if isinstance(result, requests.exceptions.RequestException):
+                # Request failed or connection lost while reading
+                app.logger.warning(f"{method}: {result!r}")
+                abort(404, description=f"{method}: {result!r}")
+            response, body_path = result
+            if response.status_code in {400, 404, 422, 500}:
+                abort(response.status_code, description=f"{method}: {response.json()!r}")
+            # Excel limits sheet names to 31 characters
+            sheet_name = method.rsplit('/', 1)[-1][:31]
+            if sheet_name in sheet_names:
+                sheet_name = f"{sheet_name[:27]} {len(sheet_names)}"
+            sheet_names.add(sheet_name)
+            results.append((sheet_name, method, body_path, response.encoding))
+        filename = f"report batch {strftime('%d-%m-%y %H-%M', localtime())}.xlsx"
+        client_dir_path = os.path.join(FILES_FOLDER, str(client_id))
+        file_path = allocate_file_path(client_dir_path, filename)
+        file_group = "report batch"
+        convert_results(write_results_xlsx, file_path, file_path, results)
+    finally:
+        for result in saved:
+            if not isinstance(result, requests.exceptions.RequestException) and result[1]:
+                os.remove(result[1])
+    checksum = file_sha256(file_path)
+    register_report(filename, client_id, file_group, file_path, checksum)
+    app.logger.info(f"Client_id {client_id} - File: {filename} with {len(methods)} reports successfully saved.")
+    app.logger.info(f"200 Client_id {client_id} - File: {filename} was sent.")
+    return send_stored_file(file_path, filename, checksum)
 
 
 @app.route('/client_template/offers_mapping_table', methods=['GET'])
@@ -509,21 +931,17 @@ def get_offers_mapping_table():
     if not headers:
         app.logger.warning(f"404 Client {client_id} has no stores.")
         abort(404, description=f"404 Client {client_id} has no stores.")
-    df = pd.DataFrame(columns=headers)
 
     filename = f"Template offers mapping table {strftime('%d-%m-%y', localtime())}.xlsx"
     client_dir_path = os.path.join(FILES_FOLDER, str(client_id))
-    Path(client_dir_path).mkdir(parents=True, exist_ok=True)
-    file_path = os.path.join(client_dir_path, filename)
-    file_path = unique_file_path(file_path)
-    filename = os.path.basename(file_path)
+    file_path = allocate_file_path(client_dir_path, filename)
     file_group = "template"
-    df.to_excel(file_path, index=False)
-    with DB(db_connection_string) as db:
-        db.insert_file_info_into_client_report_files_table(filename, client_id, file_group, file_path)
+    write_xlsx(file_path, [('Sheet1', headers, [], False)])
+    checksum = file_sha256(file_path)
+    register_report(filename, client_id, file_group, file_path, checksum)
     app.logger.info(f"Client_id {client_id} - File: {filename} successfully saved.")
     app.logger.info(f"200 Client_id {client_id} - File: {filename} was sent.")
-    return send_file(file_path)
+    return send_stored_file(file_path, filename, checksum)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,75 @@
+import os
+import shutil
+
+# Workers write metrics to files in this directory, /metrics aggregates them (prometheus_client multiprocess mode).
+# Set here, in the master, so that workers inherit it before they import prometheus_client.
+prometheus_multiproc_dir = os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/files_load_api_metrics')
+
+# 'gthread' serves GUNICORN_THREADS requests at a time per worker, so requests waiting for
+# the upstream or the database don't hold a whole process. 'gevent' serves up to
+# GUNICORN_WORKER_CONNECTIONS requests per worker in greenlets (needs gevent and psycogreen).
+# 'sync' serves one request per worker
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+# gunicorn turns sync workers into gthread ones if threads > 1
+threads = int(os.getenv('GUNICORN_THREADS', 32)) if worker_class == 'gthread' else 1
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+# Requests served at a time by one worker
+concurrency = {'gthread': threads, 'sync': 1}.get(worker_class, worker_connections)
+# Connections the whole app (all workers and their processes) may open to Postgres. The default
+# fits a stock max_connections=100, leaving superuser_reserved_connections and a few for psql
+pg_max_connections = int(os.getenv('PG_MAX_CONNECTIONS', 90))
+
+if worker_class != 'sync':
+    # Concurrent requests of a worker share its GIL: report conversion and file processing
+    # run in processes of the worker, jobs in their own (see cpu_pool.py)
+    os.environ.setdefault('CPU_POOL_WORKERS', '1')
+    os.environ.setdefault('JOBS_POOL_WORKERS', '1')
+    # Keep-alive connections to the upstream for every request that may wait for it
+    os.environ.setdefault('HTTP_POOL_MAXSIZE', str(min(concurrency, 256)))
+
+
+def set_pg_pool_max_size(server):
+    """Default PG_POOL_MAX_SIZE from PG_MAX_CONNECTIONS split between the workers. A worker uses
+        1 LISTEN connection (file_info_cache)
+      + 2 per job process (job store and bulk load), or without job processes the bulk load
+        engine of the worker (up to JOBS_MAX_WORKERS loads at a time)
+      + PG_POOL_MAX_SIZE (request and job threads).
+    Most requests wait for the upstream, not the database: the pool is also capped at a quarter
+    of the worker's concurrency, the other requests wait up to PG_POOL_TIMEOUT, then get 503."""
+    if os.getenv('PG_POOL_MAX_SIZE'):
+        return
+    jobs_processes = int(os.getenv('JOBS_POOL_WORKERS', 0))
+    if jobs_processes:
+        extra_connections = 1 + 2 * jobs_processes
+    else:
+        extra_connections = 1 + min(int(os.getenv('JOBS_MAX_WORKERS', 2)),
+                                    int(os.getenv('BULK_LOAD_POOL_SIZE', 2)) +
+                                    int(os.getenv('BULK_LOAD_MAX_OVERFLOW', 2)))
+    pool_size = min(pg_max_connections // server.cfg.workers - extra_connections, max(4, concurrency // 4))
+    if pool_size < 1:
+        server.log.warning(f"PG_MAX_CONNECTIONS={pg_max_connections} is too low for {server.cfg.workers} workers, "
+                           f"using pools of 1 connection.")
+        pool_size = 1
+    os.environ['PG_POOL_MAX_SIZE'] = str(pool_size)
+    server.log.info(f"PG_POOL_MAX_SIZE={pool_size}: up to {(pool_size + extra_connections) * server.cfg.workers} "
+                    f"connections to Postgres.")
+
+
+def on_starting(server):
+    # Samples of a previous run would be aggregated with the new ones
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+    # Workers inherit the environment of the master
+    set_pg_pool_max_size(server)
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 waits for the server in C code, which would block all greenlets of the worker
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,216 @@
+import os
+import time
+import random
+import threading
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+import my_logger
+import metrics
+
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 5))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 300))
+# Keep-alive connections kept per host
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 16))
+# Attempts after the first one, only for failures that are safe to retry
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 2))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', 0.5))
+# Circuit breaker: after this many consecutive failures requests to the host fail fast ...
+HTTP_BREAKER_FAILURES = int(os.getenv('HTTP_BREAKER_FAILURES', 5))
+# ... for this many seconds, then one trial request is let through
+HTTP_BREAKER_RESET_TIMEOUT = float(os.getenv('HTTP_BREAKER_RESET_TIMEOUT', 30))
+# Max concurrent requests of post_many
+HTTP_FANOUT_CONCURRENCY = int(os.getenv('HTTP_FANOUT_CONCURRENCY', 8))
+RETRY_STATUSES = {502, 503, 504}
+
+logger = my_logger.init_logger("http_client")
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Host had too many consecutive failures, request was not sent."""
+
+
+def is_not_sent(error):
+    """True if the connection could not be opened, so the request surely did not reach the server."""
+    if isinstance(error, (requests.exceptions.ConnectTimeout, CircuitOpenError)):
+        return True
+    # requests wraps urllib3 MaxRetryError, whose reason is the connection error
+    reason = error.args[0] if error.args else None
+    return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+
+class CircuitBreaker:
+    """closed -> (failure_threshold consecutive failures) -> open -> (reset_timeout) -> half-open.
+    In half-open state one trial request is allowed: success closes the circuit, failure opens it again."""
+
+    def __init__(self, failure_threshold=HTTP_BREAKER_FAILURES, reset_timeout=HTTP_BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow_request(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_in_progress:
+                self.trial_in_progress = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_progress = False
+
+    def record_ignored(self):
+        """The request failed for a reason unrelated to the host's health (e.g. a bad URL)."""
+        with self._lock:
+            self.trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_progress = False
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+class HttpClient:
+    """Outbound HTTP client shared by the process: keep-alive connection pool per host,
+    connect/read timeouts, retries with exponential backoff and a circuit breaker per host.
+
+    Failures to open a connection (connect timeout, refused or unresolved host, open circuit)
+    mean the request was not sent, they are retried for all requests. Other connection errors
+    (e.g. the connection was dropped after the body was sent), read timeouts and 502/503/504
+    responses are retried only for idempotent requests: the server may have applied them."""
+
+    def __init__(self, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                 pool_maxsize=HTTP_POOL_MAXSIZE, retries=HTTP_RETRIES, backoff=HTTP_RETRY_BACKOFF):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.pid = os.getpid()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    def breaker(self, url):
+        host = urlsplit(url).netloc
+        with self._breakers_lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker()
+            return self._breakers[host]
+
+    def request(self, method, url, idempotent=None, timeout=None, **kwargs):
+        """Send request and return the response; raise requests.exceptions.RequestException on failure.
+        idempotent defaults to True for GET/HEAD/OPTIONS/PUT/DELETE."""
+        if idempotent is None:
+            idempotent = method.upper() in {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+        breaker = self.breaker(url)
+        attempt = 0
+        while True:
+            if not breaker.allow_request():
+                raise CircuitOpenError(f"Circuit for {urlsplit(url).netloc} is open, request is not sent.")
+            retryable = False
+            try:
+                response = self._send(method, url, timeout=timeout or self.timeout, **kwargs)
+            except requests.exceptions.ConnectionError as e:
+                # Also covers ConnectTimeout
+                breaker.record_failure()
+                error, retryable = e, idempotent or is_not_sent(e)
+            except requests.exceptions.Timeout as e:
+                breaker.record_failure()
+                error, retryable = e, idempotent
+            except requests.exceptions.RequestException:
+                breaker.record_ignored()
+                raise
+            else:
+                if response.status_code in RETRY_STATUSES:
+                    breaker.record_failure()
+                    if not idempotent or attempt >= self.retries:
+                        return response
+                    error = requests.exceptions.HTTPError(f"{response.status_code} response", response=response)
+                    retryable = True
+                    response.close()
+                else:
+                    breaker.record_success()
+                    return response
+            if not retryable or attempt >= self.retries:
+                raise error
+            delay = self.backoff * 2 ** attempt * (0.5 + random.random() / 2)
+            logger.warning(f"{method} {url} failed ({error!r}), retry {attempt + 1} in {delay:.2f}s.")
+            time.sleep(delay)
+            attempt += 1
+
+    def _send(self, method, url, **kwargs):
+        """One attempt of request, observed in files_load_api_upstream_seconds."""
+        parts = urlsplit(url)
+        status = 'error'
+        started = time.perf_counter()
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        except requests.exceptions.RequestException as e:
+            status = type(e).__name__
+            raise
+        finally:
+            metrics.UPSTREAM_SECONDS.labels(method.upper(), parts.netloc + parts.path, status).observe(
+                time.perf_counter() - started)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post_many(self, calls, max_concurrency=HTTP_FANOUT_CONCURRENCY, on_response=None, **kwargs):
+        """Send POST requests concurrently over the shared pool.
+        calls is a list of (url, json) pairs. Return list of responses or exceptions, in order.
+        on_response(response) is called in the sending thread, e.g. to read a body sent with
+        stream=True while the other requests are in flight; its result is returned instead of
+        the response, a RequestException it raises is returned like a failed request."""
+        def send(call):
+            url, json_data = call
+            try:
+                response = self.post(url, json=json_data, **kwargs)
+                return on_response(response) if on_response else response
+            except requests.exceptions.RequestException as e:
+                return e
+
+        if not calls:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(calls)),
+                                thread_name_prefix='http-fanout') as executor:
+            return list(executor.map(send, calls))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_http_client():
+    """Return the process-wide client, creating it on first use (after fork)."""
+    global _client
+    with _client_lock:
+        if _client is None or _client.pid != os.getpid():
+            _client = HttpClient()
+        return _client
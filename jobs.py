@@ -0,0 +1,243 @@
+import os
+import uuid
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException
+import my_logger
+import cpu_pool
+from postgres import DB, db_connection_string
+from processors import run_processor
+
+# 'postgres' keeps job state in the file_jobs table, 'memory' keeps it in the process (for tests/dev)
+JOBS_BACKEND = os.getenv('JOBS_BACKEND', 'postgres')
+# Number of jobs processed concurrently by one worker process
+JOBS_MAX_WORKERS = int(os.getenv('JOBS_MAX_WORKERS', 2))
+# Max number of jobs waiting for a free worker thread in one process
+JOBS_MAX_QUEUED = int(os.getenv('JOBS_MAX_QUEUED', 100))
+# Running jobs refresh their heartbeat this often (seconds)
+JOBS_HEARTBEAT_INTERVAL = float(os.getenv('JOBS_HEARTBEAT_INTERVAL', 30))
+# Jobs without heartbeat for this long are taken over by another worker (seconds)
+JOBS_STALE_AFTER = float(os.getenv('JOBS_STALE_AFTER', 300))
+
+logger = my_logger.init_logger("jobs")
+
+
+class QueueFull(Exception):
+    """Too many jobs are waiting in this process."""
+
+
+class JobNotSaved(Exception):
+    """The job store could not save a new job."""
+
+
+class MemoryJobStore:
+    """In-process job store. Jobs are lost on restart."""
+
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, job):
+        now = datetime.now()
+        with self._lock:
+            self._jobs[job['job_id']] = dict(job, progress=0, result=None, error=None,
+                                             created_at=now, updated_at=now)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields, updated_at=datetime.now())
+
+    def claim(self, job_id, worker_pid):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if not job or job['status'] != 'queued':
+                return False
+            job.update(status='running', worker_pid=worker_pid, updated_at=datetime.now())
+            return True
+
+    def claim_stale(self, worker_pid, stale_seconds):
+        return None
+
+    def touch(self, job_ids):
+        pass
+
+
+class PostgresJobStore:
+    """Job store backed by the file_jobs table, shared by all workers and restarts."""
+
+    def create(self, job):
+        with DB(db_connection_string) as db:
+            saved = db.insert_file_job(job)
+        if not saved:
+            raise JobNotSaved(f"Job {job['job_id']} is not saved to file_jobs.")
+
+    def get(self, job_id):
+        with DB(db_connection_string) as db:
+            return db.get_file_job(job_id)
+
+    def update(self, job_id, **fields):
+        with DB(db_connection_string) as db:
+            db.update_file_job(job_id, **fields)
+
+    def claim(self, job_id, worker_pid):
+        with DB(db_connection_string) as db:
+            return db.claim_file_job(job_id, worker_pid)
+
+    def claim_stale(self, worker_pid, stale_seconds):
+        with DB(db_connection_string) as db:
+            return db.claim_stale_file_job(worker_pid, stale_seconds)
+
+    def touch(self, job_ids):
+        with DB(db_connection_string) as db:
+            db.touch_file_jobs(job_ids)
+
+
+class JobQueue:
+    """Run file_group processors (see processors.py) on a bounded thread pool.
+
+    Job status goes queued -> running -> done | failed. With a persistent store a
+    maintenance thread keeps heartbeats of running jobs fresh and picks up jobs
+    that were abandoned (e.g. by a restarted worker)."""
+
+    def __init__(self, store, max_workers=JOBS_MAX_WORKERS, max_queued=JOBS_MAX_QUEUED):
+        self.store = store
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.pid = os.getpid()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='file-job')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = set()
+        self._maintenance = None
+
+    def submit(self, file_group, method_name, file_path, client_id=None, api_id=None, **kwargs):
+        """Persist a new job and schedule it. Return job_id.
+        Raise QueueFull if too many jobs are waiting, JobNotSaved if the store failed."""
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queued:
+                raise QueueFull(f"{self._pending} jobs are already queued.")
+            self._pending += 1
+        job_id = uuid.uuid4().hex
+        job = {'job_id': job_id, 'client_id': client_id, 'api_id': api_id, 'file_group': file_group,
+               'method_name': method_name, 'file_path': file_path, 'kwargs': kwargs,
+               'status': 'queued', 'worker_pid': self.pid}
+        try:
+            self.store.create(job)
+            self._executor.submit(self._claim_and_run, job)
+        except BaseException:
+            with self._lock:
+                self._pending -= 1
+            raise
+        logger.info(f"Job {job_id} ({file_group}) queued for client_id {client_id}.")
+        return job_id
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def _claim_and_run(self, job):
+        try:
+            if self.store.claim(job['job_id'], self.pid):
+                self._run(job)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _run(self, job):
+        job_id = job['job_id']
+        with self._lock:
+            self._running.add(job_id)
+        try:
+            self.store.update(job_id, progress=0)
+
+            kwargs = dict(job['kwargs'] or {}, client_id=job['client_id'], api_id=job['api_id'])
+            if cpu_pool.JOBS_POOL_WORKERS:
+                # Reading and validating files take CPU time, they are done out of the worker process
+                result = cpu_pool.run_job(run_pooled_job, job_id, job['file_group'], job['file_path'], kwargs)
+            else:
+                def progress(percent):
+                    self.store.update(job_id, progress=int(percent))
+
+                result = run_processor(job['file_group'], job['file_path'], progress=progress, **kwargs)
+            if result is None:
+                result = {"message": f"Client file: {os.path.basename(job['file_path'])} is processed."}
+            self.store.update(job_id, status='done', progress=100, result=result)
+            logger.info(f"Job {job_id} done: {result.get('message')}")
+        except HTTPException as e:
+            self.store.update(job_id, status='failed', error={"code": e.code, "description": e.description})
+            logger.warning(f"Job {job_id} failed: {e.code} {e.description}")
+        except Exception as e:
+            self.store.update(job_id, status='failed', error={"code": 500, "description": repr(e)})
+            logger.error(f"Job {job_id} failed: {e!r}")
+        finally:
+            with self._lock:
+                self._running.discard(job_id)
+
+    def start_maintenance(self, interval=JOBS_HEARTBEAT_INTERVAL, stale_after=JOBS_STALE_AFTER):
+        """Start heartbeat/recovery thread (once per process)."""
+        if self._maintenance is not None:
+            return
+        self._maintenance = threading.Thread(target=self._maintenance_loop, args=(interval, stale_after),
+                                             name='file-job-maintenance', daemon=True)
+        self._maintenance.start()
+
+    def _maintenance_loop(self, interval, stale_after):
+        while True:
+            try:
+                with self._lock:
+                    running = list(self._running)
+                    has_capacity = self._pending < self.max_workers
+                if running:
+                    self.store.touch(running)
+                if has_capacity:
+                    job = self.store.claim_stale(self.pid, stale_after)
+                    if job:
+                        logger.warning(f"Job {job['job_id']} was abandoned, resuming it.")
+                        with self._lock:
+                            self._pending += 1
+                        self._executor.submit(self._run_recovered, job)
+            except Exception as e:
+                logger.error(repr(e))
+            threading.Event().wait(interval)
+
+    def _run_recovered(self, job):
+        try:
+            self._run(job)
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+
+def run_pooled_job(job_id, file_group, file_path, kwargs):
+    """run_processor in a process of the cpu_pool jobs pool. Progress is saved to the job store when it is shared
+    by processes (postgres), the memory store of the worker can't be updated from here."""
+    store = PostgresJobStore() if JOBS_BACKEND != 'memory' else None
+
+    def report_progress(percent):
+        store.update(job_id, progress=int(percent))
+
+    progress = report_progress if store is not None else None
+    return run_processor(file_group, file_path, progress=progress, **kwargs)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """Return the process-wide job queue, creating it on first use (after fork)."""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None or _job_queue.pid != os.getpid():
+            if JOBS_BACKEND == 'memory':
+                _job_queue = JobQueue(MemoryJobStore())
+            else:
+                _job_queue = JobQueue(PostgresJobStore())
+                _job_queue.start_maintenance()
+        return _job_queue
@@ -0,0 +1,360 @@
+"""Incremental conversion of JSON results of graph methods to tables.
+
+The upstream body is saved to a temp file as it arrives (save_body), so the request
+thread only does I/O; the file is read in chunks and parsed one element (record, row
+or column value) at a time: the items of an array that are in the buffer are decoded with one
+json.loads call, a value crossing the buffer end with json.JSONDecoder.raw_decode.
+Columns of a table are only known once the whole result is read, so items are spilled
+to temp files (a JSON array per line) while the columns are collected, and rows are
+read back from the files by the writer. Memory holds about one chunk and one value,
+whatever the size of the result."""
+import os
+import re
+import json
+import tempfile
+from contextlib import ExitStack
+from itertools import repeat
+from report_writers import write_report, write_xlsx
+
+# Directory of the temp files of streamed results, the system temp dir by default
+REPORT_SPILL_DIR = os.getenv('REPORT_SPILL_DIR') or None
+# Bytes read from the upstream response at a time
+JSON_STREAM_CHUNK_SIZE = int(os.getenv('JSON_STREAM_CHUNK_SIZE', 65536))
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+
+
+class UnsupportedShape(Exception):
+    """The result is valid JSON, but not one of the shapes of report_writers.table_from_result."""
+
+
+def save_body(response, spill_dir=REPORT_SPILL_DIR, chunk_size=JSON_STREAM_CHUNK_SIZE):
+    """Write the body of a response sent with stream=True to a temp file as it arrives.
+    Return the file path, the caller removes the file."""
+    fd, file_path = tempfile.mkstemp(suffix='.json', dir=spill_dir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in response.iter_content(chunk_size):
+                f.write(chunk)
+    except BaseException:
+        os.remove(file_path)
+        raise
+    return file_path
+
+
+def iter_file_text(file_path, encoding=None, chunk_size=JSON_STREAM_CHUNK_SIZE):
+    """Yield the text of a file saved by save_body in chunks."""
+    with open(file_path, encoding=encoding or 'utf-8') as f:
+        while True:
+            text = f.read(chunk_size)
+            if not text:
+                return
+            yield text
+
+
+class _Reader:
+    """JSON text from chunks, read token by token."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self, size):
+        """Buffer at least size unread characters, unless the input ends. Return False if nothing was read."""
+        parts = [self.buffer[self.pos:]]
+        length = len(parts[0])
+        while length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                self.eof = True
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        self.buffer = ''.join(parts)
+        self.pos = 0
+        return len(parts) > 1
+
+    def peek(self):
+        """Return the next character that is not whitespace, '' at the end of input."""
+        while True:
+            self.pos = _whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read(1):
+                return ''
+
+    def take(self):
+        char = self.peek()
+        self.pos += len(char)
+        return char
+
+    def expect(self, char):
+        if self.take() != char:
+            raise ValueError(f"Invalid JSON: expected {char!r}")
+
+    def value(self):
+        """Decode the next value. Return (value, its JSON text)."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                end = None
+            # A number at the end of the buffer ('12', '1.', '1e') may continue in the next chunk
+            if end is not None and (self.eof or (end < len(self.buffer) and self.buffer[end] not in '.eE')):
+                text = self.buffer[self.pos:end]
+                self.pos = end
+                return value, text
+            # Grow the buffer geometrically, so a big value is not re-decoded for every chunk
+            self._read(2 * (len(self.buffer) - self.pos) + 1)
+
+    def batches(self):
+        """Yield lists of the items of an array (its '[' must be already taken) with their JSON text.
+        The buffered items are decoded with one json.loads call: the text is cut at the array end
+        or after the last complete item. A cut inside a string or a nested value is never valid
+        JSON, so a wrong cut is detected by the decoder; then items are decoded one by one
+        until the cut position."""
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        single_buffer, single_until = None, 0
+        while True:
+            buffer, pos = self.buffer, self.pos
+            batch = None
+            if buffer is not single_buffer or pos >= single_until:
+                cuts = (buffer.find(']', pos), buffer.rfind('}', pos) + 1, buffer.rfind(']', pos) + 1,
+                        buffer.rfind(',', pos))
+                for cut in sorted({cut for cut in cuts if cut > pos}, key=cuts.index):
+                    batch = _loads_items(buffer, pos, cut)
+                    if batch:
+                        self.pos = cut
+                        break
+                else:
+                    single_buffer, single_until = buffer, max(cuts)
+            if batch:
+                yield batch
+            else:
+                value, text = self.value()
+                yield [value], f'[{text}]'
+            separator = self.take()
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError("Invalid JSON: expected ',' or ']'")
+            self.peek()
+
+
+def _loads_items(buffer, start, end):
+    """Return (items, JSON array text) if buffer[start:end] is a list of complete items, else None."""
+    text = f'[{buffer[start:end]}]'
+    try:
+        items = json.loads(text)
+    except ValueError:
+        return None
+    return (items, text) if items else None
+
+
+class StreamedTable:
+    """(columns, rows) of a JSON result spilled to temp files. Use it as a context manager,
+    the files are removed on exit. rows() reads rows back from the files."""
+
+    def __init__(self, spill_dir=REPORT_SPILL_DIR):
+        self.spill_dir = spill_dir
+        self.columns = []
+        self.files = []
+        self.kind = None
+        self.width = 0
+        self.record = None
+        # Columns given as a scalar (index in columns -> value) and the number of rows
+        self.constants = {}
+        self.length = 0
+
+    def new_file(self):
+        f = tempfile.TemporaryFile('w+', encoding='utf-8', newline='\n', dir=self.spill_dir)
+        self.files.append(f)
+        return f
+
+    def rows(self):
+        """Yield rows as tuples in columns order."""
+        if self.kind == 'record':
+            yield self.record
+            return
+        for f in self.files:
+            f.flush()
+            f.seek(0)
+        if self.kind == 'columns':
+            files = iter(self.files)
+            yield from zip(*[repeat(self.constants[i], self.length) if i in self.constants
+                             else _load_values(next(files)) for i in range(len(self.columns))])
+        elif self.kind == 'rows':
+            padding = [(None,) * n for n in range(self.width + 1)]
+            for row in _load_values(self.files[0]):
+                yield tuple(row) + padding[self.width - len(row)]
+        elif self.files:
+            columns = self.columns
+            for record in _load_values(self.files[0]):
+                yield tuple(record.get(column) for column in columns)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def _load_values(f):
+    """Yield values of a spilled file."""
+    for line in f:
+        yield from json.loads(line)
+
+
+def _spill(f, text):
+    # Newlines of JSON text can only be whitespace, so a batch is one line
+    f.write(text.replace('\n', ' '))
+    f.write('\n')
+
+
+def _spill_list(reader, table):
+    """Array of records (dicts) or of rows (lists)."""
+    f = table.new_file()
+    columns = {}
+    for values, text in reader.batches():
+        for value in values:
+            kind = 'records' if type(value) is dict else 'rows' if type(value) is list else None
+            if kind is None or (table.kind and kind != table.kind):
+                raise UnsupportedShape("array items are not all records or all rows")
+            table.kind = kind
+            if kind == 'records':
+                columns.update(dict.fromkeys(value))
+            else:
+                table.width = max(table.width, len(value))
+        _spill(f, text)
+    table.columns = list(columns) if table.kind != 'rows' else list(range(table.width))
+
+
+class _Constant:
+    """Scalar value of a column object, repeated in every row."""
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _spill_object(reader, table):
+    """Object of columns (arrays of equal length, scalars are repeated) or a single record."""
+    if reader.peek() == '}':
+        raise UnsupportedShape("empty object")
+    sources = {}
+    lengths = {}
+    values = {}
+    while True:
+        key, _ = reader.value()
+        if type(key) is not str:
+            raise ValueError("Invalid JSON: expected an object key")
+        reader.expect(':')
+        if table.kind is None:
+            table.kind = 'columns' if reader.peek() == '[' else 'record'
+        if table.kind == 'record':
+            values[key] = reader.value()[0]
+        else:
+            if key in sources and not isinstance(sources[key], _Constant):
+                sources[key].close()
+            lengths.pop(key, None)
+            if reader.peek() == '[':
+                reader.take()
+                sources[key] = f = table.new_file()
+                lengths[key] = 0
+                for values, text in reader.batches():
+                    _spill(f, text)
+                    lengths[key] += len(values)
+            else:
+                value, _ = reader.value()
+                if type(value) is dict:
+                    # pandas would align it by index
+                    raise UnsupportedShape("object values are arrays and objects")
+                sources[key] = _Constant(value)
+        separator = reader.take()
+        if separator == '}':
+            break
+        if separator != ',':
+            raise ValueError("Invalid JSON: expected ',' or '}'")
+    if table.kind == 'record':
+        table.columns = list(values)
+        table.record = tuple(values.values())
+    else:
+        if not lengths:
+            raise UnsupportedShape("object values are not arrays")
+        if len(set(lengths.values())) > 1:
+            raise UnsupportedShape("columns have different lengths")
+        # A repeated key replaces the column, like in json.loads
+        table.columns = list(sources)
+        table.files = [source for source in sources.values() if not isinstance(source, _Constant)]
+        table.constants = {i: source.value for i, source in enumerate(sources.values())
+                           if isinstance(source, _Constant)}
+        table.length = next(iter(lengths.values()))
+
+
+def spill_table(chunks, spill_dir=REPORT_SPILL_DIR):
+    """Parse a JSON result from text chunks into a StreamedTable.
+    Shapes are those of report_writers.table_from_result: list of records, list of rows,
+    dict of lists (columns, scalars are repeated) and a single record.
+    Raise UnsupportedShape for other shapes and ValueError for invalid JSON."""
+    reader = _Reader(chunks)
+    table = StreamedTable(spill_dir)
+    try:
+        first = reader.take()
+        if first == '[':
+            _spill_list(reader, table)
+        elif first == '{':
+            _spill_object(reader, table)
+        elif not first:
+            raise ValueError("Invalid JSON: empty result")
+        else:
+            raise UnsupportedShape("result is not an array or an object")
+        if reader.peek():
+            raise ValueError("Invalid JSON: extra data after the result")
+    except Exception:
+        table.close()
+        raise
+    return table
+
+
+def _spill_saved(body_path, encoding, label=''):
+    """spill_table of a saved body. Errors get the label of the result in their label attribute."""
+    try:
+        return spill_table(iter_file_text(body_path, encoding))
+    except UnsupportedShape as e:
+        e.label = label
+        raise
+    except ValueError as e:
+        # A decoder error holds the parsed text, only the message is sent back from the CPU pool
+        error = ValueError(str(e))
+        error.label = label
+        raise error from None
+
+
+def write_result_report(body_path, encoding, file_path, report_format, index=False):
+    """Write the result saved in body_path to a report file (see report_writers.write_report).
+    Parsing and writing take CPU time, flask_app runs this in cpu_pool."""
+    with _spill_saved(body_path, encoding) as table:
+        write_report(file_path, report_format, table.columns, table.rows(), index=index)
+
+
+def write_results_xlsx(file_path, results):
+    """Write results saved by save_body to one workbook, a sheet per result.
+    results is a list of (sheet_name, label, body_path, encoding), label is used in errors."""
+    with ExitStack() as tables:
+        sheets = []
+        for sheet_name, label, body_path, encoding in results:
+            table = tables.enter_context(_spill_saved(body_path, encoding, label))
+            sheets.append((sheet_name, table.columns, table.rows(), True))
+        write_xlsx(file_path, sheets)
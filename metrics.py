@@ -0,0 +1,39 @@
+"""Prometheus metrics of the app, served by /metrics.
+
+Under gunicorn PROMETHEUS_MULTIPROC_DIR is set (see gunicorn.conf.py): every worker writes
+its samples to files there and /metrics aggregates the files of all workers. Without it
+samples are kept in process memory (python postgres.py, benchmarks).
+
+files_load_api_stage_seconds stages: 'read', 'transform', 'sink' are the processor stage
+calls; for streamed file groups rows are parsed, validated and mapped while they are
+consumed, so that time is in 'sink' and in its 'copy' part. 'parse', 'validate', 'post',
+'copy' and 'merge' are measured inside the stages."""
+import os
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, \
+    generate_latest, multiprocess
+
+# Upper bounds of latency buckets in seconds, from cached lookups to long uploads and loads
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+ACQUIRE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REQUEST_SECONDS = Histogram('files_load_api_request_seconds', "Request latency by route (until the response starts)",
+                            ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+UPLOAD_BYTES = Counter('files_load_api_upload_bytes', "Bytes of uploaded files by table", ['table'])
+STAGE_SECONDS = Histogram('files_load_api_stage_seconds', "Time of file processing stages",
+                          ['file_group', 'stage'], buckets=LATENCY_BUCKETS)
+DB_ACQUIRE_SECONDS = Histogram('files_load_api_db_acquire_seconds', "Time to check out a connection from the pool",
+                               buckets=ACQUIRE_BUCKETS)
+CACHE_EVENTS = Counter('files_load_api_cache_events', "Hits, misses, stores and evictions of the on-disk caches",
+                      ['cache', 'event'])
+UPSTREAM_SECONDS = Histogram('files_load_api_upstream_seconds',
+                             "Outbound HTTP latency by endpoint (until response headers), one sample per attempt",
+                             ['method', 'endpoint', 'status'], buckets=LATENCY_BUCKETS)
+
+
+def generate():
+    """Return (body, content type) with the metrics of all workers."""
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -1,21 +1,133 @@
+"""Process-wide logging setup.
+
+Loggers only put records on a queue (QueueHandler), a single listener thread per process
+formats them and writes to the log file and stderr, so requests never wait on file I/O.
+Under gunicorn every worker gets its own listener after fork."""
+import os
+import sys
+import json
+import queue
+import atexit
 import logging
+import threading
+import traceback
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, WatchedFileHandler
+
+# Level of all app loggers: DEBUG, INFO, WARNING, ERROR or CRITICAL
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+# 'json' (one object per line) or 'text'
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Log file; empty to log to stderr only
+LOG_FILE = os.getenv('LOG_FILE', 'files_load_api.log')
+# By default every process writes its own file, with the pid before the extension (files_load_api.1234.log),
+# and rotates it. '0' makes all processes append to LOG_FILE, which the app does not rotate (processes
+# would rotate it under each other): it is reopened after an external logrotate
+LOG_FILE_PER_PROCESS = (os.getenv('LOG_FILE_PER_PROCESS') or '1').lower() not in ('0', 'false')
+# Size of a per-process file when it is rotated, 0 to never rotate. Files of exited processes are
+# kept, up to LOG_MAX_BYTES * (LOG_BACKUP_COUNT + 1) each
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', 100 * 1024 ** 2))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', 5))
+
+TEXT_FORMAT = '%(asctime)s:%(levelname)s:%(module)s - %(funcName)s - %(message)s'
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def format(self, record):
+        entry = {'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+                 'level': record.levelname, 'logger': record.name, 'module': record.module,
+                 'function': record.funcName, 'pid': record.process, 'thread': record.threadName,
+                 'message': record.getMessage()}
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """Puts records on the process queue. The message and traceback are rendered in the caller
+    (arguments may change after the call), the rest of formatting is left to the listener."""
+
+    def prepare(self, record):
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = ''.join(traceback.format_exception(*record.exc_info)).rstrip('\n')
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg, record.args, record.exc_info, record.exc_text = message, None, None, exc_text
+        return record
+
+
+def _file_path():
+    if not LOG_FILE_PER_PROCESS:
+        return LOG_FILE
+    base, extension = os.path.splitext(LOG_FILE)
+    return f"{base}.{os.getpid()}{extension}"
+
+
+def _make_handlers():
+    formatter = JsonFormatter() if LOG_FORMAT == 'json' else logging.Formatter(TEXT_FORMAT)
+    handlers = [logging.StreamHandler(sys.stderr)]
+    if LOG_FILE:
+        if LOG_FILE_PER_PROCESS and LOG_MAX_BYTES:
+            handlers.append(RotatingFileHandler(_file_path(), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                                encoding='utf-8'))
+        else:
+            handlers.append(WatchedFileHandler(_file_path(), encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+_handler = _QueueHandler(queue.SimpleQueue())
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def _start_listener():
+    global _listener
+    with _listener_lock:
+        if _listener is None:
+            _listener = QueueListener(_handler.queue, *_make_handlers(), respect_handler_level=True)
+            _listener.start()
+
+
+def stop_listener():
+    """Write the queued records and stop the listener thread."""
+    global _listener
+    with _listener_lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            _listener = None
+
+
+def _reset_after_fork():
+    # The listener thread is not copied by fork: the child gets a new queue
+    # (records queued by the parent stay with the parent) and its own listener
+    global _listener, _listener_lock
+    started = _listener is not None
+    _handler.queue = queue.SimpleQueue()
+    _listener = None
+    _listener_lock = threading.Lock()
+    if started:
+        _start_listener()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+atexit.register(stop_listener)
 
 
-def init_logger(name):
+def init_logger(name, level=None):
+    """Return logger name writing through the process log queue, at level (LOG_LEVEL by default).
+    Repeated calls don't add handlers."""
     logger = logging.getLogger(name)
-    logger.setLevel(logging.DEBUG)
-    # create file and stream handlers and set level to debug
-    fh = logging.FileHandler(filename='files_load_api.log')
-    sh = logging.StreamHandler()
-    fh.setLevel(logging.DEBUG)
-    sh.setLevel(logging.DEBUG)
-    # create formatter
-    formatter = logging.Formatter('%(asctime)s:%(levelname)s:%(module)s - %(funcName)s - %(message)s')
-    # add formatter to fh and sh
-    fh.setFormatter(formatter)
-    sh.setFormatter(formatter)
-    # add fh and sh to logger
-    logger.addHandler(fh)
-    logger.addHandler(sh)
+    logger.setLevel(level or LOG_LEVEL)
+    if _handler not in logger.handlers:
+        logger.addHandler(_handler)
     logger.propagate = False
+    _start_listener()
     return logger
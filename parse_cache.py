@@ -0,0 +1,121 @@
+import os
+import threading
+import tempfile
+import numpy as np
+import my_logger
+import metrics
+
+# Parsed and validated columns of uploaded files, keyed by file content hash
+PARSE_CACHE_DIR = os.getenv('PARSE_CACHE_DIR', './files_storage/parse_cache')
+PARSE_CACHE_MAX_BYTES = int(os.getenv('PARSE_CACHE_MAX_BYTES', 512 * 1024 ** 2))
+
+logger = my_logger.init_logger("parse_cache")
+
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+
+
+def _count(name, value=1):
+    with _stats_lock:
+        _stats[name] += value
+    metrics.CACHE_EVENTS.labels('parse', name).inc(value)
+
+
+def stats():
+    """Return hit/miss counters of this process and the current cache size on disk."""
+    with _stats_lock:
+        result = dict(_stats)
+    entries = _entries()
+    result['entries'] = len(entries)
+    result['bytes'] = sum(size for _, size, _ in entries)
+    return result
+
+
+def _entry_path(key):
+    return os.path.join(PARSE_CACHE_DIR, f'{key}.npz')
+
+
+def _entries():
+    """Return list of (path, size, mtime) of cache entries."""
+    entries = []
+    try:
+        with os.scandir(PARSE_CACHE_DIR) as it:
+            for entry in it:
+                if entry.name.endswith('.npz'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, stat.st_size, stat.st_mtime))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def _to_array(values):
+    """Convert a list to a fixed-type array that can be saved without pickle.
+    Return None for mixed or unsupported types."""
+    value_types = {type(value) for value in values}
+    if len(value_types) > 1 or not value_types <= {int, float, str, bool}:
+        # np.asarray would silently turn e.g. [1, 'a'] into strings
+        return None
+    array = np.asarray(values)
+    if array.dtype.kind in 'biufU':
+        return array
+    return None
+
+
+def get(key):
+    """Return dict of column name -> list for key, or None on a miss."""
+    path = _entry_path(key)
+    try:
+        with np.load(path, allow_pickle=False) as data:
+            columns = {name: data[name].tolist() for name in data.files}
+    except (FileNotFoundError, OSError, ValueError):
+        _count('misses')
+        return None
+    try:
+        os.utime(path)  # mtime is the LRU clock
+    except FileNotFoundError:
+        pass
+    _count('hits')
+    return columns
+
+
+def put(key, columns):
+    """Store dict of column name -> list under key. Columns of mixed types are not cached."""
+    arrays = {}
+    for name, values in columns.items():
+        array = _to_array(values)
+        if array is None:
+            logger.debug(f"Column {name} of {key} has mixed types, not cached.")
+            return
+        arrays[name] = array
+    os.makedirs(PARSE_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=PARSE_CACHE_DIR, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, _entry_path(key))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    _count('stores')
+    evict()
+
+
+def evict(max_bytes=PARSE_CACHE_MAX_BYTES):
+    """Remove least recently used entries until the cache fits in max_bytes."""
+    entries = _entries()
+    total = sum(size for _, size, _ in entries)
+    if total <= max_bytes:
+        return
+    for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        _count('evictions')
+        total -= size
+        if total <= max_bytes:
+            break
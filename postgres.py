@@ -1,8 +1,12 @@
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
 import traceback
 import os
+import threading
+import time
 import my_logger
+import metrics
 import csv
 from pathlib import Path
 from io import StringIO
@@ -23,22 +27,246 @@ sqlalch_db_conn_str = (f'postgresql://{os.getenv("PG_USER")}:{os.getenv("PG_PASS
                        f'@{os.getenv("PG_HOST")}:{os.getenv("PG_PORT")}/{os.getenv("PG_DB")}')
 connection_args = {'sslmode': os.getenv('SSLMODE'),
                    'target_session_attrs': os.getenv('TARGET_SESSION_ATTRS')}
+# Connection pool settings (per process, i.e. per gunicorn worker)
+PG_POOL_MIN_SIZE = int(os.getenv('PG_POOL_MIN_SIZE', 1))
+PG_POOL_MAX_SIZE = int(os.getenv('PG_POOL_MAX_SIZE', 10))
+PG_POOL_TIMEOUT = float(os.getenv('PG_POOL_TIMEOUT', 30))
+# Idle connections older than this (seconds) are pinged before being handed out
+PG_POOL_CHECK_INTERVAL = float(os.getenv('PG_POOL_CHECK_INTERVAL', 30))
+# NOTIFY channel for deleted file rows, payload is '<table_name>:<file_id>'
+FILE_INFO_CHANNEL = 'file_info_changed'
+# Returned by queries whose result can be None, when the query failed
+QUERY_FAILED = object()
 
 
 # create logger
 logger = my_logger.init_logger("postgres")
 
 
+class PoolTimeout(psycopg2.pool.PoolError):
+    """No connection became available within the pool timeout."""
+
+
+class ConnectionPool:
+    """Thread-safe pool of psycopg2 connections.
+
+    Idle connections are checked before checkout: closed or broken ones are discarded
+    and the ones idle longer than check_interval are pinged with 'SELECT 1'.
+    When the pool is exhausted, getconn waits up to timeout seconds for a free connection."""
+
+    def __init__(self, connection_string, min_size=PG_POOL_MIN_SIZE, max_size=PG_POOL_MAX_SIZE,
+                 timeout=PG_POOL_TIMEOUT, check_interval=PG_POOL_CHECK_INTERVAL):
+        self.connection_string = connection_string
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = []  # list of (connection, last_used)
+        self._in_use = set()
+        self._size = 0  # open connections + connections being opened
+        self._waiting = 0
+        self._created = 0
+        self._discarded = 0
+        self._timeouts = 0
+        for _ in range(self.min_size):
+            try:
+                self._idle.append((self._new_connection(), time.monotonic()))
+            except (Exception, psycopg2.Error) as error:
+                logger.critical(repr(error))
+                break
+
+    def _new_connection(self):
+        connection = psycopg2.connect(self.connection_string)
+        with self._cond:
+            self._size += 1
+            self._created += 1
+        return connection
+
+    def _is_healthy(self, connection, last_used):
+        if connection.closed:
+            return False
+        if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - last_used < self.check_interval:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1;")
+            cursor.close()
+            connection.rollback()
+            return True
+        except (Exception, psycopg2.Error) as error:
+            logger.warning(f"Discarding broken connection: {error!r}")
+            return False
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except (Exception, psycopg2.Error):
+            pass
+        with self._cond:
+            self._size -= 1
+            self._discarded += 1
+            self._cond.notify()
+
+    def getconn(self):
+        """Check out a healthy connection, opening a new one if the pool is not full."""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(f"No connection available in {self.timeout}s "
+                                          f"(max_size={self.max_size}).")
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                if self._idle:
+                    connection, last_used = self._idle.pop()
+                else:
+                    connection = None
+                    self._size += 1  # reserve a slot before connecting outside the lock
+            if connection is None:
+                try:
+                    connection = psycopg2.connect(self.connection_string)
+                except BaseException:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._created += 1
+                    self._in_use.add(connection)
+                return connection
+            # Health check is done outside the lock, it may hit the network
+            if self._is_healthy(connection, last_used):
+                with self._cond:
+                    self._in_use.add(connection)
+                return connection
+            self._discard(connection)
+
+    def putconn(self, connection):
+        """Return connection to the pool, rolling back any unfinished transaction."""
+        with self._cond:
+            self._in_use.discard(connection)
+        if os.getpid() != self.pid:
+            # Connection was inherited through fork, leave it to the parent process.
+            return
+        if not connection.closed and \
+                connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except (Exception, psycopg2.Error) as error:
+                logger.warning(f"Rollback failed on connection return: {error!r}")
+        if connection.closed or \
+                connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            self._discard(connection)
+            return
+        with self._cond:
+            self._idle.append((connection, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._discard(connection)
+
+    def stats(self):
+        with self._cond:
+            return {"pid": self.pid,
+                    "in_use": len(self._in_use),
+                    "idle": len(self._idle),
+                    "waiting": self._waiting,
+                    "size": self._size,
+                    "min_size": self.min_size,
+                    "max_size": self.max_size,
+                    "created": self._created,
+                    "discarded": self._discarded,
+                    "timeouts": self._timeouts}
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(connection_string):
+    """Return the process-wide pool for connection_string, creating it on first use.
+    A pool inherited from the parent process (gunicorn fork) is never reused."""
+    with _pools_lock:
+        pool = _pools.get(connection_string)
+        if pool is None or pool.pid != os.getpid():
+            pool = ConnectionPool(connection_string)
+            _pools[connection_string] = pool
+        return pool
+
+
+def get_pool_stats():
+    with _pools_lock:
+        pools = [pool for pool in _pools.values() if pool.pid == os.getpid()]
+    return [pool.stats() for pool in pools]
+
+
+# Pools inherited from the parent process. Deallocating a psycopg2 connection closes it,
+# which would send Terminate on the socket shared with the parent: the child keeps them
+# referenced and never uses them.
+_inherited_pools = []
+
+
+def _detach_connection(connection):
+    """Point the child's copy of the connection socket to /dev/null,
+    so that nothing the child does with it reaches the parent's server session."""
+    try:
+        fd = connection.fileno()
+    except (Exception, psycopg2.Error):
+        return
+    devnull = os.open(os.devnull, os.O_RDWR)
+    try:
+        os.dup2(devnull, fd)
+    finally:
+        os.close(devnull)
+
+
+def _reset_pools_after_fork():
+    # Connections opened by the parent must not be used (or closed) by the child:
+    # closing them would terminate the parent's server sessions.
+    global _pools, _pools_lock
+    for pool in _pools.values():
+        for connection in [connection for connection, _ in pool._idle] + list(pool._in_use):
+            _detach_connection(connection)
+        _inherited_pools.append(pool)
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_pools_after_fork)
+
+
 class DB:
     def __init__(self, connection_string):
         self.connection_string = connection_string
         self.connection = None
+        self.pool = None
         self.connect()
 
     def connect(self):
+        """Check out a connection from the process-wide pool. Raise PoolTimeout if none is free in time."""
         if not self.connection:
             try:
-                self.connection = psycopg2.connect(self.connection_string)
+                self.pool = get_pool(self.connection_string)
+                with metrics.DB_ACQUIRE_SECONDS.time():
+                    self.connection = self.pool.getconn()
+            except PoolTimeout as error:
+                # All connections are busy: the caller can't run without one, flask_app answers 503
+                logger.error(repr(error))
+                raise
             except (Exception, psycopg2.Error) as error:
                 logger.critical(repr(error))
         return self.connection
@@ -56,11 +284,13 @@ class DB:
                                      client_id INT,
                                      creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                                      file_group VARCHAR,
-                                     file_path VARCHAR);""")
+                                     file_path VARCHAR,
+                                     sha256 VARCHAR);""")
             self.connection.commit()
             cursor.close()
         except (Exception, psycopg2.Error) as error:
             logger.critical(repr(error))
+        self.create_files_list_index('client_report_files')
 
     def get_list_of_client_report_files(self, client_id):
         files = []
@@ -75,15 +305,20 @@ class DB:
             logger.error(repr(error))
         return files
 
-    def insert_file_info_into_client_report_files_table(self, filename, client_id, file_group, file_path):
+    def insert_file_info_into_client_report_files_table(self, filename, client_id, file_group, file_path, sha256=None):
+        """Return file_id of the saved row, None if it is not saved."""
         try:
             cursor = self.connection.cursor()
-            cursor.execute("""INSERT INTO client_report_files (filename, client_id, file_group, file_path)
-                              VALUES (%s, %s, %s, %s);""", (filename, client_id, file_group, file_path))
+            cursor.execute("""INSERT INTO client_report_files (filename, client_id, file_group, file_path, sha256)
+                              VALUES (%s, %s, %s, %s, %s)
+                           RETURNING file_id;""", (filename, client_id, file_group, file_path, sha256))
+            file_id = cursor.fetchone()[0]
             self.connection.commit()
             cursor.close()
+            return file_id
         except (Exception, psycopg2.Error) as error:
             logger.error(repr(error))
+        return None
 
     def get_file_path_from_client_report_files_table(self, file_id):
         file_path = ""
@@ -108,17 +343,18 @@ class DB:
                                      filename VARCHAR,
                                      creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                                      file_group VARCHAR,
-                                     file_path VARCHAR);""")
+                                     file_path VARCHAR,
+                                     sha256 VARCHAR);""")
             self.connection.commit()
             cursor.close()
         except (Exception, psycopg2.Error) as error:
             logger.critical(repr(error))
 
-    def insert_file_info_into_templates_table(self, filename, file_group, file_path):
+    def insert_file_info_into_templates_table(self, filename, file_group, file_path, sha256=None):
         try:
             cursor = self.connection.cursor()
-            cursor.execute("""INSERT INTO file_templates (filename, file_group, file_path)
-                              VALUES (%s, %s, %s);""", (filename, file_group, file_path))
+            cursor.execute("""INSERT INTO file_templates (filename, file_group, file_path, sha256)
+                              VALUES (%s, %s, %s, %s);""", (filename, file_group, file_path, sha256))
             self.connection.commit()
             cursor.close()
         except (Exception, psycopg2.Error) as error:
@@ -160,21 +396,26 @@ class DB:
                                      client_id INT,
                                      creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                                      file_group VARCHAR,
-                                     file_path VARCHAR);""")
+                                     file_path VARCHAR,
+                                     sha256 VARCHAR);""")
             self.connection.commit()
             cursor.close()
         except (Exception, psycopg2.Error) as error:
             logger.critical(repr(error))
+        self.create_files_list_index('client_files')
 
-    def insert_file_info_into_client_files_table(self, filename, client_id, file_group, file_path):
+    def insert_file_info_into_client_files_table(self, filename, client_id, file_group, file_path, sha256=None):
+        """Return True if the row is saved."""
         try:
             cursor = self.connection.cursor()
-            cursor.execute("""INSERT INTO client_files (filename, client_id, file_group, file_path)
-                              VALUES (%s, %s, %s, %s);""", (filename, client_id, file_group, file_path))
+            cursor.execute("""INSERT INTO client_files (filename, client_id, file_group, file_path, sha256)
+                              VALUES (%s, %s, %s, %s, %s);""", (filename, client_id, file_group, file_path, sha256))
             self.connection.commit()
             cursor.close()
+            return True
         except (Exception, psycopg2.Error) as error:
             logger.error(repr(error))
+        return False
 
     def get_list_of_client_files(self, client_id):
         files = []
@@ -203,14 +444,168 @@ class DB:
             logger.error(repr(error))
         return file_path
 
-    def delete_from_table(self, table_name, file_id):
+    def create_files_list_index(self, table_name):
+        """Create index for keyset pagination of client's files list (see iter_files_list)."""
         try:
             cursor = self.connection.cursor()
-            cursor.execute(f"DELETE FROM {table_name} WHERE file_id = {file_id};")
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS {table_name}_client_id_creation_date_idx
+                                   ON {table_name} (client_id, creation_date, file_id);""")
             self.connection.commit()
             cursor.close()
+        except (Exception, psycopg2.Error) as error:
+            logger.critical(repr(error))
+
+    @staticmethod
+    def _files_list_conditions(client_id, file_group=None, date_from=None, date_to=None, after=None):
+        """Return WHERE clause and params; after is the (creation_date, file_id) key of the previous page end."""
+        conditions = ["client_id = %s"]
+        params = [client_id]
+        if file_group is not None:
+            conditions.append("file_group = %s")
+            params.append(file_group)
+        if date_from is not None:
+            conditions.append("creation_date >= %s")
+            params.append(date_from)
+        if date_to is not None:
+            conditions.append("creation_date < %s")
+            params.append(date_to)
+        if after is not None:
+            # Newest files first
+            conditions.append("(creation_date, file_id) < (%s, %s)")
+            params.extend(after)
+        return " AND ".join(conditions), params
+
+    def get_files_list_page_end(self, table_name, client_id, limit, **filters):
+        """Return (creation_date, file_id) key of the last file of the page, None if
+        the page is the last one or QUERY_FAILED on error. Takes at most limit + 1 index entries."""
+        page_end = QUERY_FAILED
+        try:
+            conditions, params = self._files_list_conditions(client_id, **filters)
+            cursor = self.connection.cursor()
+            cursor.execute(f"""SELECT creation_date, file_id
+                                 FROM {table_name}
+                                WHERE {conditions}
+                                ORDER BY creation_date DESC, file_id DESC
+                               OFFSET %s LIMIT 2;""", params + [limit - 1])
+            rows = cursor.fetchall()
+            cursor.close()
+            page_end = rows[0] if len(rows) == 2 else None
         except (Exception, psycopg2.Error) as error:
             logger.error(repr(error))
+        return page_end
+
+    def iter_files_list(self, table_name, client_id, page_end=None, itersize=1000, **filters):
+        """Yield file info dicts of client's files, newest first, down to page_end key (inclusive).
+        Rows are fetched in batches of itersize through a server-side cursor."""
+        conditions, params = self._files_list_conditions(client_id, **filters)
+        if page_end is not None:
+            conditions += " AND (creation_date, file_id) >= (%s, %s)"
+            params.extend(page_end)
+        dict_cursor = self.connection.cursor(name=f'{table_name}_list',
+                                             cursor_factory=psycopg2.extras.RealDictCursor)
+        dict_cursor.itersize = itersize
+        try:
+            dict_cursor.execute(f"""SELECT filename, client_id, creation_date, file_group, file_id
+                                      FROM {table_name}
+                                     WHERE {conditions}
+                                     ORDER BY creation_date DESC, file_id DESC;""", params)
+            yield from dict_cursor
+        finally:
+            try:
+                dict_cursor.close()
+            except psycopg2.Error:
+                pass
+            # End the transaction of the named cursor
+            self.connection.rollback()
+
+    def get_file_info_from_table(self, table_name, file_id):
+        """Return dict with filename, file_path, sha256 and creation_date of the file or None."""
+        file_info = None
+        try:
+            dict_cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            dict_cursor.execute(f"""SELECT filename, file_path, sha256, creation_date
+                                      FROM {table_name}
+                                     WHERE file_id = %s;""", (file_id,))
+            file_info = dict_cursor.fetchone()
+            dict_cursor.close()
+        except (Exception, psycopg2.Error) as error:
+            logger.error(repr(error))
+        return file_info
+
+    def create_file_blobs_table(self):
+        """Create table in db for content-addressed file blobs and add sha256 column
+        to files tables (blob reference for client files, ETag for all files)."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""CREATE TABLE IF NOT EXISTS file_blobs (
+                                     sha256 VARCHAR PRIMARY KEY,
+                                     file_path VARCHAR,
+                                     size BIGINT,
+                                     ref_count INT,
+                                     creation_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP);""")
+            cursor.execute("""ALTER TABLE client_report_files ADD COLUMN IF NOT EXISTS sha256 VARCHAR;""")
+            cursor.execute("""ALTER TABLE client_files ADD COLUMN IF NOT EXISTS sha256 VARCHAR;""")
+            cursor.execute("""ALTER TABLE file_templates ADD COLUMN IF NOT EXISTS sha256 VARCHAR;""")
+            self.connection.commit()
+            cursor.close()
+        except (Exception, psycopg2.Error) as error:
+            logger.critical(repr(error))
+
+    def acquire_file_blob(self, sha256, file_path, size):
+        """Add a reference to the blob, registering it if it is new.
+        Return (blob file_path, is_new) or (None, False) on error.
+        Does not commit: the blob row stays locked until the caller commits,
+        which serializes it with a concurrent release of the same blob."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""INSERT INTO file_blobs (sha256, file_path, size, ref_count)
+                              VALUES (%s, %s, %s, 1)
+                              ON CONFLICT (sha256) DO UPDATE SET ref_count = file_blobs.ref_count + 1
+                              RETURNING file_path, ref_count = 1;""", (sha256, file_path, size))
+            blob_path, is_new = cursor.fetchone()
+            cursor.close()
+            return blob_path, is_new
+        except (Exception, psycopg2.Error) as error:
+            logger.error(repr(error))
+        return None, False
+
+    def release_file_blob(self, sha256):
+        """Remove a reference to the blob. Return blob file_path if it is not referenced
+        anymore (its row is deleted), None if it still is, QUERY_FAILED on error.
+        Does not commit, like acquire_file_blob."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""UPDATE file_blobs SET ref_count = ref_count - 1
+                               WHERE sha256 = %s
+                           RETURNING file_path, ref_count;""", (sha256,))
+            row = cursor.fetchone()
+            if row and row[1] <= 0:
+                cursor.execute("""DELETE FROM file_blobs WHERE sha256 = %s;""", (sha256,))
+                cursor.close()
+                return row[0]
+            cursor.close()
+            return None
+        except (Exception, psycopg2.Error) as error:
+            logger.error(repr(error))
+        return QUERY_FAILED
+
+    def delete_file_row(self, table_name, file_id):
+        """Delete file row and notify (on commit) other processes caching it. Does not commit.
+        Return dict with sha256 and file_path of the deleted row, None if there was no row
+        (e.g. a concurrent delete got it first), QUERY_FAILED on error."""
+        try:
+            dict_cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            dict_cursor.execute(f"""DELETE FROM {table_name}
+                                     WHERE file_id = %s
+                                 RETURNING sha256, file_path;""", (file_id,))
+            row = dict_cursor.fetchone()
+            if row:
+                dict_cursor.execute("SELECT pg_notify(%s, %s);", (FILE_INFO_CHANNEL, f"{table_name}:{file_id}"))
+            dict_cursor.close()
+            return row
+        except (Exception, psycopg2.Error) as error:
+            logger.error(repr(error))
+        return QUERY_FAILED
 
     def get_client_store_names(self, client_id):
         """Returns list of client store names from account_list table."""
@@ -246,11 +641,170 @@ class DB:
             self.connection.commit()
             cursor.close()
         except (Exception, psycopg2.Error) as e:
-            print("PostgreSQL error:", e)
+            logger.error(repr(e))
+
+    def create_file_jobs_table(self):
+        """Create table in db for background file processing jobs."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""CREATE TABLE IF NOT EXISTS file_jobs (
+                                     job_id VARCHAR PRIMARY KEY,
+                                     client_id INT,
+                                     api_id INT,
+                                     file_group VARCHAR,
+                                     method_name VARCHAR,
+                                     file_path VARCHAR,
+                                     kwargs JSONB,
+                                     status VARCHAR,
+                                     progress INT DEFAULT 0,
+                                     result JSONB,
+                                     error JSONB,
+                                     worker_pid INT,
+                                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP);""")
+            cursor.execute("""CREATE INDEX IF NOT EXISTS file_jobs_status_updated_at_idx
+                                  ON file_jobs (status, updated_at);""")
+            self.connection.commit()
+            cursor.close()
+        except (Exception, psycopg2.Error) as error:
+            logger.critical(repr(error))
+
+    def insert_file_job(self, job):
+        """Return True if the job is saved."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""INSERT INTO file_jobs (job_id, client_id, api_id, file_group, method_name,
+                                                     file_path, kwargs, status, worker_pid)
+                              VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s);""",
+                           (job['job_id'], job['client_id'], job['api_id'], job['file_group'],
+                            job['method_name'], job['file_path'], psycopg2.extras.Json(job['kwargs']),
+                            job['status'], job['worker_pid']))
+            self.connection.commit()
+            cursor.close()
+            return True
+        except (Exception, psycopg2.Error) as error:
+            logger.error(repr(error))
+        return False
+
+    def get_file_job(self, job_id):
+        job = None
+        try:
+            dict_cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            dict_cursor.execute("""SELECT job_id, client_id, api_id, file_group, method_name, file_path, kwargs,
+                                          status, progress, result, error, worker_pid, created_at, updated_at
+                                     FROM file_jobs
+                                    WHERE job_id = %s;""", (job_id,))
+            job = dict_cursor.fetchone()
+            dict_cursor.close()
+        except (Exception, psycopg2.Error) as error:
+            logger.error(repr(error))
+        return job
+
+    def update_file_job(self, job_id, **fields):
+        """Update given job fields, updated_at is always refreshed."""
+        try:
+            cursor = self.connection.cursor()
+            columns = [f"{column} = %s" for column in fields] + ["updated_at = CURRENT_TIMESTAMP"]
+            values = [psycopg2.extras.Json(value) if column in ('result', 'error', 'kwargs') else value
+                      for column, value in fields.items()]
+            cursor.execute(f"""UPDATE file_jobs SET {', '.join(columns)} WHERE job_id = %s;""",
+                           (*values, job_id))
+            self.connection.commit()
+            cursor.close()
+        except (Exception, psycopg2.Error) as error:
+            logger.error(repr(error))
+
+    def claim_file_job(self, job_id, worker_pid):
+        """Atomically move a queued job to running. Return True if this worker got it."""
+        claimed = False
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""UPDATE file_jobs
+                                 SET status = 'running', worker_pid = %s, updated_at = CURRENT_TIMESTAMP
+                               WHERE job_id = %s AND status = 'queued';""", (worker_pid, job_id))
+            claimed = cursor.rowcount == 1
+            self.connection.commit()
+            cursor.close()
+        except (Exception, psycopg2.Error) as error:
+            logger.error(repr(error))
+        return claimed
+
+    def claim_stale_file_job(self, worker_pid, stale_seconds):
+        """Claim one job that nobody is working on: queued or running jobs
+        whose updated_at heartbeat is older than stale_seconds. Return the job or None."""
+        job = None
+        try:
+            dict_cursor = self.connection.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            dict_cursor.execute("""UPDATE file_jobs
+                                      SET status = 'running', worker_pid = %s, updated_at = CURRENT_TIMESTAMP
+                                    WHERE job_id = (SELECT job_id
+                                                      FROM file_jobs
+                                                     WHERE status IN ('queued', 'running')
+                                                       AND updated_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+                                                     ORDER BY created_at
+                                                     LIMIT 1
+                                                       FOR UPDATE SKIP LOCKED)
+                                RETURNING job_id, client_id, api_id, file_group, method_name, file_path, kwargs,
+                                          status, progress, result, error, worker_pid, created_at, updated_at;""",
+                                (worker_pid, stale_seconds))
+            job = dict_cursor.fetchone()
+            self.connection.commit()
+            dict_cursor.close()
+        except (Exception, psycopg2.Error) as error:
+            logger.error(repr(error))
+        return job
+
+    def touch_file_jobs(self, job_ids):
+        """Refresh heartbeat of running jobs."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""UPDATE file_jobs SET updated_at = CURRENT_TIMESTAMP
+                               WHERE job_id = ANY(%s) AND status = 'running';""", (list(job_ids),))
+            self.connection.commit()
+            cursor.close()
+        except (Exception, psycopg2.Error) as error:
+            logger.error(repr(error))
+
+    def create_data_analytics_bydays_main_unique_index(self):
+        """Migration: remove existing duplicates once and create the unique index
+        on the (api_id, sku_id, date, region_id) key used by incremental uploads.
+        The index is built CONCURRENTLY, so the live table stays writable; an invalid
+        index left by a failed build is dropped and built again.
+        Does nothing if a valid index already exists."""
+        try:
+            cursor = self.connection.cursor()
+            cursor.execute("""SELECT i.indisvalid
+                                FROM pg_index i
+                               WHERE i.indexrelid = to_regclass('data_analytics_bydays_main_key_idx');""")
+            row = cursor.fetchone()
+            cursor.close()
+            self.connection.commit()
+            if row and row[0]:
+                return
+            self.delete_duplicates_from_data_analytics_bydays_main_table()
+            # Ends the transaction if the delete failed: CREATE/DROP INDEX CONCURRENTLY
+            # can't run inside a transaction
+            self.connection.rollback()
+            self.connection.autocommit = True
+            try:
+                cursor = self.connection.cursor()
+                if row:
+                    cursor.execute("""DROP INDEX CONCURRENTLY IF EXISTS data_analytics_bydays_main_key_idx;""")
+                cursor.execute("""CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS data_analytics_bydays_main_key_idx
+                                      ON data_analytics_bydays_main (api_id, sku_id, date, region_id);""")
+                cursor.close()
+            finally:
+                self.connection.autocommit = False
+            logger.info("Unique index data_analytics_bydays_main_key_idx is created.")
+        except (Exception, psycopg2.Error) as error:
+            logger.critical(repr(error))
+            self.connection.rollback()
 
     def close(self):
+        """Return the connection to the pool."""
         if self.connection:
-            self.connection.close()
+            self.pool.putconn(self.connection)
+            self.connection = None
 
     def __exit__(self, exc_type, exc_value, tb):
         self.close()
@@ -296,10 +850,16 @@ if __name__ == "__main__":
     Path("./files_storage/client_report_files").mkdir(parents=True, exist_ok=True)
     Path("./files_storage/file_templates").mkdir(parents=True, exist_ok=True)
     Path("./files_storage/clients_files").mkdir(parents=True, exist_ok=True)
+    Path("./files_storage/blobs").mkdir(parents=True, exist_ok=True)
     with DB(db_connection_string) as db:
         # db.create_client_report_files_table()
         # db.create_templates_table()
         # db.create_client_files_table()
+        db.create_file_jobs_table()
+        db.create_file_blobs_table()
+        db.create_files_list_index('client_files')
+        db.create_files_list_index('client_report_files')
+        db.create_data_analytics_bydays_main_unique_index()
         conn = db.connect()
         cur = conn.cursor()
         cur.execute('SELECT version()')
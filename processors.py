@@ -0,0 +1,151 @@
+import os
+import threading
+import importlib
+import my_logger
+import metrics
+
+# Extra modules registering processors for new file groups, e.g. 'ozon_processors,wb_processors'.
+# They are imported on the first processor lookup.
+PROCESSOR_MODULES = [module for module in os.getenv('PROCESSOR_MODULES', '').split(',') if module]
+
+logger = my_logger.init_logger("processors")
+
+ANALYTICS_TABLE = 'data_analytics_bydays_main'
+# Natural key of data_analytics_bydays_main rows, see DB.create_data_analytics_bydays_main_unique_index
+ANALYTICS_KEY_COLUMNS = ['api_id', 'sku_id', 'date', 'region_id']
+
+
+class Processor:
+    """How files of a file_group are processed: reader -> transform -> sink.
+
+    Stages are 'module:function' names (or callables), so the module and the libraries
+    it uses (pandas, SQLAlchemy...) are imported only when the first file is processed.
+    schema is a name in validation.SCHEMAS, options are read by the stages
+    (e.g. url of the http sink, table, copy_format and merge of the copy sink)."""
+
+    def __init__(self, file_group, reader, transform, sink=None, schema=None, message=None, **options):
+        self.file_group = file_group
+        self.reader = reader
+        self.transform = transform
+        self.sink = sink
+        self.schema = schema or file_group
+        self.message = message or f"{file_group} file is processed"
+        self.options = options
+        self._stages = None
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return f"{self.file_group} processor"
+
+    def stages(self):
+        with self._lock:
+            if self._stages is None:
+                self._stages = [_resolve(stage) for stage in (self.reader, self.transform, self.sink)]
+            return self._stages
+
+    def run(self, file_path, client_id=None, api_id=None, progress=None, **kwargs):
+        """Process the file and return result dict with message."""
+        reader, transform, sink = self.stages()
+        context = dict(kwargs, file_path=file_path, client_id=client_id, api_id=api_id, progress=progress)
+        with metrics.STAGE_SECONDS.labels(self.file_group, 'read').time():
+            data = reader(file_path, self, context)
+        with metrics.STAGE_SECONDS.labels(self.file_group, 'transform').time():
+            payload = transform(data, self, context)
+        stats = None
+        if sink:
+            with metrics.STAGE_SECONDS.labels(self.file_group, 'sink').time():
+                stats = sink(payload, self, context)
+        result = {"message": f"Client file: {os.path.basename(file_path)} is successfully saved and {self.message}."}
+        if stats:
+            result['stats'] = stats
+        return result
+
+
+def _resolve(stage):
+    if stage is None or callable(stage):
+        return stage
+    module_name, _, function_name = stage.partition(':')
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+_processors = {}
+_modules_loaded = False
+_modules_lock = threading.Lock()
+
+
+def register(processor):
+    _processors[processor.file_group] = processor
+    return processor
+
+
+def _load_modules():
+    global _modules_loaded
+    with _modules_lock:
+        if _modules_loaded:
+            return
+        for module_name in PROCESSOR_MODULES:
+            try:
+                importlib.import_module(module_name)
+            except ImportError as e:
+                logger.error(f"Unable to load processors from {module_name}: {e!r}")
+        _modules_loaded = True
+
+
+def get_processor(file_group):
+    """Return Processor of file_group or None if files of the group are only stored."""
+    _load_modules()
+    return _processors.get(file_group)
+
+
+def run_processor(file_group, file_path, **kwargs):
+    processor = get_processor(file_group)
+    if processor is None:
+        raise KeyError(f"No processor for file group {file_group}")
+    return processor.run(file_path, **kwargs)
+
+
+register(Processor('price', schema='price', value_key='price', url="",
+                   reader='file_handling_methods:read_offer_values',
+                   transform='file_handling_methods:offer_values_payload',
+                   sink='file_handling_methods:post_json',
+                   message="prices are uploaded"))
+register(Processor('margin', schema='margin', value_key='min_margin', url="",
+                   reader='file_handling_methods:read_offer_values',
+                   transform='file_handling_methods:offer_values_payload',
+                   sink='file_handling_methods:post_json',
+                   message="min margin are uploaded"))
+register(Processor('offers_mapping_table', url="",
+                   reader='file_handling_methods:read_checked_frame',
+                   transform='file_handling_methods:offers_mapping_payload',
+                   sink='file_handling_methods:post_json',
+                   message="offers mapping table are uploaded"))
+register(Processor('yandex_impressions_and_sales',
+                   reader='file_handling_methods:read_checked_rows',
+                   transform='file_handling_methods:map_columns',
+                   sink='file_handling_methods:copy_to_table',
+                   message="impressions and sales are uploaded",
+                   table=ANALYTICS_TABLE, key_columns=ANALYTICS_KEY_COLUMNS, nullable_key_columns=('region_id',),
+                   columns={'Ваш SKU': 'sku_id', 'Название товара': 'sku_name', 'День': 'date',
+                            'ID категории': 'category_id', 'Категория': 'category_name',
+                            'ID бренда': 'brand_id', 'Бренд': 'brand_name',
+                            'Показы': 'session_view', 'Добавлено в корзину, шт.': 'hits_tocart',
+                            'Конверсия добавления в корзину, %': 'conv_tocart', 'Продажи, шт.': 'delivered_units',
+                            'Продажи, руб.': 'revenue', 'ID округа': 'region_id',
+                            'Федеральный округ': 'region_name'}))
+# The report has periods instead of days and ends with a summary row. It fills its own columns
+# of the analytics rows without a region, other columns of existing rows are kept
+register(Processor('yandex_sales_boost',
+                   reader='file_handling_methods:read_report_rows',
+                   transform='file_handling_methods:expand_periods',
+                   sink='file_handling_methods:copy_to_table',
+                   message="sales boost report is uploaded",
+                   table=ANALYTICS_TABLE, key_columns=ANALYTICS_KEY_COLUMNS, nullable_key_columns=('region_id',),
+                   merge='update', id_header='Ваш SKU', period_headers=('Начало периода', 'Конец периода'),
+                   columns={'Ваш SKU': 'sku_id', 'Наименование предложения': 'sku_name',
+                            'Клики по товарам со ставками, шт.': 'hits_view_search', 'Все клики, шт.': 'hits_view',
+                            'Продано всего, шт': 'delivered_units', 'Продано всего, рубли': 'revenue',
+                            'Всего заказано товаров, шт.': 'ordered_units',
+                            'Расход на продвижение, рубли': 'adv_sum_all'},
+                   metrics={'hits_view_search': 0, 'hits_view': 0, 'delivered_units': 0, 'ordered_units': 0,
+                            'revenue': 2, 'adv_sum_all': 2}))
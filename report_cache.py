@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import hashlib
+import uuid
+import threading
+import tempfile
+import my_logger
+import metrics
+from postgres import DB, db_connection_string
+from file_storage import delete_file
+
+# Index of generated report files, shared by all workers through the disk.
+# Expired entries are not reused but stay in the index until evicted, so the byte budget bounds the disk
+# used by generated reports: evicting an entry deletes its report file and client_report_files row.
+REPORT_CACHE_DIR = os.getenv('REPORT_CACHE_DIR', './files_storage/report_cache')
+# Seconds a report is reused for, 0 disables the cache
+REPORT_CACHE_TTL = float(os.getenv('REPORT_CACHE_TTL', 300))
+# Per-method TTL overrides, e.g. '{"/graphs/full": 60, "/graphs/ddr": 0}'
+REPORT_CACHE_TTLS = json.loads(os.getenv('REPORT_CACHE_TTLS', '{}'))
+# Max total size of cached report files
+REPORT_CACHE_MAX_BYTES = int(os.getenv('REPORT_CACHE_MAX_BYTES', 1024 ** 3))
+# Eviction reads every entry, a process runs it once per this many stored reports
+REPORT_CACHE_EVICT_EVERY = int(os.getenv('REPORT_CACHE_EVICT_EVERY', 20))
+
+logger = my_logger.init_logger("report_cache")
+
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_stats_lock = threading.Lock()
+_puts = 0
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+    metrics.CACHE_EVENTS.labels('report', name).inc()
+
+
+def stats():
+    """Return hit/miss counters of this process."""
+    with _stats_lock:
+        return dict(_stats)
+
+
+def ttl(method):
+    return float(REPORT_CACHE_TTLS.get(method, REPORT_CACHE_TTL))
+
+
+def cache_key(method, client_id, report_format, json_data):
+    """Key of a report request; JSON body is canonicalised, so key order and spacing don't matter."""
+    canonical = json.dumps([method, client_id, report_format, json_data],
+                           sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _entry_path(key):
+    return os.path.join(REPORT_CACHE_DIR, f'{key}.json')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def get(method, client_id, report_format, json_data):
+    """Return cached entry dict (file_id, file_path, filename, mimetype, sha256, size, created) or None."""
+    if ttl(method) <= 0:
+        return None
+    path = _entry_path(cache_key(method, client_id, report_format, json_data))
+    try:
+        with open(path, encoding='utf-8') as f:
+            entry = json.load(f)
+    except (FileNotFoundError, ValueError):
+        _count('misses')
+        return None
+    if not os.path.isfile(entry['file_path']):
+        # The report was deleted
+        _remove(path)
+        _count('misses')
+        return None
+    if time.time() - entry['created'] > ttl(method):
+        # The report is kept until evicted, a new one replaces the entry
+        _count('misses')
+        return None
+    try:
+        os.utime(path)  # mtime is the LRU clock
+    except FileNotFoundError:
+        pass
+    _count('hits')
+    return entry
+
+
+def put(method, client_id, report_format, json_data, file_id, file_path, filename, mimetype, sha256=None):
+    """Cache report saved in client_report_files as file_id."""
+    global _puts
+    if ttl(method) <= 0:
+        return
+    entry = {'method': method, 'client_id': client_id, 'file_id': file_id, 'file_path': file_path,
+             'filename': filename, 'mimetype': mimetype, 'sha256': sha256, 'size': os.path.getsize(file_path),
+             'created': time.time()}
+    key = cache_key(method, client_id, report_format, json_data)
+    os.makedirs(REPORT_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=REPORT_CACHE_DIR, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        try:
+            # The expired report stays on disk: its entry is kept under another name, only to be evicted
+            os.rename(_entry_path(key), _entry_path(f'{key}-{uuid.uuid4().hex}'))
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, _entry_path(key))
+    finally:
+        _remove(tmp_path)
+    _count('stores')
+    with _stats_lock:
+        _puts += 1
+        due = _puts % max(REPORT_CACHE_EVICT_EVERY, 1) == 0
+    if due:
+        evict()
+
+
+def evict(max_bytes=REPORT_CACHE_MAX_BYTES):
+    """Delete least recently used reports until cached files fit in max_bytes."""
+    entries = []
+    try:
+        with os.scandir(REPORT_CACHE_DIR) as it:
+            for dir_entry in it:
+                if not dir_entry.name.endswith('.json'):
+                    continue
+                try:
+                    with open(dir_entry.path, encoding='utf-8') as f:
+                        entry = json.load(f)
+                    mtime = dir_entry.stat().st_mtime
+                except (FileNotFoundError, ValueError):
+                    continue
+                if not os.path.isfile(entry['file_path']):
+                    _remove(dir_entry.path)
+                    continue
+                entries.append((mtime, entry['size'], dir_entry.path, entry.get('file_id')))
+    except FileNotFoundError:
+        return
+    total = sum(entry[1] for entry in entries)
+    if total <= max_bytes:
+        return
+    with DB(db_connection_string) as db:
+        for _, size, path, file_id in sorted(entries):
+            if total <= max_bytes:
+                break
+            # Entry first, so it is not served while its report is deleted
+            _remove(path)
+            # Entries of older versions have no file_id, their reports are left alone
+            if file_id is not None and delete_file(db, 'client_report_files', file_id) is None:
+                logger.error(f"Unable to delete evicted report {file_id}.")
+            _count('evictions')
+            total -= size
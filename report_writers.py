@@ -0,0 +1,94 @@
+import csv
+import gzip
+import json
+from itertools import repeat
+
+# format name -> (file extension, mimetype)
+REPORT_FORMATS = {'xlsx': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+                  'csv': ('.csv', 'text/csv'),
+                  'csv.gz': ('.csv.gz', 'application/gzip')}
+
+
+def table_from_result(result):
+    """Return (columns, rows) for JSON result of a graph method without building a dataframe.
+    Handles the same shapes as pd.DataFrame.from_records / from_dict: list of records,
+    dict of lists (columns, scalar values are repeated in every row) and a single record.
+    rows is an iterator of tuples.
+    Return None if result has another shape (e.g. lists of different lengths or objects
+    among the columns, which pandas aligns by index)."""
+    if type(result) is list:
+        if result and all(type(record) is list for record in result):
+            # list of rows without column names
+            columns = list(range(max(len(record) for record in result)))
+            return columns, (tuple(record) + (None,) * (len(columns) - len(record)) for record in result)
+        columns = {}
+        for record in result:
+            if type(record) is not dict:
+                return None
+            columns.update(dict.fromkeys(record))
+        columns = list(columns)
+        return columns, (tuple(record.get(column) for column in columns) for record in result)
+    if type(result) is dict and result:
+        values = list(result.values())
+        if type(values[0]) is list:
+            if any(type(value) is dict or (type(value) is list and len(value) != len(values[0]))
+                   for value in values):
+                return None
+            length = len(values[0])
+            return list(result), zip(*[value if type(value) is list else repeat(value, length) for value in values])
+        return list(result), iter([tuple(values)])
+    return None
+
+
+def _cell_value(value):
+    # Nested JSON can't be written to a cell as is
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+def write_xlsx(file_path, sheets):
+    """Write sheets to xlsx with openpyxl write-only mode: rows are streamed
+    to the file, so memory does not grow with the number of rows.
+    sheets is a list of (sheet_name, columns, rows, index); with index=True
+    a leading 0..n-1 column is added, like df.to_excel does."""
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    for sheet_name, columns, rows, index in sheets:
+        sheet = workbook.create_sheet(title=sheet_name)
+        sheet.append(([None] if index else []) + list(columns))
+        for i, row in enumerate(rows):
+            values = [_cell_value(value) for value in row]
+            sheet.append([i] + values if index else values)
+    workbook.save(file_path)
+
+
+def _write_csv_rows(f, columns, rows):
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_cell_value(value) for value in row])
+
+
+def write_csv(file_path, columns, rows):
+    with open(file_path, 'w', newline='', encoding='utf-8-sig') as f:
+        _write_csv_rows(f, columns, rows)
+
+
+def write_csv_gz(file_path, columns, rows):
+    with gzip.open(file_path, 'wt', newline='', encoding='utf-8-sig', compresslevel=6) as f:
+        _write_csv_rows(f, columns, rows)
+
+
+def write_report(file_path, report_format, columns, rows, index=False, sheet_name='Sheet1'):
+    """Write one table to file_path in report_format (see REPORT_FORMATS).
+    index only applies to xlsx, csv files never get the index column."""
+    if report_format == 'xlsx':
+        write_xlsx(file_path, [(sheet_name, columns, rows, index)])
+    elif report_format == 'csv':
+        write_csv(file_path, columns, rows)
+    elif report_format == 'csv.gz':
+        write_csv_gz(file_path, columns, rows)
+    else:
+        raise ValueError(f"Unknown report format {report_format}")
+
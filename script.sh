@@ -3,4 +3,4 @@
 
 /usr/local/bin/python3 /app/postgres.py
 
-gunicorn -b 0.0.0.0:5000 --timeout 9999 --workers 8 flask_app:app --reload
+gunicorn -c gunicorn.conf.py -b 0.0.0.0:5000 --timeout 9999 --workers 8 flask_app:app --reload
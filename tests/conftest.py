@@ -0,0 +1,28 @@
+import os
+import sys
+
+# The app modules read their settings on import: no log file, jobs kept in memory
+os.environ.setdefault('LOG_FILE', '')
+os.environ.setdefault('JOBS_BACKEND', 'memory')
+os.environ.setdefault('CPU_POOL_WORKERS', '0')
+os.environ.setdefault('JOBS_POOL_WORKERS', '0')
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytest  # noqa: E402
+
+
+@pytest.fixture(scope='session')
+def pg_dsn():
+    """libpq connection string of a scratch database for tests that need Postgres, from TEST_PG_DSN.
+    The tests create the app tables they use; they are skipped without TEST_PG_DSN."""
+    dsn = os.getenv('TEST_PG_DSN')
+    if not dsn:
+        pytest.skip("TEST_PG_DSN is not set")
+    from postgres import DB
+    with DB(dsn) as db:
+        db.create_client_report_files_table()
+        db.create_templates_table()
+        db.create_client_files_table()
+        db.create_file_blobs_table()
+    return dsn
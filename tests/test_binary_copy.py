@@ -0,0 +1,128 @@
+import io
+import struct
+from datetime import date, datetime, timedelta
+import pytest
+import binary_copy
+from postgres import DB
+
+PG_TYPES = ['integer', 'bigint', 'smallint', 'double precision', 'real', 'date', 'timestamp without time zone',
+            'text', 'character varying']
+COLUMNS = [
+    [1, 2, 3, 4],
+    [-2 ** 63, 2 ** 63 - 1, None, 0],
+    [-2 ** 15, None, 2 ** 15 - 1, 7],
+    [0.1, -1e300, None, float('inf')],
+    [None, 0.5, 3.25, -1e-3],
+    [date(2000, 1, 1), date(1999, 12, 31), None, date(2024, 2, 29)],
+    [datetime(2000, 1, 1), None, datetime(1970, 1, 1, 12, 30, 15, 123456), datetime(2038, 1, 19, 3, 14, 8)],
+    ['Молоко 3,2%', '', None, 'tab\t"quote" \\ 日本'],
+    [None, None, None, None],
+]
+DECODERS = {
+    'smallint': lambda raw: struct.unpack('!h', raw)[0],
+    'integer': lambda raw: struct.unpack('!i', raw)[0],
+    'bigint': lambda raw: struct.unpack('!q', raw)[0],
+    'real': lambda raw: struct.unpack('!f', raw)[0],
+    'double precision': lambda raw: struct.unpack('!d', raw)[0],
+    'date': lambda raw: date(2000, 1, 1) + timedelta(days=struct.unpack('!i', raw)[0]),
+    'timestamp without time zone':
+        lambda raw: datetime(2000, 1, 1) + timedelta(microseconds=struct.unpack('!q', raw)[0]),
+    'text': lambda raw: raw.decode('utf-8'),
+    'character varying': lambda raw: raw.decode('utf-8'),
+}
+
+
+def decode(data, pg_types):
+    """Rows of a binary COPY stream, checking the header, the tuple framing and the trailer."""
+    assert data[:11] == b'PGCOPY\n\xff\r\n\x00'
+    assert struct.unpack_from('!ii', data, 11) == (0, 0)
+    pos = 19
+    rows = []
+    while True:
+        (n_fields,) = struct.unpack_from('!h', data, pos)
+        pos += 2
+        if n_fields == -1:
+            break
+        assert n_fields == len(pg_types)
+        row = []
+        for pg_type in pg_types:
+            (length,) = struct.unpack_from('!i', data, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            row.append(DECODERS[pg_type](data[pos:pos + length]))
+            pos += length
+        rows.append(tuple(row))
+    assert pos == len(data)
+    return rows
+
+
+def expected_rows():
+    rows = []
+    for row in zip(*COLUMNS):
+        row = list(row)
+        # real keeps float32 precision
+        row[4] = None if row[4] is None else struct.unpack('!f', struct.pack('!f', row[4]))[0]
+        rows.append(tuple(row))
+    return rows
+
+
+def test_encode_decode():
+    assert decode(binary_copy.encode_columns(COLUMNS, PG_TYPES), PG_TYPES) == expected_rows()
+
+
+def test_columns_without_nulls():
+    columns = [[-2 ** 31, 2 ** 31 - 1], [1.5, -2.5], [date(1900, 3, 1), date(2100, 12, 31)]]
+    pg_types = ['integer', 'double precision', 'date']
+    assert decode(binary_copy.encode_columns(columns, pg_types), pg_types) == list(zip(*columns))
+
+
+def test_integral_floats_in_integer_columns():
+    assert decode(binary_copy.encode_columns([[7.0, None, '12']], ['integer']), ['integer']) == [(7,), (None,), (12,)]
+
+
+def test_no_rows():
+    assert binary_copy.encode_columns([[], []], ['integer', 'text']) == binary_copy.HEADER + binary_copy.TRAILER
+
+
+@pytest.mark.parametrize('values, pg_type', [([2 ** 31], 'integer'), ([-2 ** 15 - 1], 'smallint'),
+                                             ([3, 1.5], 'bigint'), (['x'], 'integer'), ([float('nan')], 'integer')])
+def test_invalid_values(values, pg_type):
+    with pytest.raises((ValueError, TypeError)):
+        binary_copy.encode_columns([values], [pg_type])
+
+
+def to_csv(columns):
+    """CSV of the columns for COPY: NULL is an unquoted empty field, so '' and strings are quoted."""
+    lines = []
+    for row in zip(*columns):
+        fields = []
+        for value in row:
+            if value is None:
+                fields.append('')
+            elif isinstance(value, str):
+                fields.append('"' + value.replace('"', '""') + '"')
+            elif isinstance(value, (date, datetime)):
+                fields.append(value.isoformat())
+            else:
+                fields.append(repr(value))
+        lines.append(','.join(fields))
+    return '\n'.join(lines) + '\n'
+
+
+def test_same_rows_as_csv_copy(pg_dsn):
+    definition = ', '.join(f'c{i} {pg_type}' for i, pg_type in enumerate(PG_TYPES))
+    with DB(pg_dsn) as db:
+        cursor = db.connection.cursor()
+        cursor.execute(f"CREATE TEMP TABLE binary_rows ({definition}); CREATE TEMP TABLE csv_rows ({definition});")
+        cursor.copy_expert("COPY binary_rows FROM STDIN WITH (FORMAT binary);",
+                           io.BytesIO(binary_copy.encode_columns(COLUMNS, PG_TYPES)))
+        cursor.copy_expert("COPY csv_rows FROM STDIN WITH (FORMAT csv);", io.StringIO(to_csv(COLUMNS)))
+        cursor.execute("SELECT * FROM binary_rows ORDER BY c0;")
+        binary_rows = cursor.fetchall()
+        cursor.execute("SELECT * FROM csv_rows ORDER BY c0;")
+        csv_rows = cursor.fetchall()
+        db.connection.rollback()
+    # real is read back from its shortest text, the values are the ones encoded
+    assert binary_rows == csv_rows == list(zip(*COLUMNS))
@@ -0,0 +1,23 @@
+import pytest
+import postgres
+import flask_app
+
+
+@pytest.fixture
+def client(monkeypatch):
+    # No connection slots: getconn times out at once
+    monkeypatch.setattr(postgres, 'get_pool',
+                        lambda connection_string: postgres.ConnectionPool(connection_string, min_size=0, max_size=0,
+                                                                          timeout=0))
+    return flask_app.app.test_client()
+
+
+def test_busy_pool_is_503(client):
+    response = client.get('/client_files/', query_string={'client_id': 1})
+    assert response.status_code == 503
+    assert response.get_json()['code'] == 503
+
+
+def test_db_raises_pool_timeout(client):
+    with pytest.raises(postgres.PoolTimeout):
+        postgres.DB(postgres.db_connection_string)
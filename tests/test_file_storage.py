@@ -0,0 +1,70 @@
+import os
+import uuid
+import threading
+import pytest
+import file_storage
+from postgres import DB
+
+
+@pytest.fixture
+def blobs_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_storage, 'BLOBS_FOLDER', str(tmp_path / 'blobs'))
+    return tmp_path / 'blobs'
+
+
+def add_shared_blob(dsn, copies):
+    """Store one blob referenced by copies client_files rows, return (sha256, blob path, file ids)."""
+    sha256 = uuid.uuid4().hex * 2
+    path = file_storage.blob_path(sha256, '.csv')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write('a,b\n')
+    with DB(dsn) as db:
+        for i in range(copies):
+            db.acquire_file_blob(sha256, path, 4)
+            assert db.insert_file_info_into_client_files_table(f'file {i}.csv', 1, 'test', path, sha256)
+        cursor = db.connection.cursor()
+        cursor.execute("SELECT file_id FROM client_files WHERE sha256 = %s ORDER BY file_id;", (sha256,))
+        file_ids = [row[0] for row in cursor.fetchall()]
+        db.connection.commit()
+    return sha256, path, file_ids
+
+
+def ref_count(dsn, sha256):
+    with DB(dsn) as db:
+        cursor = db.connection.cursor()
+        cursor.execute("SELECT ref_count FROM file_blobs WHERE sha256 = %s;", (sha256,))
+        row = cursor.fetchone()
+        db.connection.commit()
+    return row[0] if row else None
+
+
+def test_concurrent_deletes_release_blob_once(pg_dsn, blobs_folder):
+    sha256, path, (file_id, other_file_id) = add_shared_blob(pg_dsn, 2)
+    barrier = threading.Barrier(2)
+    results = []
+
+    def delete():
+        with DB(pg_dsn) as db:
+            barrier.wait()
+            results.append(file_storage.delete_file(db, 'client_files', file_id))
+
+    threads = [threading.Thread(target=delete) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [False, True]
+    # The other row still references the blob
+    assert ref_count(pg_dsn, sha256) == 1
+    assert os.path.isfile(path)
+
+    with DB(pg_dsn) as db:
+        assert file_storage.delete_file(db, 'client_files', other_file_id) is True
+    assert ref_count(pg_dsn, sha256) is None
+    assert not os.path.exists(path)
+
+
+def test_delete_missing_file(pg_dsn, blobs_folder):
+    with DB(pg_dsn) as db:
+        assert file_storage.delete_file(db, 'client_files', -1) is False
@@ -0,0 +1,144 @@
+import time
+import socket
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+import requests
+from http_client import HttpClient, CircuitBreaker, CircuitOpenError
+
+
+class Handler(BaseHTTPRequestHandler):
+    """/ok echoes the JSON body, /drop reads the body and closes the connection without
+    a response, /unavailable answers 503, /slow answers after 0.5 seconds."""
+    protocol_version = 'HTTP/1.1'
+    calls = Counter()
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        with self.lock:
+            self.calls[self.path] += 1
+        if self.path == '/drop':
+            self.close_connection = True
+            return
+        if self.path == '/slow':
+            time.sleep(0.5)
+        status = 503 if self.path == '/unavailable' else 200
+        data = body or b'{}'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = handle_request
+
+
+@pytest.fixture
+def server():
+    Handler.calls.clear()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def client():
+    return HttpClient(connect_timeout=1, read_timeout=2, retries=2, backoff=0)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_post(server, client):
+    response = client.post(server + '/ok', json={'a': 1})
+    assert response.status_code == 200
+    assert response.json() == {'a': 1}
+    assert client.breaker(server).failures == 0
+
+
+def test_dropped_post_is_not_retried(server, client):
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post(server + '/drop', json={'a': 1})
+    # The server got the body, sending it again could apply it twice
+    assert Handler.calls['/drop'] == 1
+
+
+def test_dropped_idempotent_request_is_retried(server, client):
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.get(server + '/drop')
+    assert Handler.calls['/drop'] == 3
+
+
+def test_refused_post_is_retried(client, monkeypatch):
+    attempts = []
+    send = client._send
+    monkeypatch.setattr(client, '_send', lambda *args, **kwargs: attempts.append(1) or send(*args, **kwargs))
+    with pytest.raises(requests.exceptions.ConnectionError):
+        client.post(f'http://127.0.0.1:{free_port()}/ok', json={'a': 1})
+    assert len(attempts) == 3
+
+
+def test_retry_statuses(server, client):
+    assert client.post(server + '/unavailable', json={}).status_code == 503
+    assert Handler.calls['/unavailable'] == 1
+    assert client.get(server + '/unavailable').status_code == 503
+    assert Handler.calls['/unavailable'] == 4
+
+
+def test_read_timeout(server, client):
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.post(server + '/slow', json={}, timeout=(1, 0.1))
+    assert Handler.calls['/slow'] == 1
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        client.get(server + '/slow', timeout=(1, 0.1))
+    assert Handler.calls['/slow'] == 4
+
+
+def test_circuit_opens_and_closes(server):
+    client = HttpClient(connect_timeout=1, read_timeout=2, retries=0, backoff=0)
+    breaker = client._breakers[server.split('//')[1]] = CircuitBreaker(failure_threshold=2, reset_timeout=0.2)
+    for _ in range(2):
+        client.post(server + '/unavailable', json={})
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        client.post(server + '/ok', json={})
+    assert Handler.calls['/ok'] == 0
+    time.sleep(0.25)
+    assert client.post(server + '/ok', json={}).status_code == 200
+    assert breaker.state == 'closed'
+
+
+def test_request_errors_are_not_successes(server, client):
+    breaker = client.breaker(server)
+    breaker.record_failure()
+    with pytest.raises(requests.exceptions.InvalidHeader):
+        client.get(server + '/ok', headers={'X-Bad': 'a\nb'})
+    assert breaker.failures == 1
+
+
+def test_post_many(server, client):
+    results = client.post_many([(server + '/ok', {'i': i}) for i in range(5)] + [(server + '/drop', {})])
+    assert [result.json() for result in results[:5]] == [{'i': i} for i in range(5)]
+    assert isinstance(results[5], requests.exceptions.ConnectionError)
+
+
+def test_post_many_on_response(server, client):
+    def read(response):
+        if response.json() == {'i': 1}:
+            raise requests.exceptions.ChunkedEncodingError('lost')
+        return response.json()['i']
+
+    results = client.post_many([(server + '/ok', {'i': i}) for i in range(3)], on_response=read)
+    assert results[0] == 0 and results[2] == 2
+    assert isinstance(results[1], requests.exceptions.ChunkedEncodingError)
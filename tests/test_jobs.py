@@ -0,0 +1,126 @@
+import time
+import threading
+import pytest
+from werkzeug.exceptions import BadRequest
+import jobs
+import processors
+from jobs import JobQueue, MemoryJobStore, PostgresJobStore, QueueFull, JobNotSaved
+
+
+def register_processor(monkeypatch, transform):
+    processor = processors.Processor('test_group', reader=lambda file_path, processor, context: file_path,
+                                     transform=transform, message="test file is processed")
+    monkeypatch.setitem(processors._processors, 'test_group', processor)
+    return processor
+
+
+def wait_for(queue, job_id, statuses=('done', 'failed'), timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job['status'] in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f"Job {job_id} is still {job['status']}")
+
+
+def test_job_is_done(monkeypatch):
+    seen = {}
+
+    def transform(data, processor, context):
+        seen.update(context)
+        context['progress'](50)
+
+    register_processor(monkeypatch, transform)
+    queue = JobQueue(MemoryJobStore())
+    job_id = queue.submit('test_group', 'test_group processor', '/tmp/file.xlsx', client_id=1, api_id=2,
+                          sha256='abc')
+    job = wait_for(queue, job_id)
+    assert job['status'] == 'done'
+    assert job['progress'] == 100
+    assert job['result'] == {"message": "Client file: file.xlsx is successfully saved and test file is processed."}
+    assert job['error'] is None
+    assert (seen['client_id'], seen['api_id'], seen['sha256']) == (1, 2, 'abc')
+
+
+def test_http_error_fails_job(monkeypatch):
+    def transform(data, processor, context):
+        raise BadRequest(description={"missing_columns": ["price"]})
+
+    register_processor(monkeypatch, transform)
+    queue = JobQueue(MemoryJobStore())
+    job = wait_for(queue, queue.submit('test_group', 'test_group processor', '/tmp/file.xlsx', client_id=1))
+    assert job['status'] == 'failed'
+    assert job['error'] == {"code": 400, "description": {"missing_columns": ["price"]}}
+
+
+def test_unexpected_error_fails_job(monkeypatch):
+    def transform(data, processor, context):
+        raise ValueError("broken")
+
+    register_processor(monkeypatch, transform)
+    queue = JobQueue(MemoryJobStore())
+    job = wait_for(queue, queue.submit('test_group', 'test_group processor', '/tmp/file.xlsx'))
+    assert job['status'] == 'failed'
+    assert job['error'] == {"code": 500, "description": "ValueError('broken')"}
+
+
+def test_queue_full(monkeypatch):
+    release = threading.Event()
+    register_processor(monkeypatch, lambda data, processor, context: release.wait(5))
+    queue = JobQueue(MemoryJobStore(), max_workers=1, max_queued=1)
+    try:
+        job_ids = [queue.submit('test_group', 'test_group processor', '/tmp/file.xlsx') for _ in range(2)]
+        with pytest.raises(QueueFull):
+            queue.submit('test_group', 'test_group processor', '/tmp/file.xlsx')
+    finally:
+        release.set()
+    for job_id in job_ids:
+        assert wait_for(queue, job_id)['status'] == 'done'
+    # Finished jobs free their places
+    assert wait_for(queue, queue.submit('test_group', 'test_group processor', '/tmp/file.xlsx'))['status'] == 'done'
+
+
+def test_job_not_saved_is_not_run(monkeypatch):
+    ran = threading.Event()
+    register_processor(monkeypatch, lambda data, processor, context: ran.set())
+
+    class FailingStore(MemoryJobStore):
+        def create(self, job):
+            raise JobNotSaved("store is down")
+
+    queue = JobQueue(FailingStore(), max_workers=1, max_queued=0)
+    with pytest.raises(JobNotSaved):
+        queue.submit('test_group', 'test_group processor', '/tmp/file.xlsx')
+    assert not ran.wait(0.2)
+    # The failed submit doesn't hold a place in the queue
+    with pytest.raises(JobNotSaved):
+        queue.submit('test_group', 'test_group processor', '/tmp/file.xlsx')
+
+
+def test_postgres_store_raises_if_insert_fails(monkeypatch):
+    class FailingDB:
+        def __init__(self, connection_string):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            return False
+
+        def insert_file_job(self, job):
+            return False
+
+    monkeypatch.setattr(jobs, 'DB', FailingDB)
+    with pytest.raises(JobNotSaved):
+        PostgresJobStore().create({'job_id': 'abc'})
+
+
+def test_claim_once():
+    store = MemoryJobStore()
+    store.create({'job_id': 'abc', 'status': 'queued'})
+    assert store.claim('abc', 1)
+    assert not store.claim('abc', 2)
+    assert store.get('abc')['worker_pid'] == 1
+    assert not store.claim('missing', 1)
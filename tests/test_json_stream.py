@@ -0,0 +1,91 @@
+import json
+import pytest
+from json_stream import spill_table, UnsupportedShape, _Reader
+from report_writers import table_from_result
+
+CHUNK_SIZES = [1, 2, 7, 65536]
+
+RESULTS = {
+    'records': '''[{"date": "2024-01-01", "views": 10, "ctr": 0.5},
+                   {"date": "2024-01-02", "views": -3, "ctr": 1.25e-3, "name": "Молоко \\"3,2%\\""},
+                   {"views": 12345678901234567890, "nested": {"a": [1, {"b": "]},["}]}, "date": null}]''',
+    'rows': '[[1, "a,b"], [2.5e10, "]", true, false], [], [null, "}", [3, 4]]]',
+    'columns': '{"date": ["2024-01-01", "2024-01-02"], "views": [1e3, -0.0], "shop": "Shop, \\"main\\"", '
+               '"list": [[1], {"a": "]"}]}',
+    'repeated keys': '{"a": [1, 2], "b": [3, 4], "a": [5, 6], "c": 7, "b": 8}',
+    'record': '{"total": 1.5, "name": "итого", "tags": [1, 2], "extra": {"x": null}}',
+    'record with a list': '{"a": 1, "b": [1]}',
+    'numbers': '[[0, -1, 1.0, 1e5, 1E-5, -12.75e+2, 123456789012345678901234567890]]',
+    'empty': ' [ ] ',
+    'whitespace': '\n[ {"a" : 1 } ,\n\t{ "a" :[ 2 , 3 ]} ]\n',
+}
+
+INVALID = ['', '   ', '[[1], [2]', '[{"a": 1}', '{"a": [1, 2]', '{"a" 1}', '[{"a": 1} {"a": 2}]', '[[1],]', '[] []',
+           '{"a": [1]} x', '[{"a": tru}]', '{1: [2]}', '{"a": [1 2]}']
+
+UNSUPPORTED = ['1', '"text"', 'null', '[1, 2]', '[{"a": 1}, [1]]', '[[1], {"a": 1}]', '{}',
+               '{"a": [1], "b": [1, 2]}', '{"a": [1], "b": {"x": 1}}']
+
+
+def chunked(text, size):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def spilled(text, size):
+    with spill_table(chunked(text, size)) as table:
+        return table.columns, list(table.rows())
+
+
+@pytest.mark.parametrize('size', CHUNK_SIZES)
+@pytest.mark.parametrize('name', RESULTS)
+def test_same_table_as_json_loads(name, size):
+    columns, rows = table_from_result(json.loads(RESULTS[name]))
+    assert spilled(RESULTS[name], size) == (columns, list(rows))
+
+
+@pytest.mark.parametrize('size', [1, 7])
+@pytest.mark.parametrize('text', INVALID)
+def test_invalid_json(text, size):
+    with pytest.raises(ValueError):
+        json.loads(text)
+    with pytest.raises(ValueError) as e:
+        spilled(text, size)
+    assert not isinstance(e.value, UnsupportedShape)
+
+
+@pytest.mark.parametrize('size', [1, 7])
+@pytest.mark.parametrize('text', UNSUPPORTED)
+def test_unsupported_shape(text, size):
+    assert table_from_result(json.loads(text)) is None
+    with pytest.raises(UnsupportedShape):
+        spilled(text, size)
+
+
+def test_number_split_across_chunks():
+    # raw_decode of '12' would return 12 before the rest of the number arrives
+    text = '[[12.5e3, -7]]'
+    for cut in range(1, len(text)):
+        with spill_table([text[:cut], text[cut:]]) as table:
+            assert list(table.rows()) == [(12.5e3, -7)]
+    with spill_table(['[[1', '2', '.', '5', 'e', '3', ', -', '7]]']) as table:
+        assert list(table.rows()) == [(12.5e3, -7)]
+
+
+def test_batches_decode_buffered_items_at_once():
+    reader = _Reader(['[{"a": 1}, {"a": [2]}, {"a": "x"}]'])
+    reader.expect('[')
+    batches = list(reader.batches())
+    assert [items for items, _ in batches] == [[{'a': 1}, {'a': [2]}, {'a': 'x'}]]
+    assert json.loads(batches[0][1]) == batches[0][0]
+
+
+@pytest.mark.parametrize('size', [1, 3, 7, 100])
+def test_batches_wrong_cuts(size):
+    # Brackets and commas in strings and nested values are not item ends
+    items = ['a],[', {'b': '}, {'}, [1, [2, ']']], '",', {'c': {'d': [{}]}}, 12.5]
+    reader = _Reader(chunked(json.dumps(items), size))
+    reader.expect('[')
+    batches = list(reader.batches())
+    assert [item for batch, _ in batches for item in batch] == items
+    assert all(json.loads(text) == batch for batch, text in batches)
+    assert reader.peek() == ''
@@ -0,0 +1,78 @@
+import os
+import time
+import pytest
+import report_cache
+from postgres import DB
+
+evict = report_cache.evict
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(report_cache, 'REPORT_CACHE_DIR', str(tmp_path / 'report_cache'))
+    monkeypatch.setattr(report_cache, 'REPORT_CACHE_TTL', 60)
+    monkeypatch.setattr(report_cache, 'evict', lambda: None)
+    return tmp_path / 'report_cache'
+
+
+def write_report(path, size=10):
+    with open(path, 'wb') as f:
+        f.write(b'x' * size)
+    return str(path)
+
+
+def put(file_id, file_path, json_data=None):
+    report_cache.put('/graphs/ddr', 1, 'xlsx', json_data or {}, file_id, file_path, 'ddr.xlsx', 'application/x')
+
+
+def get(json_data=None):
+    return report_cache.get('/graphs/ddr', 1, 'xlsx', json_data or {})
+
+
+def test_expired_report_is_kept_for_eviction(cache_dir, tmp_path, monkeypatch):
+    put(1, write_report(tmp_path / 'old.xlsx'))
+    assert get()['file_id'] == 1
+    now = time.time()
+    monkeypatch.setattr(report_cache.time, 'time', lambda: now + 120)
+    assert get() is None
+    put(2, write_report(tmp_path / 'new.xlsx'))
+    assert get()['file_id'] == 2
+    # Both reports are on disk, both count for the budget
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_deleted_report_is_dropped(cache_dir, tmp_path):
+    put(1, write_report(tmp_path / 'report.xlsx'))
+    os.remove(tmp_path / 'report.xlsx')
+    assert get() is None
+    assert os.listdir(cache_dir) == []
+
+
+def test_evict_every_n_puts(cache_dir, tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(report_cache, 'evict', lambda: calls.append(1))
+    monkeypatch.setattr(report_cache, 'REPORT_CACHE_EVICT_EVERY', 3)
+    for i in range(6):
+        put(i, write_report(tmp_path / f'{i}.xlsx'), {'i': i})
+    assert len(calls) == 2
+
+
+def test_evict_deletes_reports(pg_dsn, cache_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(report_cache, 'db_connection_string', pg_dsn)
+    paths = []
+    for i in range(3):
+        paths.append(write_report(tmp_path / f'{i}.xlsx', 100))
+        with DB(pg_dsn) as db:
+            file_id = db.insert_file_info_into_client_report_files_table(f'{i}.xlsx', 1, 'test', paths[-1])
+        put(file_id, paths[-1], {'i': i})
+        # The first report is the least recently used
+        os.utime(report_cache._entry_path(report_cache.cache_key('/graphs/ddr', 1, 'xlsx', {'i': i})), (i, i))
+    evict(max_bytes=200)
+    assert [os.path.isfile(path) for path in paths] == [False, True, True]
+    assert len(os.listdir(cache_dir)) == 2
+    assert get({'i': 0}) is None
+    with DB(pg_dsn) as db:
+        cursor = db.connection.cursor()
+        cursor.execute("SELECT count(*) FROM client_report_files WHERE file_path = ANY(%s);", (paths,))
+        assert cursor.fetchone()[0] == 2
+        db.connection.commit()
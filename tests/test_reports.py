@@ -0,0 +1,83 @@
+import pytest
+from werkzeug.exceptions import HTTPException
+import flask_app
+from http_client import get_http_client
+
+
+class FakeResponse:
+    """Upstream error response sent with stream=True, records whether it was closed."""
+    encoding = 'utf-8'
+
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self.data = data
+        self.closed = False
+
+    @property
+    def content(self):
+        return b''
+
+    def json(self):
+        return self.data
+
+    def close(self):
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    responses = []
+
+    def post(url, **kwargs):
+        responses.append(FakeResponse(422, {'detail': url}))
+        return responses[-1]
+
+    monkeypatch.setattr(get_http_client(), 'post', post)
+    monkeypatch.setattr(flask_app.report_cache, 'get', lambda *args: None)
+    return responses
+
+
+def test_report_upstream_error_closes_response(upstream):
+    response = flask_app.app.test_client().post('/report', query_string={'client_id': 1, 'method': '/graphs/ddr'},
+                                                json={})
+    assert response.status_code == 422
+    assert [r.closed for r in upstream] == [True]
+
+
+def test_batch_upstream_error_closes_responses(upstream):
+    response = flask_app.app.test_client().post('/reports/batch', query_string={'client_id': 1},
+                                                json={'methods': ['/graphs/ddr', '/graphs/costs_cpo'], 'data': {}})
+    assert response.status_code == 422
+    assert [r.closed for r in upstream] == [True, True]
+
+
+class FailingDB:
+    """DB that can't save anything."""
+
+    def __init__(self, *args):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def insert_file_info_into_client_report_files_table(self, *args):
+        return None
+
+
+def test_unregistered_report_is_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(flask_app, 'DB', FailingDB)
+    file_path = tmp_path / 'report.xlsx'
+    file_path.write_bytes(b'report')
+    with flask_app.app.test_request_context(), pytest.raises(HTTPException) as e:
+        flask_app.register_report('report.xlsx', 1, 'ddr', str(file_path), 'checksum')
+    assert e.value.code == 500
+    assert not file_path.exists()
@@ -0,0 +1,84 @@
+import pandas as pd
+import pytest
+from werkzeug.exceptions import HTTPException
+from validation import Schema, Column, SCHEMAS, validate_frame, check_frame, iter_checked_rows
+
+PRICE = SCHEMAS['price']
+
+
+def positions(errors):
+    return [(error['row'], error['column'], error['error']) for error in errors]
+
+
+def test_clean_frame():
+    df = pd.DataFrame({'offer_id': ['a', 'b', 'c'], 'price': [1, '2.5', 0]})
+    checked, errors, errors_count = validate_frame(df, PRICE)
+    assert (errors, errors_count) == ([], 0)
+    assert checked['price'].tolist() == [1.0, 2.5, 0.0]
+    assert checked['offer_id'].tolist() == ['a', 'b', 'c']
+
+
+def test_dirty_frame_positions():
+    df = pd.DataFrame({'offer_id': ['a', None, 'c', 'a', 'e'], 'price': [-1, 2, 'abc', 3, None]})
+    _, errors, errors_count = validate_frame(df, PRICE)
+    # The header is row 1, so the first row of the frame is row 2; errors are ordered by row
+    assert positions(errors) == [(2, 'price', 'less than 0'), (3, 'offer_id', 'empty value'),
+                                 (4, 'price', 'not float'), (5, 'offer_id', 'duplicate value'),
+                                 (6, 'price', 'empty value')]
+    assert errors_count == 5
+    assert errors[2]['value'] == 'abc'
+
+
+def test_first_row():
+    df = pd.DataFrame({'offer_id': ['a', None], 'price': [1, 2]})
+    _, errors, _ = validate_frame(df, PRICE, first_row=101)
+    assert positions(errors) == [(102, 'offer_id', 'empty value')]
+
+
+def test_strings_in_numeric_columns():
+    schema = Schema([Column('count', 'int', nullable=True), Column('share', 'float', nullable=True),
+                     Column('day', 'date', nullable=True)])
+    df = pd.DataFrame({'count': ['10', '1.5', 'ten', None], 'share': ['0.5', '12,5', '1e3', ''],
+                       'day': ['2024-01-31', 'yesterday', None, '2024-02-01']})
+    checked, errors, errors_count = validate_frame(df, schema)
+    assert positions(errors) == [(3, 'count', 'not int'), (3, 'share', 'not float'), (3, 'day', 'not date'),
+                                 (4, 'count', 'not int'), (5, 'share', 'not float')]
+    assert errors_count == 5
+    assert checked['count'].iloc[0] == 10
+    assert checked['share'].iloc[2] == 1000.0
+
+
+def test_headers():
+    df = pd.DataFrame({'price': [1], 'offer_id': ['a'], 'extra': [1]})
+    _, errors, errors_count = validate_frame(df, PRICE)
+    assert positions(errors) == [(1, 'offer_id', 'column must be number 1'), (1, 'price', 'column must be number 2'),
+                                 (1, 'extra', 'unexpected column')]
+    assert errors_count == 3
+
+
+def test_max_errors():
+    df = pd.DataFrame({'offer_id': [None] * 1000, 'price': ['x'] * 1000})
+    _, errors, errors_count = validate_frame(df, PRICE, max_errors=10)
+    assert errors_count == 2000
+    # The first errors by row are kept, whatever the column they are in
+    assert len(errors) == 10
+    assert [error['row'] for error in errors] == [2, 2, 3, 3, 4, 4, 5, 5, 6, 6]
+
+
+def test_check_frame_aborts():
+    df = pd.DataFrame({'offer_id': ['a'], 'price': ['x']})
+    with pytest.raises(HTTPException) as e:
+        check_frame(df, 'price')
+    assert e.value.code == 400
+    assert e.value.description['errors_count'] == 1
+    assert positions(e.value.description['errors']) == [(2, 'price', 'not float')]
+
+
+def test_iter_checked_rows_numbers_rows_across_batches():
+    rows = [('a', 1), ('b', 2, 'cut'), ('c',), ('d', 4), ('e', -5)]
+    assert list(iter_checked_rows(rows[:2] + rows[3:4], ['offer_id', 'price'], 'price', batch_size=2)) == \
+        [('a', 1), ('b', 2), ('d', 4)]
+    with pytest.raises(HTTPException) as e:
+        list(iter_checked_rows(rows, ['offer_id', 'price'], 'price', batch_size=2))
+    # Row 4 ('c') has no price, it is in the second batch
+    assert positions(e.value.description['errors']) == [(4, 'price', 'empty value')]
@@ -0,0 +1,229 @@
+import os
+import numpy as np
+import pandas as pd
+import my_logger
+from flask import abort
+from bulk_load import iter_batches, COPY_BATCH_SIZE
+
+# Max number of errors listed in the report, the total count is always given
+VALIDATION_MAX_ERRORS = int(os.getenv('VALIDATION_MAX_ERRORS', 100))
+
+logger = my_logger.init_logger("validation")
+
+
+class Column:
+    """Expected column of an uploaded file.
+    dtype is one of 'str', 'int', 'float', 'date'; min_value/max_value apply to numbers."""
+
+    def __init__(self, name, dtype='str', nullable=False, unique=False, min_value=None, max_value=None):
+        self.name = name
+        self.dtype = dtype
+        self.nullable = nullable
+        self.unique = unique
+        self.min_value = min_value
+        self.max_value = max_value
+
+
+class Schema:
+    """Columns of a file_group's files, in order. With columns=None any headers
+    are accepted and every column is checked against any_column."""
+
+    def __init__(self, columns=None, any_column=None):
+        self.columns = columns
+        self.any_column = any_column or Column(None)
+
+    def column_specs(self, headers):
+        if self.columns is None:
+            return [self.any_column] * len(headers)
+        return self.columns
+
+
+SCHEMAS = {
+    'price': Schema([Column('offer_id', unique=True),
+                     Column('price', 'float', min_value=0)]),
+    'margin': Schema([Column('offer_id', unique=True),
+                      Column('margin', 'float')]),
+    # Headers are client's store names
+    'offers_mapping_table': Schema(),
+    'yandex_impressions_and_sales': Schema([
+        Column('Название бизнес аккаунта', nullable=True), Column('Тип бизнес аккаунта', nullable=True),
+        Column('ID бизнес аккаунта', 'int', nullable=True), Column('Магазин', nullable=True),
+        Column('ID магазина', 'int', nullable=True), Column('День', 'date'),
+        Column('Месяц', nullable=True), Column('Год', 'int', nullable=True),
+        Column('ID округа', 'int', nullable=True), Column('Федеральный округ', nullable=True),
+        Column('ID бренда', 'int', nullable=True), Column('Бренд', nullable=True),
+        Column('ID категории', 'int', nullable=True), Column('Категория', nullable=True),
+        Column('Ваш SKU'), Column('Название товара', nullable=True),
+        Column('Показы', 'float', nullable=True, min_value=0),
+        Column('Добавлено в корзину, шт.', 'float', nullable=True, min_value=0),
+        Column('Конверсия добавления в корзину, %', 'float', nullable=True, min_value=0),
+        Column('Продажи, шт.', 'float', nullable=True, min_value=0),
+        Column('Цена товара, руб.', 'float', nullable=True, min_value=0),
+        Column('Продажи, руб.', 'float', nullable=True, min_value=0)]),
+    # The last row is a summary row, read_report_rows leaves it out
+    'yandex_sales_boost': Schema([
+        Column('Название бизнес аккаунта', nullable=True), Column('Тип бизнес аккаунта', nullable=True),
+        Column('ID бизнес аккаунта', 'int', nullable=True), Column('Магазин', nullable=True),
+        Column('ID магазина', 'int', nullable=True), Column('Начало периода', 'date'),
+        Column('Конец периода', 'date'), Column('Ваш SKU'), Column('Наименование предложения', nullable=True),
+        Column('Продано с помощью продвижения, шт', 'float', nullable=True, min_value=0),
+        Column('Продано с помощью продвижения, рубли', 'float', nullable=True, min_value=0),
+        Column('Расход на продвижение, рубли', 'float', nullable=True, min_value=0),
+        Column('Расход на продвижение, %', 'float', nullable=True),
+        Column('Средняя стоимость продвижения', 'float', nullable=True),
+        Column('Продано всего, шт', 'int', nullable=True, min_value=0),
+        Column('Продано всего, рубли', 'float', nullable=True, min_value=0),
+        Column('Количество, шт', 'float', nullable=True),
+        Column('Доля продаж у партнера', 'float', nullable=True),
+        Column('Клики по товарам со ставками, шт.', 'int', nullable=True, min_value=0),
+        Column('Все клики, шт.', 'int', nullable=True, min_value=0),
+        Column('Заказано товаров со ставками, шт.', 'int', nullable=True, min_value=0),
+        Column('Всего заказано товаров, шт.', 'int', nullable=True, min_value=0)]),
+}
+
+
+class ErrorReport:
+    """Collects errors as {'row', 'column', 'value', 'error'}; rows are numbered as in
+    the spreadsheet (header is row 1). Only the first max_errors (by row) are kept."""
+
+    def __init__(self, max_errors=VALIDATION_MAX_ERRORS):
+        self.max_errors = max_errors
+        self.count = 0
+        self.errors = []
+
+    def add(self, row, column, value, error):
+        self.count += 1
+        self.errors.append({'row': row, 'column': column, 'value': _json_value(value), 'error': error})
+
+    def add_mask(self, mask, series, first_row, error):
+        """Add an error for every True in mask; only the first max_errors positions are materialised."""
+        positions = np.flatnonzero(mask)
+        self.count += len(positions)
+        for position in positions[:self.max_errors]:
+            self.errors.append({'row': int(position) + first_row, 'column': series.name,
+                                'value': _json_value(series.iat[position]), 'error': error})
+
+    def result(self):
+        errors = sorted(self.errors, key=lambda e: e['row'])[:self.max_errors]
+        return errors, self.count
+
+
+def _json_value(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def _convert(series, dtype):
+    """Return (converted series, mask of non-null values of the wrong type)."""
+    if dtype in ('int', 'float'):
+        converted = pd.to_numeric(series, errors='coerce')
+        bad = converted.isna().to_numpy()
+        if dtype == 'int':
+            bad |= (converted % 1 != 0).to_numpy()
+    elif dtype == 'date':
+        converted = pd.to_datetime(series, errors='coerce')
+        bad = converted.isna().to_numpy()
+    else:
+        return series, None
+    return converted, bad
+
+
+def check_headers(headers, schema, report):
+    """Add an error (row 1) for every missing, unexpected or misplaced header."""
+    headers = list(headers)
+    if schema.columns is None:
+        if not headers:
+            report.add(1, None, None, "no columns")
+        for i, header in enumerate(headers):
+            if header is None:
+                report.add(1, i + 1, None, "empty header")
+        return
+    expected = [column.name for column in schema.columns]
+    for i, name in enumerate(expected):
+        if name not in headers:
+            report.add(1, name, None, "missing column")
+        elif i >= len(headers) or headers[i] != name:
+            report.add(1, name, None, f"column must be number {i + 1}")
+    for header in headers:
+        if header not in expected:
+            report.add(1, header, None, "unexpected column")
+
+
+def validate_frame(df, schema, first_row=2, max_errors=VALIDATION_MAX_ERRORS, convert=True):
+    """Check df against schema column by column with vectorised operations.
+    first_row is the spreadsheet row number of df's first row.
+    Return (df with converted numeric and date columns, errors, errors_count);
+    with convert=False df is returned as is."""
+    report = ErrorReport(max_errors)
+    check_headers(df.columns, schema, report)
+    if report.count:
+        return df, *report.result()
+    converted_columns = {}
+    for spec, name in zip(schema.column_specs(df.columns), df.columns):
+        series = df[name]
+        nulls = series.isna().to_numpy()
+        if not spec.nullable:
+            report.add_mask(nulls, series, first_row, "empty value")
+        converted, bad = _convert(series, spec.dtype)
+        if bad is not None:
+            bad &= ~nulls
+            report.add_mask(bad, series, first_row, f"not {spec.dtype}")
+            converted_columns[name] = converted
+            if spec.min_value is not None:
+                report.add_mask((converted < spec.min_value).to_numpy(), series, first_row,
+                                f"less than {spec.min_value}")
+            if spec.max_value is not None:
+                report.add_mask((converted > spec.max_value).to_numpy(), series, first_row,
+                                f"greater than {spec.max_value}")
+        if spec.unique:
+            report.add_mask(series.duplicated().to_numpy() & ~nulls, series, first_row, "duplicate value")
+    if convert and converted_columns:
+        df = df.assign(**converted_columns)
+    return df, *report.result()
+
+
+def abort_with_errors(errors, errors_count, filename=None):
+    logger.warning(f"400 {filename or 'File'} has {errors_count} validation errors.")
+    abort(400, description={"message": "File validation failed.",
+                            "errors_count": errors_count,
+                            "errors": errors})
+
+
+def check_frame(df, file_group, filename=None, first_row=2):
+    """Validate df against the schema of file_group and return it with converted columns.
+    Abort with 400 and error report (at most VALIDATION_MAX_ERRORS entries) if it is invalid."""
+    df, errors, errors_count = validate_frame(df, SCHEMAS[file_group], first_row=first_row)
+    if errors_count:
+        abort_with_errors(errors, errors_count, filename)
+    return df
+
+
+def check_file_headers(headers, file_group, filename=None):
+    """Abort with 400 and error report if headers do not match the schema of file_group."""
+    report = ErrorReport()
+    check_headers(headers, SCHEMAS[file_group], report)
+    if report.count:
+        abort_with_errors(*report.result(), filename)
+
+
+def iter_checked_rows(rows, headers, file_group, filename=None, batch_size=COPY_BATCH_SIZE):
+    """Yield rows (cut or padded to the headers length) of a streamed file, validating them
+    in batches of batch_size. Abort with 400 on the first batch with errors,
+    headers are expected to be checked with check_file_headers."""
+    schema = SCHEMAS[file_group]
+    headers = list(headers)
+    width = len(headers)
+    first_row = 2
+    for batch in iter_batches(rows, batch_size):
+        batch = [tuple(row[:width]) + (None,) * (width - len(row)) for row in batch]
+        _, errors, errors_count = validate_frame(pd.DataFrame.from_records(batch, columns=headers),
+                                                 schema, first_row=first_row, convert=False)
+        if errors_count:
+            abort_with_errors(errors, errors_count, filename)
+        first_row += len(batch)
+        yield from batch